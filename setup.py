@@ -8,6 +8,8 @@ setup(
     entry_points={
         'console_scripts': [
             'unicorn = unicorn.__main__:main',
+            'unicorn-bench = unicorn.bench:main',
+            'unicorn-loadtest = unicorn.loadtest:main',
         ],
     },
     packages=find_packages(),
@@ -16,6 +18,8 @@ setup(
     ],
     extras_require={
         'web': ['hug', 'jinja2'],
+        'asgi': ['aiohttp', 'hug', 'jinja2', 'uvicorn'],
+        'orjson': ['orjson'],
         'test': ['pytest'],
     },
 )
@@ -1,6 +1,29 @@
-from typing import Mapping, Optional, Sequence, Union
+from typing import Any, Mapping, Optional, Sequence, Union
+
+
+class TransportError(Exception):
+    status_code: Union[int, str]
+    error: str
+    info: Any
+
+
+class ConnectionError(TransportError): ...
+
+
+class ConnectionTimeout(ConnectionError): ...
+
+
+class IndicesClient:
+    def get_settings(self, index: Optional[str] = None, name: Optional[str] = None) -> Mapping: ...
 
 
 class Elasticsearch:
+    indices: IndicesClient
+
     def __init__(self, hosts: Optional[Union[str, Sequence[str]]] = None, **kwargs) -> None: ...
-    def search(self, index: str, body: Union[str, Mapping]) -> Mapping: ...
+    def search(
+        self, index: str, body: Union[str, Mapping], request_timeout: Optional[float] = None,
+        filter_path: Optional[Sequence[str]] = None) -> Mapping: ...
+    def msearch(
+        self, body: Sequence[Mapping], index: Optional[str] = None,
+        request_timeout: Optional[float] = None, filter_path: Optional[Sequence[str]] = None) -> Mapping: ...
@@ -1,6 +1,15 @@
 from hug.output_format import OutputFormat
-from typing import Callable, TypeVar
+from typing import Any, Callable, TypeVar
 
 T = TypeVar('T', bound=Callable)
 
+HTTP_400: str
+
 def get(route, output: OutputFormat) -> Callable[[T], T]: ...
+
+class HTTPInterfaceAPI:
+    server: Callable[[], Callable]
+
+class API:
+    http: HTTPInterfaceAPI
+    def __init__(self, module: Any) -> None: ...
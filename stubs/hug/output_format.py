@@ -2,8 +2,8 @@ from typing import Any, Mapping, Protocol
 
 # Lax definition for now, may want to pin it down
 class OutputFormat(Protocol):
-    def __call__(**kwargs) -> Any: ...
+    def __call__(self, content: Any, **kwargs) -> Any: ...
 
 def accept(kinds: Mapping[str, OutputFormat]) -> OutputFormat: ...
-def json(**kwargs) -> Any: ...
+def json(content: Any, **kwargs) -> Any: ...
 def html(content: str, **kwargs) -> Any: ...
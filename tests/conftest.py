@@ -1,7 +1,12 @@
+from collections import Counter
 import json
 import os
+import re
+
 import pytest
 
+from unicorn.loadtest import StubElasticsearch
+
 
 @pytest.fixture(scope='session')
 def fixture_dir():
@@ -37,3 +42,177 @@ def fixture_factory(fixture_dir):
         path = os.path.join(fixture_dir, group, fixture_id, group, fixture_id + '.expected')
         return on_disk_fixture(path)
     return factory
+
+
+def add_doc(docs, title, sitelink_count, edges):
+    docs.append({
+        '_id': str(len(docs) + 1),
+        '_source': {
+            'title': title,
+            'sitelink_count': sitelink_count,
+            'statement_keywords': edges,
+            'labels': {'en': ['label ' + title]},
+        },
+    })
+
+
+def make_docs():
+    """Small wikibase-like graph of hospitals, their kinds and owners"""
+    docs = []
+    add_doc(docs, 'Q16917', 500, ['P279=Q4287745'])
+    add_doc(docs, 'Q1774898', 300, ['P279=Q16917'])
+    add_doc(docs, 'Q64578911', 10, ['P279=Q16917'])
+    add_doc(docs, 'Q5', 50, ['P279=Q64578911'])
+    for i in range(100, 160):
+        kind = ['Q16917', 'Q1774898', 'Q64578911', 'Q5'][i % 4]
+        owner = 'Q{}'.format(1000 + i % 7)
+        add_doc(docs, 'Q{}'.format(i), i % 13, ['P31=' + kind, 'P127=' + owner, 'P17=Q30'])
+    for i in range(7):
+        add_doc(docs, 'Q{}'.format(1000 + i), 20 + i, ['P31=Q43229', 'P17=Q{}'.format(30 + i % 2)])
+    return docs
+
+
+def field_values(doc, field):
+    source = doc['_source']
+    if field == 'statement_keywords':
+        return [edge.lower() for edge in source['statement_keywords']]
+    if field == 'statement_keywords.property':
+        return [edge.split('=')[0].lower() for edge in source['statement_keywords']]
+    if field == 'title' or field.startswith('title.'):
+        return [source['title']]
+    if field == 'sitelink_count':
+        return [source['sitelink_count']]
+    raise ValueError('unknown field ' + field)
+
+
+def matches(doc, query):
+    (kind, body), = query.items()
+    if kind == 'match_all':
+        return True
+    if kind == 'match_none':
+        return False
+    if kind == 'match':
+        (field, value), = body.items()
+        return value.lower() in [v.lower() for v in field_values(doc, field)]
+    if kind == 'terms':
+        (field, values), = body.items()
+        return bool(set(values) & set(field_values(doc, field)))
+    if kind == 'bool':
+        if not all(matches(doc, q) for q in body.get('must', []) + body.get('filter', [])):
+            return False
+        if any(matches(doc, q) for q in body.get('must_not', [])):
+            return False
+        should = body.get('should', [])
+        if should and not (body.get('must') or body.get('filter')):
+            return any(matches(doc, q) for q in should)
+        return True
+    raise ValueError('unknown query ' + kind)
+
+
+def sort_orders(sort):
+    """Fields and orders of an elasticsearch sort"""
+    orders = []
+    for spec in sort if isinstance(sort, list) else [sort]:
+        if isinstance(spec, str):
+            orders.append((spec, 'asc'))
+        else:
+            (field, order), = spec.items()
+            orders.append((field, order['order'] if isinstance(order, dict) else order))
+    return orders
+
+
+def sort_key(values, orders):
+    return [-value if order == 'desc' else value for value, (_, order) in zip(values, orders)]
+
+
+def filter_source(source, paths):
+    """Parts of source selected by dotted paths"""
+    filtered = {}
+    for path in paths:
+        *parents, name = path.split('.')
+        src, dst = source, filtered
+        for parent in parents:
+            src = src.get(parent, {})
+            dst = dst.setdefault(parent, {})
+        if name in src:
+            dst[name] = src[name]
+    return filtered
+
+
+def aggregate(hits, aggs):
+    """Terms aggregations over matching docs, ordered by doc count"""
+    aggregations = {}
+    for name, agg in aggs.items():
+        terms = agg['terms']
+        include = re.compile(terms.get('include', '.*'))
+        counts = Counter(
+            value
+            for doc in hits
+            for value in set(field_values(doc, terms['field']))
+            if include.fullmatch(value))
+        buckets = [
+            {'key': key, 'doc_count': count}
+            for key, count in sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        ]
+        size = terms.get('size', 10)
+        aggregations[name] = {
+            'sum_other_doc_count': sum(bucket['doc_count'] for bucket in buckets[size:]),
+            'buckets': buckets[:size],
+        }
+    return aggregations
+
+
+class FakeElasticsearch(StubElasticsearch):
+    """In-memory stand-in for the search api of elasticsearch
+
+    Supports the subset of the query dsl and terms aggregations built
+    by BasicQueryBuilder. latency_s delays each request, as with the
+    stub elasticsearch of load tests.
+    """
+    def __init__(self, docs=None, latency_s=0.):
+        super().__init__(latency_ms=latency_s * 1000)
+        self.docs = make_docs() if docs is None else docs
+        self.requests = []
+
+    def response(self, body):
+        self.requests.append(body)
+        hits = [doc for doc in self.docs if matches(doc, body.get('query', {'match_all': {}}))]
+        orders = sort_orders(body.get('sort', '_id'))
+        keyed = sorted((
+            ([doc['_id'] if field == '_id' else field_values(doc, field)[0] for field, _ in orders], doc)
+            for doc in hits
+        ), key=lambda item: sort_key(item[0], orders))
+        if 'search_after' in body:
+            after = sort_key(body['search_after'], orders)
+            keyed = [item for item in keyed if sort_key(item[0], orders) > after]
+        es_hits = []
+        for values, doc in keyed[:body.get('size', 10)]:
+            es_hit = {'_id': doc['_id'], '_source': doc['_source'], 'sort': values}
+            if isinstance(body.get('_source'), list):
+                es_hit['_source'] = filter_source(doc['_source'], body['_source'])
+            if 'docvalue_fields' in body:
+                es_hit['fields'] = {field: field_values(doc, field) for field in body['docvalue_fields']}
+                # Only honoured along with doc values, other tests
+                # read ids of hits requested without any source.
+                if body.get('_source') is False:
+                    del es_hit['_source']
+            es_hits.append(es_hit)
+        response = {'took': 1, 'timed_out': False, 'hits': {'total': len(hits), 'hits': es_hits}}
+        if 'aggs' in body:
+            response['aggregations'] = aggregate(hits, body['aggs'])
+        return response
+
+
+@pytest.fixture
+def docs():
+    return make_docs()
+
+
+@pytest.fixture
+def elastic(docs):
+    return FakeElasticsearch(docs)
+
+
+@pytest.fixture
+def elastic_factory():
+    return FakeElasticsearch
@@ -0,0 +1,59 @@
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('hug')
+from unicorn import asgi  # noqa: E402
+
+
+async def call(path, query_string, messages):
+    scope = {'type': 'http', 'path': path, 'query_string': query_string, 'headers': []}
+
+    async def receive():
+        return {'type': 'http.request'}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi.app(scope, receive, send)
+
+
+def response(messages):
+    start, body = messages
+    return start['status'], json.loads(body['body'])
+
+
+def request(path, query_string):
+    messages = []
+    asyncio.run(call(path, query_string, messages))
+    return response(messages)
+
+
+@pytest.mark.parametrize('query_string', [
+    b'',
+    b'q=P31%3DQ5&size=many',
+    b'q=(foo+P31%3DQ5)',
+    b'q=(apply+P31%3D+%241)',
+])
+def test_bad_request(query_string):
+    status, body = request('/search', query_string)
+    assert status == 400
+    assert body['errors']
+
+
+def test_not_found():
+    assert request('/missing', b'')[0] == 404
+
+
+def test_server_error(monkeypatch):
+    async def fail(q: str):
+        raise RuntimeError('boom')
+
+    monkeypatch.setitem(asgi.routes, '/search', (fail, 'search.html'))
+    messages = []
+    # Raised on to the server, after responding
+    with pytest.raises(RuntimeError):
+        asyncio.run(call('/search', b'q=P31%3DQ5', messages))
+    assert response(messages) == (500, {'errors': {'500': 'Internal Server Error'}})
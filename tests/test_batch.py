@@ -0,0 +1,74 @@
+import io
+import json
+
+from unicorn.batch import run_batch, split_expressions
+
+
+def test_split_one_per_line():
+    lines = ['P31=Q5\n', '(or P31=Q5 P31=Q16917)\n']
+    assert list(split_expressions(lines)) == [(1, 'P31=Q5'), (2, '(or P31=Q5 P31=Q16917)')]
+
+
+def test_split_multiline_blocks():
+    lines = io.StringIO(
+        '# hospitals\n'
+        '\n'
+        '(extract P127=\n'
+        '    (or P31=Q16917\n'
+        '\n'
+        '        (apply P31= P279=Q16917)))\n'
+        'P31=Q5\n'
+    )
+    assert list(split_expressions(lines)) == [
+        (3, '(extract P127=\n    (or P31=Q16917\n\n        (apply P31= P279=Q16917)))'),
+        (7, 'P31=Q5'),
+    ]
+
+
+def test_split_comments_only_between_expressions():
+    lines = ['(and P31=Q5\n', '# P17=Q30\n', ')\n']
+    assert list(split_expressions(lines)) == [(1, '(and P31=Q5\n# P17=Q30\n)')]
+
+
+def test_split_unbalanced():
+    # Parsing reports the unbalanced brackets
+    assert list(split_expressions(['P31=Q5)\n', '(and P31=Q5\n'])) == [(1, 'P31=Q5)'), (2, '(and P31=Q5')]
+
+
+def test_run_batch_keeps_order_and_errors():
+    def run_one(expression):
+        if expression == 'bad':
+            raise ValueError('invalid')
+        return {'hits': [expression]}
+
+    out = io.StringIO()
+    report = run_batch([(1, 'a'), (2, 'bad'), (3, 'c')], run_one, out, concurrency=3)
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert records == [
+        {'line': 1, 'expression': 'a', 'hits': ['a']},
+        {'line': 2, 'expression': 'bad', 'error': 'ValueError: invalid'},
+        {'line': 3, 'expression': 'c', 'hits': ['c']},
+    ]
+    assert (report.queries, report.errors) == (3, 1)
+
+
+def test_run_batch_reads_ahead_a_bounded_window():
+    read = []
+    written = []
+
+    def expressions():
+        for i in range(1, 21):
+            read.append(i)
+            yield i, str(i)
+
+    class Out(io.StringIO):
+        def write(self, line):
+            # Expressions read by the time each record is written
+            written.append(len(read))
+            return super().write(line)
+
+    report = run_batch(expressions(), lambda expression: {}, Out(), concurrency=2)
+    assert report.queries == 20
+    # A window of concurrency * 2 queries, and the next expression
+    # waiting for room in it
+    assert all(count <= i + 5 for i, count in enumerate(written))
@@ -0,0 +1,46 @@
+import sys
+
+import pytest
+
+from unicorn.bench import main, measure, regressions, stage_request_bytes
+from unicorn.qb import CIRRUS_FIELDS, BasicQueryBuilder
+from unicorn.qe import BasicQueryExecutor
+from unicorn.trace import TraceNode
+
+
+def test_stage_request_bytes():
+    trace = TraceNode('(apply P31= P279=Q5)', requests=1, request_bytes=100, children=[
+        TraceNode('P279=Q5', requests=1, request_bytes=40),
+        TraceNode('(or P279=Q5 P279=Q6)', children=[
+            TraceNode('P279=Q5', requests=1, request_bytes=40),
+        ]),
+    ])
+    assert stage_request_bytes(trace) == {
+        'request_bytes (apply P31= P279=Q5)': 100,
+        'request_bytes P279=Q5': 80,
+    }
+
+
+def test_measure(elastic):
+    executor = BasicQueryExecutor(elastic, BasicQueryBuilder(**CIRRUS_FIELDS), 'wikidatawiki_content')
+    measured = measure('(apply P31= P279=Q16917)', executor, 10)
+    stages = {k: v for k, v in measured.items() if k.startswith('request_bytes ')}
+    assert set(stages) == {'request_bytes (apply P31= P279=Q16917)', 'request_bytes P279=Q16917'}
+    assert sum(stages.values()) == measured['request_bytes']
+    assert measured['requests'] == 2
+
+
+def test_regressions():
+    baseline = {'q': {'request_bytes P31=Q5': 100, 'execute_ms': 10.}}
+    assert regressions({'q': {'request_bytes P31=Q5': 100, 'execute_ms': 12.5}}, baseline, 0.2, 1.) == []
+    found = regressions({'q': {'request_bytes P31=Q5': 130, 'execute_ms': 14.}}, baseline, 0.2, 1.)
+    assert len(found) == 2
+
+
+def test_save_requires_baseline(monkeypatch, capsys):
+    argv = ['unicorn-bench', 'run', '--recording', 'rec.json', '--save', 'examples/hospitals']
+    monkeypatch.setattr(sys, 'argv', argv)
+    with pytest.raises(SystemExit) as exit:
+        main()
+    assert exit.value.code == 2
+    assert '--save requires --baseline' in capsys.readouterr().err
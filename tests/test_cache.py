@@ -0,0 +1,169 @@
+import threading
+
+import pytest
+
+from unicorn.cache import LRUCache, SqliteCache
+from unicorn.utils import timer
+
+
+class Clock:
+    def __init__(self, now=1000.):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_get_put():
+    cache = LRUCache()
+    assert cache.get('a') is None
+    cache.put('a', 1)
+    assert cache.get('a') == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    # Reading a makes b the least recently used
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_lru_ttl():
+    clock = Clock()
+    cache = LRUCache(ttl_s=10., clock=clock)
+    cache.put('a', 1)
+    clock.now += 10.
+    assert cache.get('a') == 1
+    clock.now += 1.
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_lru_put_refreshes_ttl():
+    clock = Clock()
+    cache = LRUCache(ttl_s=10., clock=clock)
+    cache.put('a', 1)
+    clock.now += 8.
+    cache.put('a', 2)
+    clock.now += 8.
+    assert cache.get('a') == 2
+
+
+@pytest.fixture
+def sqlite_path(tmp_path):
+    return str(tmp_path / 'stages.sqlite')
+
+
+def test_sqlite_get_put(sqlite_path):
+    cache = SqliteCache(sqlite_path)
+    assert cache.get(('stage', 1)) is None
+    cache.put(('stage', 1), {'hits': [1, 2]})
+    assert cache.get(('stage', 1)) == {'hits': [1, 2]}
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_sqlite_shared_between_instances(sqlite_path):
+    SqliteCache(sqlite_path).put('a', 1)
+    assert SqliteCache(sqlite_path).get('a') == 1
+
+
+def test_sqlite_ttl(sqlite_path):
+    clock = Clock()
+    cache = SqliteCache(sqlite_path, ttl_s=10., clock=clock)
+    cache.put('a', 1)
+    clock.now += 10.
+    assert cache.get('a') == 1
+    clock.now += 1.
+    assert cache.get('a') is None
+
+
+def test_sqlite_evicts_oldest(sqlite_path):
+    clock = Clock()
+    cache = SqliteCache(sqlite_path, max_entries=50, ttl_s=10., clock=clock)
+    cache.put('expired', 0)
+    clock.now += 11.
+    # Eviction runs every 100 puts
+    for i in range(99):
+        cache.put(i, i)
+    assert len(cache) == 50
+    assert cache.get(48) is None
+    assert cache.get(49) == 49
+    assert cache.get(98) == 98
+
+
+def refresh(cache):
+    """Run any refresh of the generation that is due to completion"""
+    cache.check_generation()
+    if cache.refresher is not None:
+        cache.refresher.join()
+
+
+def test_sqlite_generation(sqlite_path):
+    clock = Clock()
+    generation = ['1']
+    cache = SqliteCache(sqlite_path, generation=lambda: generation[0], generation_check_s=60., clock=clock)
+    refresh(cache)
+    cache.put('a', 1)
+    generation[0] = '2'
+    # The generation is only checked every generation_check_s
+    refresh(cache)
+    assert cache.get('a') == 1
+    clock.now += 60.
+    refresh(cache)
+    assert cache.get('a') is None
+    cache.put('a', 2)
+    # Other processes start with the generation last seen
+    other = SqliteCache(sqlite_path, generation=lambda: generation[0], clock=clock)
+    assert other.get('a') == 2
+
+
+def test_sqlite_ignores_other_generations(sqlite_path):
+    clock = Clock()
+    generation = ['1']
+    stale = SqliteCache(sqlite_path, generation=lambda: generation[0], clock=clock)
+    refresh(stale)
+    generation[0] = '2'
+    current = SqliteCache(sqlite_path, generation=lambda: generation[0], clock=clock)
+    refresh(current)
+    # Put before the stale process saw the new generation
+    stale.put('a', 1)
+    assert current.get('a') is None
+    assert stale.get('a') == 1
+    clock.now += 60.
+    refresh(stale)
+    assert stale.get('a') is None
+
+
+def test_sqlite_generation_errors_are_misses(sqlite_path):
+    def generation():
+        raise ConnectionError('cluster unavailable')
+
+    cache = SqliteCache(sqlite_path, generation=generation)
+    refresh(cache)
+    cache.put('a', 1)
+    assert cache.get('a') is None
+    assert cache.generation_errors == 1
+
+
+def test_sqlite_generation_refreshed_in_background(sqlite_path):
+    release = threading.Event()
+
+    def generation():
+        release.wait(5.)
+        return '1'
+
+    cache = SqliteCache(sqlite_path, generation=generation)
+    with timer() as took:
+        assert cache.get('a') is None
+    assert took.ms < 1000
+    release.set()
+    cache.refresher.join()
+    cache.put('a', 1)
+    assert cache.get('a') == 1
@@ -0,0 +1,56 @@
+import pytest
+
+from unicorn import parser, sexpr
+from unicorn.cache import LRUCache
+from unicorn.estimate import CostEstimator, CostExceeded
+from unicorn.qb import CIRRUS_FIELDS, BasicQueryBuilder
+from unicorn.qe import BasicQueryExecutor
+
+
+def parse(expression):
+    return parser.parse(sexpr.parse(expression))
+
+
+class CountingExecutor(BasicQueryExecutor):
+    def count(self, query_node):
+        self.counts.append((self.route(query_node), query_node))
+        return super().count(query_node)
+
+
+@pytest.fixture
+def executor(elastic):
+    executor = CountingExecutor(elastic, BasicQueryBuilder(**CIRRUS_FIELDS), 'wikidatawiki_content')
+    executor.counts = []
+    return executor
+
+
+def test_limits_stages_to_inner_hits(executor):
+    planned, estimate = CostEstimator(executor)(parse('(apply P31= P279=Q16917)'))
+    # Two documents are subclasses of hospital
+    assert planned.limit == 2
+    assert estimate.cost() == 2
+    assert estimate.children[0].hits == 2
+
+
+def test_budget(executor):
+    with pytest.raises(CostExceeded) as e:
+        CostEstimator(executor, budget=10)(parse('(apply P127= (apply P31= P17=Q30))'))
+    assert e.value.estimate.cost() > 10
+
+
+def test_counts_are_cached(executor):
+    estimator = CostEstimator(executor, cache=LRUCache())
+    estimator(parse('(apply P31= P279=Q16917)'))
+    counts = len(executor.counts)
+    estimator(parse('(apply P31= P279=Q16917)'))
+    assert len(executor.counts) == counts
+
+
+def test_count_cache_is_per_index(elastic, executor):
+    cache = LRUCache()
+    CostEstimator(executor, cache=cache)(parse('P180=Q5'))
+    routed = CountingExecutor(
+        elastic, executor.qb, 'wikidatawiki_content', routes={'P180': 'commonswiki_file'})
+    routed.counts = []
+    CostEstimator(routed, cache=cache)(parse('P180=Q5'))
+    assert [index for index, _ in routed.counts] == ['commonswiki_file']
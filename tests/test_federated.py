@@ -0,0 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from unicorn import parser, sexpr
+from unicorn.federated import Backend, FederatedQueryExecutor
+from unicorn.qb import CIRRUS_FIELDS, BasicQueryBuilder
+from unicorn.qe import BasicQueryExecutor
+
+
+def parse(expression):
+    return parser.parse(sexpr.parse(expression))
+
+
+@pytest.fixture
+def backends(docs, elastic_factory):
+    qb = BasicQueryBuilder(**dict(CIRRUS_FIELDS, sort=[CIRRUS_FIELDS['sort'], {'title.keyword': 'asc'}]))
+    # Documents split between two wikis
+    return [
+        Backend(name, BasicQueryExecutor(elastic_factory(docs[i::2]), qb, 'wikidatawiki_content'))
+        for i, name in enumerate(['even', 'odd'])]
+
+
+def test_merges_hits_by_sort(docs, elastic_factory, backends):
+    sort = backends[0].executor.qb.sort
+    expected = BasicQueryExecutor(elastic_factory(docs), backends[0].executor.qb, 'wikidatawiki_content')(
+        parse('P17=Q30'), sort, size=20)
+    with FederatedQueryExecutor(backends) as executor:
+        result = executor(parse('P17=Q30'), sort, size=20)
+    assert result.ids == expected.ids
+    assert result.total_hits == expected.total_hits
+    assert {hit.backend for hit in result.hits} == {'even', 'odd'}
+
+
+def test_reports_cover_each_query(backends):
+    sort = backends[0].executor.qb.sort
+    with FederatedQueryExecutor(backends) as executor:
+        executor(parse('P17=Q30'), sort, size=5)
+        first = [report.truncated for report in executor.reports]
+        executor(parse('P17=Q30'), sort, size=5)
+        assert len(executor.reports) == 2
+        assert [report.truncated for report in executor.reports] == first == [29, 25]
+        # Counters of the executor still cover all queries
+        assert executor.truncated == 2 * (54 + 5)
+
+
+def test_close_shuts_down_owned_pool(backends):
+    with FederatedQueryExecutor(backends) as executor:
+        pass
+    with pytest.raises(RuntimeError):
+        executor.pool.submit(print)
+
+    pool = ThreadPoolExecutor(2)
+    FederatedQueryExecutor(backends, pool).close()
+    assert pool.submit(lambda: 1).result() == 1
+    pool.shutdown()
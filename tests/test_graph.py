@@ -0,0 +1,60 @@
+import pytest
+
+from unicorn import parser, sexpr
+from unicorn.graph import GraphIndex, GraphQueryExecutor
+from unicorn.qb import CIRRUS_FIELDS, BasicQueryBuilder
+from unicorn.qe import BasicQueryExecutor
+
+
+EXPRESSIONS = [
+    'P31=Q5',
+    'P31',
+    '(or P31=Q16917 P31=Q1774898)',
+    '(and P31=Q16917 P17=Q30)',
+    '(difference P31=Q16917 P127=Q1000)',
+    '(not P31=Q5)',
+    '(apply P31= P279=Q16917)',
+    '(extract P127= P31=Q5)',
+    '(closure P279= Q16917)',
+    '(apply P31= (closure P279= Q16917))',
+    '(or (apply P31= P279=Q16917) (extract P127= P31=Q5) (apply P31= (apply P279= P279=Q16917)))',
+]
+
+
+def parse(expression):
+    return parser.parse(sexpr.parse(expression))
+
+
+@pytest.fixture
+def graph(docs):
+    return GraphIndex.from_docs(doc['_source'] for doc in docs)
+
+
+@pytest.mark.parametrize('inner_limit', [900, 5])
+@pytest.mark.parametrize('expression', EXPRESSIONS)
+def test_same_as_elasticsearch(elastic, graph, expression, inner_limit):
+    # The graph orders hits tied on sitelink_count by title
+    qb = BasicQueryBuilder(**dict(
+        CIRRUS_FIELDS, sort=[CIRRUS_FIELDS['sort'], {'title.keyword': 'asc'}], inner_limit=inner_limit))
+    executor = BasicQueryExecutor(elastic, qb, 'wikidatawiki_content')
+    graph_executor = GraphQueryExecutor(graph, inner_limit=inner_limit)
+    node = parse(expression)
+
+    expected = executor(node, qb.sort, size=20, source=['title'])
+    result = graph_executor(node, CIRRUS_FIELDS['sort'], size=20, source=['title'])
+    assert result.ids == expected.ids
+    assert result.total_hits == expected.total_hits
+    assert graph_executor.truncated == executor.truncated
+
+
+def test_source(graph):
+    executor = GraphQueryExecutor(graph)
+    result = executor(parse('P279=Q64578911'), CIRRUS_FIELDS['sort'], source=['title', 'labels.en'])
+    hit, = result.hits
+    assert hit.id == 'Q5'
+    assert hit.label('en') == 'label Q5'
+
+
+def test_unsupported_sort(graph):
+    with pytest.raises(NotImplementedError):
+        GraphQueryExecutor(graph)(parse('P31=Q5'), {'title.keyword': 'asc'})
@@ -0,0 +1,70 @@
+import asyncio
+
+from elasticsearch import ConnectionTimeout
+import pytest
+
+from unicorn.labels import LabelService
+
+
+class FailingElasticsearch:
+    def __init__(self, error):
+        self.error = error
+        self.requests = 0
+
+    def search(self, index=None, body=None, **kwargs):
+        self.requests += 1
+        raise self.error
+
+
+class AsyncElasticsearch:
+    def __init__(self, client):
+        self.client = client
+
+    async def search(self, index=None, body=None, **kwargs):
+        return self.client.search(index=index, body=body, **kwargs)
+
+
+def test_labels(elastic):
+    service = LabelService(elastic, 'wikidatawiki_content')
+    assert service.labels(['Q5', 'Q16917', 'Q404'], 'en') == {
+        'Q5': 'label Q5', 'Q16917': 'label Q16917', 'Q404': ''}
+    # Served from the cache, including the known missing label
+    assert service.labels(['Q5', 'Q404'], 'en') == {'Q5': 'label Q5', 'Q404': ''}
+    assert len(elastic.requests) == 1
+
+
+def test_fallback(elastic):
+    service = LabelService(elastic, 'wikidatawiki_content', fallbacks={'de-ch': ['de']})
+    assert service.chain('de-ch') == ['de-ch', 'de', 'en']
+    assert service.labels(['Q5'], 'de-ch') == {'Q5': 'label Q5'}
+
+
+@pytest.mark.parametrize('timeout_ms', [0, -1])
+def test_no_time_remaining(elastic, timeout_ms):
+    service = LabelService(elastic, 'wikidatawiki_content')
+    service.labels(['Q5'], 'en')
+    assert service.labels(['Q5', 'Q16917'], 'en', timeout_ms) == {'Q5': 'label Q5', 'Q16917': ''}
+    assert len(elastic.requests) == 1
+
+
+def test_failed_lookup_returns_cached(elastic):
+    service = LabelService(elastic, 'wikidatawiki_content')
+    service.labels(['Q5'], 'en')
+    service.client = FailingElasticsearch(ConnectionTimeout('TIMEOUT', 'Read timed out', None))
+    assert service.labels(['Q5', 'Q16917'], 'en', 100) == {'Q5': 'label Q5', 'Q16917': ''}
+    assert service.client.requests == 1
+    # Failures are not cached as missing labels
+    service.client = elastic
+    assert service.labels(['Q16917'], 'en') == {'Q16917': 'label Q16917'}
+
+
+def test_async_labels(elastic):
+    pytest.importorskip('aiohttp')
+    service = LabelService(AsyncElasticsearch(elastic), 'wikidatawiki_content')
+    assert asyncio.run(service.async_labels(['Q5', 'Q404'], 'en')) == {'Q5': 'label Q5', 'Q404': ''}
+
+
+def test_async_failed_lookup(elastic):
+    pytest.importorskip('aiohttp')
+    service = LabelService(AsyncElasticsearch(FailingElasticsearch(asyncio.TimeoutError())), 'wikidatawiki_content')
+    assert asyncio.run(service.async_labels(['Q5'], 'en', 100)) == {'Q5': ''}
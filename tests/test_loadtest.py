@@ -0,0 +1,82 @@
+import pytest
+
+from unicorn.loadtest import (
+    SearchClient, StubElasticsearch, histogram, load_log, percentiles, run_closed, run_open, summarize)
+
+
+def test_percentiles():
+    stats = percentiles([float(n) for n in range(100, 0, -1)])
+    assert (stats['p50'], stats['p95'], stats['p99'], stats['max']) == (50., 95., 99., 100.)
+    assert stats['mean'] == 50.5
+    assert percentiles([7.]) == {'p50': 7., 'p95': 7., 'p99': 7., 'max': 7., 'mean': 7.}
+    assert percentiles([]) == {}
+
+
+def test_histogram():
+    assert histogram([0.5, 1., 1.5, 3., 9.]) == [(1., 2), (2., 1), (4., 1), (8., 0), (16., 1)]
+    assert histogram([]) == []
+
+
+def test_load_log(tmp_path):
+    log = tmp_path / 'queries.log'
+    log.write_text(
+        '# hospitals\n'
+        'P31=Q16917\n'
+        '{"q": "P31=Q5", "lang": "de"}\n'
+        '\n'
+        '(apply P31=\n'
+        '    P279=Q16917)\n')
+    assert load_log(str(log)) == [
+        {'q': 'P31=Q16917'},
+        {'q': 'P31=Q5', 'lang': 'de'},
+        {'q': '(apply P31=\n    P279=Q16917)'},
+    ]
+
+
+def test_load_empty_log(tmp_path):
+    log = tmp_path / 'queries.log'
+    log.write_text('# nothing\n')
+    with pytest.raises(ValueError):
+        load_log(str(log))
+
+
+def test_stub_looks_up_ids():
+    stub = StubElasticsearch(latency_ms=0., hits=50)
+    response = stub.search(index='wikidatawiki_content', body={'query': {'terms': {'title.keyword': ['Q7', 'Q8']}}})
+    assert response['hits']['total'] == 2
+    assert [hit['_id'] for hit in response['hits']['hits']] == ['Q7', 'Q8']
+    response = stub.search(index='wikidatawiki_content', body={'query': {'match_all': {}}, 'size': 10})
+    assert response['hits']['total'] == 50
+    assert len(response['hits']['hits']) == 10
+
+
+@pytest.fixture
+def stub_url(monkeypatch):
+    pytest.importorskip('hug')
+    from unicorn import loadtest, web
+    # serve_stub replaces the elasticsearch client of unicorn.web
+    monkeypatch.setattr(web, 'elastic', web.elastic)
+    monkeypatch.setattr(web.label_service, 'client', web.label_service.client)
+    monkeypatch.setattr(web, 'stage_cache', web.LRUCache())
+    return loadtest.serve_stub(latency_ms=1., hits=100)
+
+
+QUERIES = [{'q': 'P31=Q5', 'size': 10}, {'q': '(apply P31= P279=Q16917)', 'size': 10}, {'q': '(foo P31=Q5)'}]
+
+
+def test_run_closed(stub_url):
+    samples = run_closed(SearchClient(stub_url), QUERIES, concurrency=2, requests=6)
+    report = summarize(samples, 1.)
+    assert report['requests'] == 6
+    # Invalid expressions are rejected by the server
+    assert report['errors'] == 2
+    assert list(report['error_messages']) == ['RuntimeError: /search responded with status 400']
+    assert report['latency_ms']['max'] >= 1.
+    assert sum(n for _, n in report['histogram']) == 4
+    assert report['debug']['es_took_ms']
+
+
+def test_run_open(stub_url):
+    samples = run_open(SearchClient(stub_url), QUERIES[:2], rate=100., requests=5, max_in_flight=2)
+    assert len(samples) == 5
+    assert all(sample.error is None for sample in samples)
@@ -0,0 +1,65 @@
+import pytest
+
+from unicorn import parser, sexpr
+from unicorn.model import BoolNode, ClosureNode, NoneNode, TermNode, TermsNode, canonical
+from unicorn.optimizer import optimize
+from unicorn.qb import CIRRUS_FIELDS, BasicQueryBuilder
+from unicorn.qe import BasicQueryExecutor
+
+
+def parse(expression):
+    return parser.parse(sexpr.parse(expression))
+
+
+@pytest.mark.parametrize('expression,expected', [
+    # Nested ands are flattened
+    ('(and (and P31=Q5 P17=Q30) P127=Q1000)',
+     BoolNode(must=[TermNode('P31=Q5'), TermNode('P17=Q30'), TermNode('P127=Q1000')])),
+    # Single child bools are unwrapped
+    ('(and P31=Q5)', TermNode('P31=Q5')),
+    # Edge terms of an or are merged into one terms lookup, without duplicates
+    ('(or P31=Q5 P31=Q16917)', TermsNode(['P31=Q5', 'P31=Q16917'])),
+    ('(or P31=Q5 (or P31=Q16917 P31=Q5))', TermsNode(['P31=Q5', 'P31=Q16917'])),
+    ('(not P31=Q5 P31=Q16917)', BoolNode(must_not=[TermsNode(['P31=Q5', 'P31=Q16917'])])),
+    # a and not a
+    ('(and P31=Q5 (not P31=Q5))', NoneNode()),
+    # Stages over impossible queries are never executed
+    ('(apply P31= (and P31=Q5 (not P31=Q5)))', NoneNode()),
+    ('(extract P127= (and P31=Q5 (not P31=Q5)))', NoneNode()),
+    ('(or (and P31=Q5 (not P31=Q5)) P17=Q30)', TermNode('P17=Q30')),
+    # Filters shared by every branch of an or are hoisted
+    ('(or (and P17=Q30 P31=Q5) (and P17=Q30 P127=Q1000))',
+     BoolNode(must=[TermNode('P17=Q30'), TermsNode(['P31=Q5', 'P127=Q1000'])])),
+    ('(or P17=Q30 (and P17=Q30 P31=Q5))', TermNode('P17=Q30')),
+    ('(closure P279= Q5 Q5 Q16917)', ClosureNode('P279=', ['Q5', 'Q16917'])),
+])
+def test_rewrites(expression, expected):
+    assert canonical(optimize(parse(expression))) == canonical(expected)
+
+
+@pytest.mark.parametrize('expression', [
+    'P31=Q5',
+    '(apply P31= P279=Q16917)',
+    '(difference P31=Q16917 P127=Q1000)',
+])
+def test_optimal_is_unchanged(expression):
+    node = parse(expression)
+    assert canonical(optimize(node)) == canonical(node)
+
+
+@pytest.mark.parametrize('expression', [
+    '(and (and P31=Q16917 P17=Q30) (not P127=Q1000))',
+    '(or P31=Q16917 P31=Q1774898 P31=Q16917)',
+    '(or (and P17=Q30 P31=Q5) (and P17=Q30 P127=Q1001))',
+    '(or P17=Q30 (and P17=Q30 P31=Q5))',
+    '(not P31=Q5 P31=Q16917)',
+    '(extract P127= (or P31=Q16917 (apply P31= P279=Q16917)))',
+])
+def test_same_hits(elastic, expression):
+    qb = BasicQueryBuilder(**CIRRUS_FIELDS)
+    executor = BasicQueryExecutor(elastic, qb, 'wikidatawiki_content')
+    node = parse(expression)
+    expected = executor(node, qb.sort, size=100)
+    result = executor(optimize(node), qb.sort, size=100)
+    assert result.ids == expected.ids
+    assert result.total_hits == expected.total_hits
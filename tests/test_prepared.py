@@ -0,0 +1,54 @@
+import pytest
+
+from unicorn import parser, prepared, sexpr
+from unicorn.cache import LRUCache
+
+
+@pytest.fixture(autouse=True)
+def plans(monkeypatch):
+    plans = LRUCache(max_entries=10, ttl_s=float('inf'))
+    monkeypatch.setattr(prepared, 'plans', plans)
+    return plans
+
+
+def parse(expression):
+    return parser.parse(sexpr.parse(expression))
+
+
+def test_bind_substitutes_placeholders():
+    query = prepared.prepare('(or P31=$1 (apply P31= P279=$2) (closure P279= $2))', ['Q5', 'Q16917'], optimize=False)
+    assert query == parse('(or P31=Q5 (apply P31= P279=Q16917) (closure P279= Q16917))')
+
+
+def test_placeholder_within_value():
+    query = prepared.prepare('(extract P$1= P31=Q5)', ['127'], optimize=False)
+    assert query == parse('(extract P127= P31=Q5)')
+
+
+def test_missing_param():
+    with pytest.raises(parser.ParseError):
+        prepared.prepare('(and P31=$1 P17=$2)', ['Q5'])
+
+
+def test_extra_params_are_ignored():
+    # A batch shares its params between all expressions
+    assert prepared.prepare('(and P31=$1 P17=Q30)', ['Q5', 'Q6']) == prepared.prepare('(and P31=Q5 P17=Q30)')
+    assert prepared.prepare('P31=Q5', ['Q6']) == parse('P31=Q5')
+
+
+def test_plan_shared_between_params(monkeypatch):
+    compiled = []
+    parse_expression = sexpr.parse
+
+    def counting_parse(expression):
+        compiled.append(expression)
+        return parse_expression(expression)
+
+    monkeypatch.setattr(prepared.sexpr, 'parse', counting_parse)
+    first = prepared.prepare('(apply P31= P279=$1)', ['Q16917'])
+    second = prepared.prepare('(apply  P31=\n    P279=$1)', ['Q5'])
+    assert compiled == ['(apply P31= P279=$1)']
+    assert first == parse('(apply P31= P279=Q16917)')
+    assert second == parse('(apply P31= P279=Q5)')
+    # The shared plan keeps its placeholders
+    assert prepared.compile_plan('(apply P31= P279=$1)') == parse('(apply P31= P279=$1)')
@@ -0,0 +1,48 @@
+import pytest
+
+from unicorn import parser, sexpr
+from unicorn.qb import CIRRUS_FIELDS, BasicQueryBuilder
+from unicorn.qe import BasicQueryExecutor
+
+
+def parse(expression):
+    return parser.parse(sexpr.parse(expression))
+
+
+def test_bool_evaluated_locally(elastic):
+    qb = BasicQueryBuilder(**CIRRUS_FIELDS, local_threshold=5)
+    executor = BasicQueryExecutor(elastic, qb, 'wikidatawiki_content')
+    query = parse('(or P17=Q31 (closure P279= Q16917))')
+    built = executor.build(query)
+    assert built.hit_ids is not None
+    assert sorted(built.hit_ids.titles()) == ['Q1001', 'Q1003', 'Q1005', 'Q16917', 'Q1774898', 'Q5', 'Q64578911']
+    assert executor.truncated == 0
+
+
+def test_bool_too_large_to_evaluate_locally(elastic):
+    query = parse('(or P17=Q30 (closure P279= Q16917))')
+    expected = BasicQueryExecutor(elastic, BasicQueryBuilder(**CIRRUS_FIELDS), 'wikidatawiki_content')(
+        query, CIRRUS_FIELDS['sort'], size=100)
+    qb = BasicQueryBuilder(**CIRRUS_FIELDS, local_threshold=5)
+    executor = BasicQueryExecutor(elastic, qb, 'wikidatawiki_content')
+    assert executor.build(query).hit_ids is None
+    executor.clear_counters()
+    result = executor(query, qb.sort, size=100)
+    assert result.ids == expected.ids
+    assert result.num_hits == 68
+    # Only the count of the large clause ran, nothing was truncated
+    assert executor.truncated == 0
+
+
+@pytest.mark.parametrize('inner_limit,expected_truncated', [(900, 0), (3, 33)])
+def test_aggregated_extract_reports_dropped_targets(elastic, inner_limit, expected_truncated):
+    query = parse('(extract P127= P17=Q30)')
+    source_qb = BasicQueryBuilder(**CIRRUS_FIELDS)
+    expected = BasicQueryExecutor(elastic, source_qb, 'wikidatawiki_content').build(query)
+    qb = BasicQueryBuilder(**CIRRUS_FIELDS, inner_limit=inner_limit, extract_strategy='aggregation')
+    executor = BasicQueryExecutor(elastic, qb, 'wikidatawiki_content')
+    built = executor.build(query)
+    assert len(built.hit_ids) == min(inner_limit, 7)
+    assert set(built.hit_ids.titles()) <= set(expected.hit_ids.titles())
+    # Each of the targets left out is shared by several inner hits
+    assert executor.truncated == expected_truncated
@@ -0,0 +1,131 @@
+import asyncio
+
+import pytest
+
+from unicorn import parser, sexpr
+from unicorn.qb import CIRRUS_FIELDS, BasicQueryBuilder
+from unicorn.qe import AsyncQueryExecutor, BasicQueryExecutor, DeadlineExceeded, MultiSearchQueryExecutor
+from unicorn.topk import TopK
+
+
+def parse(expression):
+    return parser.parse(sexpr.parse(expression))
+
+
+class AsyncFakeElasticsearch:
+    """Async client whose requests time out on the client side"""
+    def __init__(self, client):
+        self.client = client
+
+    async def search(self, index=None, body=None, **kwargs):
+        return self.client.search(index=index, body=body, **kwargs)
+
+    async def msearch(self, body, index=None, **kwargs):
+        return self.client.msearch(body, index=index, **kwargs)
+
+
+@pytest.mark.parametrize('executor_class', [BasicQueryExecutor, MultiSearchQueryExecutor])
+def test_execute(elastic, executor_class):
+    qb = BasicQueryBuilder(**CIRRUS_FIELDS)
+    executor = executor_class(elastic, qb, 'wikidatawiki_content', timeout_ms=1000)
+    result = executor(parse('(apply P31= P279=Q16917)'), qb.sort, size=100, source=['title'])
+    assert result.total_hits == 30
+    assert not executor.timed_out
+
+
+@pytest.mark.parametrize('executor_class', [BasicQueryExecutor, MultiSearchQueryExecutor])
+def test_client_timeout_exceeds_deadline(elastic_factory, executor_class):
+    qb = BasicQueryBuilder(**CIRRUS_FIELDS)
+    executor = executor_class(elastic_factory(latency_s=1.), qb, 'wikidatawiki_content', timeout_ms=50)
+    with pytest.raises(DeadlineExceeded):
+        executor(parse('(apply P31= P279=Q16917)'), qb.sort, size=10)
+    assert executor.timed_out
+
+
+def test_async_client_timeout_exceeds_deadline(elastic_factory):
+    qb = BasicQueryBuilder(**CIRRUS_FIELDS)
+    client = AsyncFakeElasticsearch(elastic_factory(latency_s=1.))
+    executor = AsyncQueryExecutor(client, qb, 'wikidatawiki_content', timeout_ms=50)
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(executor.execute(parse('(apply P31= P279=Q16917)'), qb.sort, size=10))
+    assert executor.timed_out
+
+
+def test_async_execute(elastic):
+    qb = BasicQueryBuilder(**CIRRUS_FIELDS)
+    executor = AsyncQueryExecutor(AsyncFakeElasticsearch(elastic), qb, 'wikidatawiki_content')
+    result = asyncio.run(executor.execute(parse('(apply P31= P279=Q16917)'), qb.sort, size=100, source=['title']))
+    assert result.total_hits == 30
+    assert executor.took_ms > 0
+    # Only the async entry points are available
+    assert not callable(executor)
+    for name in ('pages', 'build', 'count', 'stream'):
+        assert not hasattr(executor, name)
+
+
+def test_async_top_k_matches_sync(elastic):
+    qb = BasicQueryBuilder(**CIRRUS_FIELDS)
+    query = parse('(apply P31= P279=Q16917)')
+    executor = BasicQueryExecutor(elastic, qb, 'wikidatawiki_content')
+    expected, expected_deepening = TopK(initial_limit=1, growth=2)(executor, query, qb.sort, 10, ['title'])
+    async_executor = AsyncQueryExecutor(AsyncFakeElasticsearch(elastic), qb, 'wikidatawiki_content')
+    result, deepening = asyncio.run(
+        TopK(initial_limit=1, growth=2).execute(async_executor, query, qb.sort, 10, ['title']))
+    assert result.ids == expected.ids
+    assert deepening == expected_deepening
+    assert async_executor.truncated == executor.truncated
+
+
+def test_paging_requires_tiebreak(elastic):
+    qb = BasicQueryBuilder(**CIRRUS_FIELDS)
+    with pytest.raises(ValueError):
+        BasicQueryExecutor(elastic, qb, 'wikidatawiki_content', page_size=7)
+
+
+def test_paging_keeps_tied_hits(elastic):
+    qb = BasicQueryBuilder(**CIRRUS_FIELDS)
+    tiebreak = {'title.keyword': 'asc'}
+    paged = BasicQueryExecutor(elastic, qb, 'wikidatawiki_content', page_size=7, tiebreak=tiebreak)
+    unpaged = BasicQueryExecutor(elastic, qb, 'wikidatawiki_content', tiebreak=tiebreak)
+    # Many hits share a sitelink_count, and pages end between them
+    expected = unpaged(parse('P17=Q30'), [qb.sort, tiebreak], size=100)
+    result = paged(parse('P17=Q30'), qb.sort, size=100)
+    assert len(elastic.requests) > 2
+    assert result.num_hits == 64
+    assert result.ids == expected.ids
+
+
+def test_paging_keeps_pages_fetched_before_deadline(elastic, monkeypatch):
+    qb = BasicQueryBuilder(**CIRRUS_FIELDS)
+    executor = BasicQueryExecutor(
+        elastic, qb, 'wikidatawiki_content', page_size=7, tiebreak={'title.keyword': 'asc'}, timeout_ms=200)
+    response = elastic.response
+
+    def slow_after_first_page(body):
+        elastic.latency_ms = 1000.
+        return response(body)
+
+    monkeypatch.setattr(elastic, 'response', slow_after_first_page)
+    result = executor(parse('P17=Q30'), qb.sort, size=100)
+    assert result.num_hits == 7
+    assert result.total_hits == 64
+    assert executor.timed_out
+    assert executor.truncated == 57
+
+
+def test_stream_traces_its_pages(elastic):
+    qb = BasicQueryBuilder(**CIRRUS_FIELDS)
+    executor = BasicQueryExecutor(
+        elastic, qb, 'wikidatawiki_content', page_size=7, tiebreak={'title.keyword': 'asc'})
+    query = executor.build(parse('P17=Q30'))
+    pages = []
+    for page in executor.stream(query, qb.sort, size=20):
+        # The span of the stream stays open while its pages are fetched
+        assert executor.tracer.current() is executor.tracer.last()
+        pages.append(page)
+    trace = executor.tracer.last()
+    assert executor.tracer.current() is executor.tracer.root
+    assert len(pages) == 3
+    assert trace.requests == 3
+    assert trace.hits == 20
+    assert trace.truncated == 44
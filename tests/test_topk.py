@@ -0,0 +1,79 @@
+import pytest
+
+from unicorn import parser, sexpr
+from unicorn.qb import CIRRUS_FIELDS, BasicQueryBuilder
+from unicorn.qe import BasicQueryExecutor
+from unicorn.topk import TopK
+
+
+def parse(expression):
+    return parser.parse(sexpr.parse(expression))
+
+
+def doc(title, sitelink_count, edges):
+    return {'_id': title, '_source': {'title': title, 'sitelink_count': sitelink_count, 'statement_keywords': edges}}
+
+
+@pytest.fixture
+def hub_elastic(elastic_factory):
+    """Many members, each part of every one of a few hubs"""
+    members = [doc('Q{}'.format(i), i, ['P31=Q1']) for i in range(100, 150)]
+    hubs = [
+        doc('Q{}'.format(i), i, ['P361=' + member['_id'] for member in members])
+        for i in range(10, 15)
+    ]
+    return elastic_factory(docs=members + hubs)
+
+
+def test_limits():
+    assert TopK(100, 4).limits(900) == [100, 400, 900]
+    assert TopK(100, 4).limits(400) == [100, 400]
+    assert TopK(1000, 4).limits(900) == [900]
+
+
+@pytest.mark.parametrize('initial_limit,growth', [(0, 4), (10, 1)])
+def test_invalid_arguments(initial_limit, growth):
+    with pytest.raises(ValueError):
+        TopK(initial_limit, growth)
+
+
+def test_exact_once_nothing_truncated(elastic):
+    qb = BasicQueryBuilder(**CIRRUS_FIELDS)
+    executor = BasicQueryExecutor(elastic, qb, 'wikidatawiki_content')
+    query = parse('(apply P31= P279=Q16917)')
+    result, deepening = TopK(initial_limit=1, growth=2)(executor, query, qb.sort, 10, ['title'])
+    assert deepening.limits == [1, 2]
+    assert deepening.exact
+    assert deepening.inner_truncated == 0
+
+    full = BasicQueryExecutor(elastic, qb, 'wikidatawiki_content')(query, qb.sort, 10, ['title'])
+    assert result.ids == full.ids
+    assert result.total_hits == full.total_hits
+    # Rounds build with copies of the executor, its builder is unchanged
+    assert executor.qb is qb
+
+
+def test_stable_top_hits_stop_early(hub_elastic):
+    qb = BasicQueryBuilder(**CIRRUS_FIELDS)
+    executor = BasicQueryExecutor(hub_elastic, qb, 'wikidatawiki_content')
+    result, deepening = TopK(initial_limit=1, growth=2)(executor, parse('(apply P361= P31=Q1)'), qb.sort, 5)
+    assert deepening.limits == [1, 2]
+    assert deepening.stable
+    assert not deepening.exact
+    assert result.ids == ('Q14', 'Q13', 'Q12', 'Q11', 'Q10')
+    # Truncation of the final round only, not summed over rounds
+    assert deepening.inner_truncated == 48
+
+
+def test_unstable_until_exact(elastic_factory):
+    # Each member is part of its own hub, every round matches more hubs
+    members = [doc('Q{}'.format(i), i, ['P31=Q1']) for i in range(100, 150)]
+    hubs = [doc('Q{}'.format(i + 100), i, ['P361=Q{}'.format(i)]) for i in range(100, 150)]
+    qb = BasicQueryBuilder(**CIRRUS_FIELDS)
+    executor = BasicQueryExecutor(elastic_factory(docs=members + hubs), qb, 'wikidatawiki_content')
+    result, deepening = TopK(initial_limit=1, growth=2)(executor, parse('(apply P361= P31=Q1)'), qb.sort, 5)
+    assert deepening.limits == [1, 2, 4, 8, 16, 32, 64]
+    assert deepening.exact
+    assert not deepening.stable
+    assert deepening.inner_truncated == 0
+    assert result.total_hits == 50
@@ -0,0 +1,45 @@
+import pytest
+
+from unicorn import parser, sexpr
+from unicorn.qb import CIRRUS_FIELDS, BasicQueryBuilder
+from unicorn.qe import BasicQueryExecutor, MultiSearchQueryExecutor
+from unicorn.transport import SEARCH_FILTER_PATH, TransportProfile, lean
+
+
+def parse(expression):
+    return parser.parse(sexpr.parse(expression))
+
+
+def test_lean_request_reads_titles_from_doc_values():
+    transport = lean(id_field='title.raw')
+    request = transport.request({'query': {'match_all': {}}, '_source': ['title', 'labels.en']})
+    assert request['_source'] == ['labels.en']
+    assert request['docvalue_fields'] == ['title.raw']
+    assert transport.search_args() == {'filter_path': SEARCH_FILTER_PATH}
+
+
+def test_default_request_is_unchanged():
+    transport = TransportProfile()
+    request = {'query': {'match_all': {}}, '_source': ['title']}
+    assert transport.request(dict(request)) == request
+    assert transport.search_args() == {}
+    assert transport.id_field() == 'title.keyword'
+
+
+def test_unknown_json_library():
+    with pytest.raises(ValueError):
+        TransportProfile(json_library='yaml')
+
+
+@pytest.mark.parametrize('executor_class', [BasicQueryExecutor, MultiSearchQueryExecutor])
+@pytest.mark.parametrize('id_field', ['title.keyword', 'title.raw'])
+def test_lean_executor(elastic, executor_class, id_field):
+    qb = BasicQueryBuilder(**CIRRUS_FIELDS)
+    query = parse('(apply P31= P279=Q16917)')
+    expected = BasicQueryExecutor(elastic, qb, 'wikidatawiki_content')(query, qb.sort, size=100, source=['title'])
+    executor = executor_class(elastic, qb, 'wikidatawiki_content', transport=lean(id_field=id_field))
+    result = executor(query, qb.sort, size=100, source=['title'])
+    assert elastic.requests[-1]['docvalue_fields'] == [id_field]
+    assert 'fields' in result.es_hits[0]
+    assert result.ids == expected.ids
+    assert [hit.id for hit in result.hits] == list(expected.ids)
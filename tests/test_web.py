@@ -0,0 +1,95 @@
+import json
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+hug = pytest.importorskip('hug')
+from unicorn import web  # noqa: E402
+
+
+@pytest.fixture
+def api(monkeypatch, elastic):
+    monkeypatch.setattr(web, 'elastic', elastic)
+    monkeypatch.setattr(web.label_service, 'client', elastic)
+    monkeypatch.setattr(web, 'stage_cache', web.LRUCache())
+    monkeypatch.setitem(web.config['stream'], 'page_size', 7)
+    return web
+
+
+@pytest.mark.parametrize('search_after', [[12, 'Q100'], [None], []])
+def test_cursor_round_trip(search_after):
+    cursor = web.encode_cursor('plan', search_after, 42)
+    assert web.decode_cursor(cursor) == ('plan', search_after, 42)
+
+
+@pytest.mark.parametrize('cursor', ['', 'not a cursor', web.encode_cursor('plan', [], 0)[:-4]])
+def test_invalid_cursor(cursor):
+    with pytest.raises(ValueError):
+        web.decode_cursor(cursor)
+
+
+def stream(api, **params):
+    response = hug.test.get(api, '/search/stream', params, headers={'Accept': 'application/x-ndjson'})
+    return [line for line in response.data.split('\n') if line]
+
+
+def test_stream_continues_from_cursor(api):
+    expression = '(apply P31= P279=$1)'
+    first = [json.loads(line) for line in stream(api, q=expression, params='Q16917', size=10)]
+    cursor = first[-1]['cursor']
+    assert len(first) == 11 and first[-1]['total_hits'] == 30
+    rest = [json.loads(line) for line in stream(api, q=expression, params='Q16917', size=100, cursor=cursor)]
+    assert rest[-1]['cursor'] is None
+    ids = [line['id'] for line in first[:-1] + rest[:-1]]
+    assert len(ids) == len(set(ids)) == 30
+
+
+def test_stream_html_next_link(api):
+    response = hug.test.get(
+        api, '/search/stream', {'q': '(apply P31= P279=$1)', 'params': 'Q16917', 'size': 10, 'lang': 'de'},
+        headers={'Accept': 'text/html'})
+    html = response.data
+    href = html[html.index('href="/search/stream?') + len('href="'):]
+    href = href[:href.index('"')].replace('&amp;', '&')
+    args = parse_qs(urlparse(href).query)
+    assert args['q'] == ['(apply P31= P279=$1)']
+    assert args['params'] == ['Q16917']
+    assert args['size'] == ['10']
+    assert args['lang'] == ['de']
+    assert args['cursor']
+
+
+@pytest.mark.parametrize('top_k_config,expected_limits', [
+    ({'enabled': False}, None),
+    ({'initial_limit': 10}, None),
+    ({'enabled': True, 'initial_limit': 10}, [10, 40, 160, 640, 900]),
+])
+def test_make_top_k(monkeypatch, top_k_config, expected_limits):
+    monkeypatch.setitem(web.config, 'top_k', top_k_config)
+    top_k = web.make_top_k()
+    if expected_limits is None:
+        assert top_k is None
+    else:
+        assert top_k.limits(900) == expected_limits
+
+
+def test_make_stage_cache_without_path(monkeypatch):
+    monkeypatch.setitem(web.config, 'persistent_stage_cache', {'max_entries': 10})
+    assert isinstance(web.make_stage_cache(), web.LRUCache)
+
+
+@pytest.mark.parametrize('params', [
+    {'q': '(apply P31= P279=$1)'},
+    {'q': '(foo P31=Q5)'},
+])
+def test_search_bad_request(api, params):
+    response = hug.test.get(api, '/search', params, headers={'Accept': 'application/json'})
+    assert response.status == hug.HTTP_400
+    assert response.data['error']
+
+
+def test_search_binds_params(api):
+    response = hug.test.get(
+        api, '/search', {'q': '(apply P31= P279=$1)', 'params': 'Q16917'}, headers={'Accept': 'application/json'})
+    assert response.status == hug.HTTP_200
+    assert response.data['total_hits'] == 30
@@ -1,12 +1,21 @@
 from argparse import ArgumentParser
-from elasticsearch import Elasticsearch
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
 from textwrap import dedent
 import sys
+from typing import IO, Any, Callable, Dict, Optional, Sequence, Tuple, Union
 
-from unicorn import parser, sexpr
-from unicorn.qe import BasicQueryExecutor
-from unicorn.qb import BasicQueryBuilder
+from unicorn import parser, prepared, sexpr
+from unicorn.batch import run_batch, split_expressions
+from unicorn.cache import LRUCache
+from unicorn.estimate import CostEstimator, CostExceeded
+from unicorn.federated import Backend, FederatedQueryExecutor, format_reports
+from unicorn.graph import GraphIndex, GraphQueryExecutor
+from unicorn.model import ElasticSort, Hit, QueryNode, Result
+from unicorn.qe import BasicQueryExecutor, ConcurrentQueryExecutor, DeadlineExceeded, MultiSearchQueryExecutor
+from unicorn.qb import CIRRUS_FIELDS, BasicQueryBuilder
+from unicorn.topk import Deepening, TopK
+from unicorn.transport import TransportProfile, lean as transport_lean
 from unicorn.utils import timer
 
 
@@ -14,80 +23,369 @@ def line_in(val: str) -> str:
     return sys.stdin.read() if val == '-' else val
 
 
+def open_path(path: str, mode: str) -> IO[str]:
+    """Open path, or stdin / stdout when path is -"""
+    if path == '-':
+        return open((sys.stdin if 'r' in mode else sys.stdout).fileno(), mode, closefd=False)
+    return open(path, mode)
+
+
 def arg_parser() -> ArgumentParser:
     parser = ArgumentParser()
     parser.add_argument('--dump-sexpr', action='store_true', default=False)
     parser.add_argument('--dump-parse', action='store_true', default=False)
+    parser.add_argument('--dump-plan', action='store_true', default=False)
+    parser.add_argument('--explain', action='store_true', default=False)
+    parser.add_argument('--no-optimize', dest='optimize', action='store_false', default=True)
     parser.add_argument('--elasticsearch', default=None)
+    parser.add_argument('--graph', default=None, help='Evaluate against a jsonl dump instead of elasticsearch')
     parser.add_argument('--index', default='wikidatawiki_content')
     parser.add_argument('--size', type=int, default=100)
     parser.add_argument('--report-lang', default='en')
-    parser.add_argument('expression', type=line_in)
+    parser.add_argument('--parallelism', type=int, default=1)
+    parser.add_argument('--msearch', action='store_true', default=False)
+    parser.add_argument('--inner-limit', type=int, default=900)
+    parser.add_argument('--local-threshold', type=int, default=None)
+    parser.add_argument('--closure-depth', type=int, default=10)
+    parser.add_argument('--extract-strategy', choices=['source', 'aggregation'], default='source')
+    parser.add_argument('--limit', type=int, default=10000)
+    parser.add_argument('--page-size', type=int, default=None)
+    parser.add_argument('--time-budget-ms', type=float, default=None)
+    parser.add_argument('--timeout-ms', type=float, default=None, help='Deadline of the full query')
+    parser.add_argument('--estimate', action='store_true', default=False,
+                        help='Limit stages to estimated inner sizes, required by --cost-budget')
+    parser.add_argument('--cost-budget', type=int, default=None, help='Max docs fetched by inner stages')
+    parser.add_argument('--cost-warn', action='store_true', default=False,
+                        help='Warn instead of failing when over --cost-budget')
+    parser.add_argument('--top-k', action='store_true', default=False,
+                        help='Deepen inner stages from --initial-limit only while the top --size hits change')
+    parser.add_argument('--initial-limit', type=int, default=100)
+    parser.add_argument('--lean', action='store_true', default=False,
+                        help='Filter responses, read ids from doc values and compress requests')
+    parser.add_argument('--json-library', choices=['json', 'orjson'], default='json')
+    parser.add_argument('--backend', action='append', default=[], metavar='NAME=[HOST/]INDEX',
+                        help='Run against each backend in parallel, merging the results')
+    parser.add_argument('--route', action='append', default=[], metavar='PROPERTY=INDEX',
+                        help='Search stages matching only PROPERTY edges in INDEX')
+    parser.add_argument('--param', action='append', default=[], help='Value of the next $n placeholder')
+    parser.add_argument('--batch', default=None, metavar='PATH',
+                        help='Run each expression of PATH, - for stdin, writing jsonl results')
+    parser.add_argument('--output', default='-', help='Where --batch writes results, - for stdout')
+    parser.add_argument('--concurrency', type=int, default=4, help='Queries of --batch run at once')
+    parser.add_argument('--cache-entries', type=int, default=10000,
+                        help='Stages of --batch cached for later queries, 0 disables')
+    parser.add_argument('expression', type=line_in, nargs='?', default=None)
     return parser
 
 
+Executor = Union[BasicQueryExecutor, GraphQueryExecutor, FederatedQueryExecutor]
+
+
+def make_executor(
+    qb: BasicQueryBuilder,
+    index: str,
+    elasticsearch: str,
+    graph: Optional[str],
+    msearch: bool,
+    parallelism: int,
+    transport: TransportProfile,
+    backend: Sequence[str],
+    **kwargs
+) -> Executor:
+    return executor_factory(qb, index, elasticsearch, graph, msearch, parallelism, transport, backend, **kwargs)()
+
+
+def executor_factory(
+    qb: BasicQueryBuilder,
+    index: str,
+    elasticsearch: str,
+    graph: Optional[str],
+    msearch: bool,
+    parallelism: int,
+    transport: TransportProfile,
+    backend: Sequence[str],
+    concurrency: int = 1,
+    cache_entries: int = 0,
+    **kwargs
+) -> Callable[[], Executor]:
+    """Creates executors sharing clients, thread pools and stage caches
+
+    concurrency is the number of executors in use at once. Stage caches
+    hold up to cache_entries stages, one per backend.
+    """
+    if graph is not None:
+        graph_index = GraphIndex.from_jsonl(graph)
+        return lambda: GraphQueryExecutor(
+            graph_index,
+            inner_limit=qb.inner_limit,
+            limit=kwargs['limit'],
+            closure_depth=qb.closure_depth)
+    if backend:
+        factories = []
+        for spec in backend:
+            name, _, location = spec.partition('=')
+            host, _, backend_index = location.rpartition('/')
+            factories.append((name, es_executor_factory(
+                qb, backend_index, host or elasticsearch, msearch, parallelism, transport,
+                cache_entries, **kwargs)))
+        pool = ThreadPoolExecutor(max_workers=len(factories) * concurrency)
+        return lambda: FederatedQueryExecutor([Backend(name, factory()) for name, factory in factories], pool)
+    return es_executor_factory(qb, index, elasticsearch, msearch, parallelism, transport, cache_entries, **kwargs)
+
+
+def es_executor_factory(
+    qb: BasicQueryBuilder,
+    index: str,
+    elasticsearch: str,
+    msearch: bool,
+    parallelism: int,
+    transport: TransportProfile,
+    cache_entries: int = 0,
+    **kwargs
+) -> Callable[[], BasicQueryExecutor]:
+    client = transport.client(elasticsearch)
+    # Stages don't change over the life of a process
+    cache = LRUCache(cache_entries, ttl_s=float('inf')) if cache_entries else None
+    if msearch:
+        return lambda: MultiSearchQueryExecutor(client, qb, index, cache=cache, transport=transport, **kwargs)
+    elif parallelism > 1:
+        pool = ThreadPoolExecutor(max_workers=parallelism)
+        return lambda: ConcurrentQueryExecutor(
+            client, qb, index, pool, cache=cache, transport=transport, **kwargs)
+    else:
+        return lambda: BasicQueryExecutor(client, qb, index, cache=cache, transport=transport, **kwargs)
+
+
+def evaluate(
+    executor: Executor,
+    query: QueryNode,
+    sort: ElasticSort,
+    size: int,
+    source: Sequence[str],
+    top_k: Optional[TopK],
+) -> Tuple[Result, Optional[Deepening]]:
+    """Result of query, with the rounds taken by top_k if provided"""
+    if top_k is None:
+        return executor(query, size=size, source=source, sort=sort), None
+    if not isinstance(executor, BasicQueryExecutor):
+        raise ValueError('--top-k is not supported with --graph or --backend')
+    return top_k(executor, query, sort, size, source)
+
+
+def query_totals(
+    executor: Executor,
+    result: Result,
+    took_ms: float,
+    deepening: Optional[Deepening] = None,
+) -> Dict[str, Any]:
+    """Counters of executor after running the query of result"""
+    if deepening is not None:
+        # Counters of the executor accumulate over all rounds
+        inner_truncated = deepening.inner_truncated
+    else:
+        inner_truncated = executor.truncated - result.truncated
+    return {
+        'returned': result.num_hits,
+        'total': result.total_hits,
+        'inner_truncated': inner_truncated,
+        'es_took_ms': executor.es_took_ms,
+        'net_took_ms': executor.took_ms - executor.es_took_ms,
+        'decode_ms': executor.decode_ms,
+        'response_bytes': executor.response_bytes,
+        'unicorn_took_ms': took_ms - executor.took_ms,
+        'total_took_ms': took_ms,
+        'timed_out': executor.timed_out,
+    }
+
+
+def hit_record(hit: Hit, lang: str) -> Dict[str, Any]:
+    record = {'id': hit.id, 'label': hit.label(lang, '')}
+    if hit.backend is not None:
+        record['backend'] = hit.backend
+    return record
+
+
 def run(
     expression: str,
     report_lang: str,
     size: int,
     index: str,
     elasticsearch: str,
+    graph: Optional[str],
     dump_parse: bool,
     dump_sexpr: bool,
+    dump_plan: bool,
+    explain: bool,
+    optimize: bool,
+    parallelism: int,
+    msearch: bool,
+    inner_limit: int,
+    local_threshold: Optional[int],
+    closure_depth: int,
+    extract_strategy: str,
+    limit: int,
+    page_size: Optional[int],
+    time_budget_ms: Optional[float],
+    timeout_ms: Optional[float],
+    estimate: bool,
+    cost_budget: Optional[int],
+    cost_warn: bool,
+    top_k: bool,
+    initial_limit: int,
+    lean: bool,
+    json_library: str,
+    backend: Sequence[str],
+    route: Sequence[str],
+    param: Sequence[str],
+    batch: Optional[str],
+    output: str,
+    concurrency: int,
+    cache_entries: int,
 ) -> int:
-    root_token = sexpr.parse(expression)
-    if dump_sexpr:
-        pprint(root_token)
+    if batch is not None:
+        if expression is not None or dump_sexpr or dump_parse or dump_plan or explain:
+            print('error: --batch takes no expression, and does not dump or explain', file=sys.stderr)
+            return 1
+        if estimate or cost_budget is not None:
+            print('error: estimates are not supported with --batch', file=sys.stderr)
+            return 1
+    elif expression is None:
+        print('error: an expression, or --batch, is required', file=sys.stderr)
+        return 1
+    elif dump_sexpr:
+        pprint(sexpr.parse(expression))
         return 0
 
-    query = parser.parse(root_token)
     if dump_parse:
-        pprint(query)
+        pprint(parser.parse(sexpr.parse(expression)))
         return 0
 
-    client = Elasticsearch(elasticsearch)
+    if batch is None:
+        query = prepared.prepare(expression, param, optimize=optimize)
+        if dump_plan and not estimate:
+            pprint(query)
+            return 0
+
     qb = BasicQueryBuilder(
-        id_source='title',
-        id_field='title.keyword',
-        edge_field='statement_keywords',
-        edge_kind_field='statement_keywords.property',
-        sort={'sitelink_count': {'order': 'desc'}},
+        **CIRRUS_FIELDS,
+        inner_limit=inner_limit,
+        local_threshold=local_threshold,
+        extract_strategy=extract_strategy,
+        closure_depth=closure_depth,
+    )
+    if lean:
+        transport = transport_lean(json_library, qb.id_field)
+    else:
+        transport = TransportProfile(json_library=json_library)
+    executor_args: Dict[str, Any] = dict(
+        limit=limit,
+        page_size=page_size,
+        time_budget_ms=time_budget_ms,
+        tiebreak={qb.id_field: 'asc'},
+        timeout_ms=timeout_ms,
     )
-    executor = BasicQueryExecutor(client, qb, index)
+    if route:
+        executor_args['routes'] = dict(spec.split('=', 1) for spec in route)
+    source = ['title', 'labels.' + report_lang]
+    topk = TopK(initial_limit) if top_k else None
+    if batch is not None:
+        make = executor_factory(
+            qb, index, elasticsearch, graph, msearch, parallelism, transport, backend,
+            concurrency=concurrency, cache_entries=cache_entries, **executor_args)
+
+        def run_one(expression: str) -> Dict[str, Any]:
+            executor = make()
+            with timer() as took:
+                result, deepening = evaluate(
+                    executor, prepared.prepare(expression, param, optimize=optimize),
+                    qb.sort, size, source, topk)
+            record: Dict[str, Any] = {
+                'hits': [hit_record(hit, report_lang) for hit in result.hits],
+                'totals': query_totals(executor, result, took.ms, deepening),
+            }
+            if deepening is not None:
+                record['deepening'] = deepening.to_dict()
+            if isinstance(executor, FederatedQueryExecutor):
+                record['backends'] = [report.to_dict() for report in executor.reports]
+            return record
+
+        with open_path(batch, 'rt') as f, open_path(output, 'wt') as out:
+            report = run_batch(split_expressions(f), run_one, out, concurrency)
+        print(report.format(), file=sys.stderr)
+        return 0
+
+    executor = make_executor(
+        qb, index, elasticsearch, graph, msearch, parallelism, transport, backend, **executor_args)
+    if estimate or cost_budget is not None:
+        if isinstance(executor, FederatedQueryExecutor):
+            print('error: estimates are not supported with --backend', file=sys.stderr)
+            return 1
+        estimator = CostEstimator(executor, inner_limit, LRUCache(), budget=cost_budget)
+        try:
+            query, estimated = estimator(query)
+        except CostExceeded as e:
+            print('{}: {}'.format('warning' if cost_warn else 'error', e), file=sys.stderr)
+            if not (cost_warn or dump_plan):
+                return 1
+            query, estimated = e.planned, e.estimate
+        if dump_plan:
+            pprint(query)
+            print('estimate:')
+            for line in estimated.format(indent=1):
+                print(line)
+            print('    cost: {} docs'.format(estimated.cost()))
+            return 0
+        executor.clear_counters()
+
     with timer() as took:
-        result = executor(
-            query,
-            size=size,
-            source=[
-                'title',
-                'labels.' + report_lang
-            ],
-            sort=qb.sort,
-        )
-
-    prefix_len = max(len(hit.id) for hit in result.hits)
+        try:
+            result, deepening = evaluate(executor, query, qb.sort, size, source, topk)
+        except (DeadlineExceeded, ValueError) as e:
+            print('error: {}'.format(e), file=sys.stderr)
+            return 1
+
+    def hit_name(hit: Hit) -> str:
+        return hit.id if hit.backend is None else '{}:{}'.format(hit.backend, hit.id)
+
+    prefix_len = max((len(hit_name(hit)) for hit in result.hits), default=0)
     fmt = '{:%ss} - {}' % prefix_len
     for hit in result.hits:
         try:
             label = hit.label(report_lang)
         except KeyError:
             label = ''
-        print(fmt.format(hit.id, label))
+        print(fmt.format(hit_name(hit), label))
 
-    net_took = executor.took_ms - executor.es_took_ms
-    unicorn_took = took.ms - executor.took_ms
-    inner_truncated = executor.truncated - result.truncated
-    num_hits = len(result.hits)
+    totals = query_totals(executor, result, took.ms, deepening)
     print(dedent("""
         totals:
-            returned:     {num_hits: 4d} docs
-            total:        {result.total_hits: 4d} docs
+            returned:     {returned: 4d} docs
+            total:        {total: 4d} docs
             inner trunc:  {inner_truncated: 4d} docs
-            es took:      {executor.es_took_ms: 6.1f}ms
-            net took:     {net_took: 6.1f}ms
-            unicorn took: {unicorn_took: 6.1f}ms
-            total took:   {took.ms: 6.1f}ms
-    """.format(**locals())))
+            es took:      {es_took_ms: 6.1f}ms
+            net took:     {net_took_ms: 6.1f}ms
+            decode took:  {decode_ms: 6.1f}ms
+            response:     {response_bytes: 6d} bytes
+            unicorn took: {unicorn_took_ms: 6.1f}ms
+            total took:   {total_took_ms: 6.1f}ms
+            timed out:    {timed_out!s:>5}
+    """.format(**totals)))
+
+    if deepening is not None:
+        print('deepening:')
+        print('    limits: {}, exact: {}, stable: {}'.format(
+            ', '.join(str(limit) for limit in deepening.limits), deepening.exact, deepening.stable))
+
+    if isinstance(executor, FederatedQueryExecutor):
+        print('backends:')
+        for line in format_reports(executor.reports, indent=1):
+            print(line)
+
+    trace = executor.tracer.last()
+    if explain and trace is not None:
+        print('explain:')
+        for line in trace.format(indent=1):
+            print(line)
     return 0
 
 
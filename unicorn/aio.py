@@ -0,0 +1,97 @@
+"""Asyncio elasticsearch client
+
+Only implements the requests issued by AsyncQueryExecutor. Requires
+aiohttp, installed with the asgi extra.
+"""
+import aiohttp
+from itertools import cycle
+import json
+from typing import Any, List, Mapping, Optional, Sequence, Union
+
+
+class RequestError(Exception):
+    """Elasticsearch responded with an error status"""
+    def __init__(self, status: int, info: Any):
+        super().__init__('elasticsearch responded with status {}: {}'.format(status, info))
+        self.status = status
+        self.info = info
+
+
+class AsyncClient:
+    """Issues requests over a pool of keep-alive connections
+
+    At most pool_size requests are in flight at once, further requests
+    wait for a free connection. Idle connections are kept open for
+    keepalive_s to be reused by later requests.
+    """
+    def __init__(
+        self,
+        hosts: Optional[Union[str, Sequence[str]]] = None,
+        pool_size: int = 100,
+        keepalive_s: float = 30.,
+        timeout_s: float = 30.,
+    ):
+        if hosts is None:
+            hosts = ['localhost:9200']
+        elif isinstance(hosts, str):
+            hosts = [hosts]
+        self.hosts: List[str] = [host if '://' in host else 'http://' + host for host in hosts]
+        self.next_host = cycle(self.hosts)
+        self.pool_size = pool_size
+        self.keepalive_s = keepalive_s
+        self.timeout_s = timeout_s
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def open(self) -> aiohttp.ClientSession:
+        """Session of the client, must first be called from the event loop"""
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_s)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def request(
+        self,
+        path: str,
+        body: bytes,
+        content_type: str,
+        request_timeout: Optional[float],
+        filter_path: Optional[Sequence[str]],
+    ) -> Mapping:
+        url = next(self.next_host).rstrip('/') + path
+        timeout = aiohttp.ClientTimeout(total=self.timeout_s if request_timeout is None else request_timeout)
+        params = {} if filter_path is None else {'filter_path': ','.join(filter_path)}
+        async with self.open().post(
+                url, data=body, params=params, headers={'Content-Type': content_type},
+                timeout=timeout) as response:
+            data = await response.json(content_type=None)
+            if response.status >= 300:
+                raise RequestError(response.status, data)
+            return data
+
+    async def search(
+        self,
+        index: str,
+        body: Mapping,
+        request_timeout: Optional[float] = None,
+        filter_path: Optional[Sequence[str]] = None,
+    ) -> Mapping:
+        return await self.request(
+            '/{}/_search'.format(index), json.dumps(body).encode('utf8'),
+            'application/json', request_timeout, filter_path)
+
+    async def msearch(
+        self,
+        body: Sequence[Mapping],
+        index: Optional[str] = None,
+        request_timeout: Optional[float] = None,
+        filter_path: Optional[Sequence[str]] = None,
+    ) -> Mapping:
+        lines = ''.join(json.dumps(line) + '\n' for line in body)
+        return await self.request(
+            '/_msearch' if index is None else '/{}/_msearch'.format(index), lines.encode('utf8'),
+            'application/x-ndjson', request_timeout, filter_path)
@@ -0,0 +1,147 @@
+"""Asyncio native serving of the web interface
+
+    uvicorn unicorn.asgi:app
+
+Serves / and /search with the same parameters, responses and templates
+as unicorn.web, sharing its configuration and stage cache. Queries are
+executed by AsyncQueryExecutor, a single process serves many multi-stage
+queries concurrently over a pool of elasticsearch connections sized by
+config['async']. Cost estimation and /search/stream are only available
+from unicorn.web.
+"""
+import inspect
+import json
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Tuple
+from urllib.parse import parse_qs
+
+from unicorn import prepared
+from unicorn.aio import AsyncClient
+from unicorn.labels import LabelService
+from unicorn.parser import ParseError
+from unicorn.qe import AsyncQueryExecutor, DeadlineExceeded
+from unicorn.utils import timer
+from unicorn.web import (
+    config, get_template, qb, search_response, split_params, stage_cache, timed_out_result, top_k, transport)
+
+
+client = AsyncClient(config['elasticsearch']['hosts'], **config['async'])
+label_service = LabelService(
+    client, config['index_name'], id_field=config['query_builder']['id_field'], **config['labels'])
+
+
+def make_executor(**kwargs) -> AsyncQueryExecutor:
+    """Per-request query executor"""
+    return AsyncQueryExecutor(
+        client, qb, config['index_name'],
+        cache=stage_cache, transport=transport, **dict(config['executor'], **kwargs))
+
+
+async def root() -> Dict[str, Any]:
+    return {}
+
+
+async def search(q: str, size: int = 1000, lang: str = 'en', timeout_ms: float = 0., params: str = ''):
+    if timeout_ms > 0:
+        executor = make_executor(timeout_ms=timeout_ms)
+    else:
+        executor = make_executor()
+    with timer() as took:
+        query = prepared.prepare(q, split_params(params), optimize=config['optimize'])
+        deepening = None
+        try:
+            if top_k is not None:
+                result, deepening = await top_k.execute(executor, query, qb.sort, size, ['title'])
+            else:
+                result = await executor.execute(
+                    query,
+                    size=size,
+                    source=['title'],
+                    sort=qb.sort,
+                )
+        except DeadlineExceeded:
+            result = timed_out_result()
+        with timer() as label_took:
+            labels = await label_service.async_labels(result.ids, lang, executor.remaining_ms())
+    return search_response(q, labels, executor, result, took.ms, label_ms=label_took.ms, deepening=deepening)
+
+
+# Handler and html template of each path
+routes: Dict[str, Tuple[Callable[..., Awaitable[Dict[str, Any]]], str]] = {
+    '/': (root, 'index.html'),
+    '/search': (search, 'search.html'),
+}
+
+
+def handler_args(handler: Callable, query_string: bytes) -> Dict[str, Any]:
+    """Query string parameters converted by the handler annotations
+
+    Raises ValueError on missing or invalid parameters.
+    """
+    query = parse_qs(query_string.decode('utf8'))
+    args = {}
+    for name, param in inspect.signature(handler).parameters.items():
+        if name not in query:
+            if param.default is inspect.Parameter.empty:
+                raise ValueError("Required parameter '{}' not supplied".format(name))
+            continue
+        try:
+            args[name] = param.annotation(query[name][-1])
+        except ValueError:
+            raise ValueError("Invalid value for parameter '{}'".format(name))
+    return args
+
+
+async def respond(send: Callable, status: int, content_type: str, body: bytes) -> None:
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode('ascii'))],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive: Callable, send: Callable) -> None:
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            client.open()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await client.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope: Mapping[str, Any], receive: Callable, send: Callable) -> None:
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    try:
+        handler, template = routes[scope['path']]
+    except KeyError:
+        await respond(send, 404, 'application/json', b'{"errors": {"404": "Not Found"}}')
+        return
+    try:
+        args = handler_args(handler, scope['query_string'])
+    except ValueError as e:
+        await respond(send, 400, 'application/json', json.dumps({'errors': str(e)}).encode('utf8'))
+        return
+
+    try:
+        content = await handler(**args)
+    except (ParseError, ValueError) as e:
+        await respond(send, 400, 'application/json', json.dumps({'errors': str(e)}).encode('utf8'))
+        return
+    except Exception:
+        # The response has not started, report the failure as hug does
+        await respond(send, 500, 'application/json', b'{"errors": {"500": "Internal Server Error"}}')
+        raise
+    headers: List[Tuple[bytes, bytes]] = scope['headers']
+    accept = b', '.join(value for key, value in headers if key == b'accept')
+    if b'text/html' in accept:
+        body = get_template(template).render(content).encode('utf8')
+        await respond(send, 200, 'text/html; charset=utf-8', body)
+    else:
+        await respond(send, 200, 'application/json; charset=utf-8', json.dumps(content).encode('utf8'))
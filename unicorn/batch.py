@@ -0,0 +1,99 @@
+"""Execution of many expressions by a single process
+
+    unicorn --batch queries.txt --concurrency 8 > results.jsonl
+
+Expressions are read one per line, or as s-expression blocks spanning
+several lines until their brackets balance. Blank lines and lines
+starting with # between expressions are skipped. All queries share one
+elasticsearch client and stage cache, each is written as a single line
+of json in the order it was read.
+"""
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+import json
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, TextIO, Tuple
+
+from unicorn.sexpr import term_regex
+from unicorn.utils import timer
+
+
+@dataclass
+class BatchReport:
+    queries: int = 0
+    errors: int = 0
+    took_ms: float = 0.
+
+    def format(self) -> str:
+        qps = self.queries / (self.took_ms / 1000) if self.took_ms else 0.
+        return '{} queries, {} errors, {:.1f}ms, {:.1f} queries/s'.format(
+            self.queries, self.errors, self.took_ms, qps)
+
+
+def split_expressions(lines: Iterable[str]) -> Iterator[Tuple[int, str]]:
+    """Expressions of lines, with the line number each starts on"""
+    depth = 0
+    start = 0
+    block: List[str] = []
+    for line_number, line in enumerate(lines, 1):
+        if not block and (not line.strip() or line.lstrip().startswith('#')):
+            continue
+        if not block:
+            start = line_number
+        block.append(line)
+        for match in term_regex.finditer(line):
+            if match.group('brackl'):
+                depth += 1
+            elif match.group('brackr'):
+                depth -= 1
+        if depth <= 0:
+            # Unbalanced closing brackets end the block, parsing reports them
+            yield start, ''.join(block).strip()
+            block = []
+            depth = 0
+    if block:
+        yield start, ''.join(block).strip()
+
+
+def run_batch(
+    expressions: Iterable[Tuple[int, str]],
+    run_one: Callable[[str], Dict[str, Any]],
+    out: TextIO,
+    concurrency: int = 1,
+) -> BatchReport:
+    """Write the record of run_one for each expression to out as jsonl
+
+    Records are written in the order of expressions, each as soon as it
+    and all before it completed. No more than concurrency * 2 queries
+    are in flight. A query raising an exception is recorded with its
+    error, and doesn't stop the batch.
+    """
+    report = BatchReport()
+
+    def run(item: Tuple[int, str]) -> Dict[str, Any]:
+        line_number, expression = item
+        record: Dict[str, Any] = {'line': line_number, 'expression': expression}
+        try:
+            record.update(run_one(expression))
+        except Exception as e:
+            record['error'] = '{}: {}'.format(type(e).__name__, e)
+        return record
+
+    def write(future: 'Future[Dict[str, Any]]') -> None:
+        record = future.result()
+        report.queries += 1
+        report.errors += 'error' in record
+        out.write(json.dumps(record) + '\n')
+
+    # Expressions are read as the window of queries in flight drains,
+    # a batch larger than memory is never read ahead in full.
+    window: Deque['Future[Dict[str, Any]]'] = deque()
+    with timer() as took, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for item in expressions:
+            if len(window) >= concurrency * 2:
+                write(window.popleft())
+            window.append(pool.submit(run, item))
+        while window:
+            write(window.popleft())
+    report.took_ms = took.ms
+    return report
@@ -0,0 +1,238 @@
+"""Benchmark query execution against recorded elasticsearch responses
+
+Responses are first recorded from a live cluster:
+
+    unicorn-bench record --elasticsearch http://localhost:9200 --recording rec.json examples/*
+
+and then replayed, with their recorded latencies, to measure unicorn
+itself without a cluster:
+
+    unicorn-bench run --recording rec.json --baseline baseline.json examples/*
+
+Recordings are only valid for the cluster and index they were made
+against, none are kept in the repository.
+"""
+from argparse import ArgumentParser
+from elasticsearch import Elasticsearch
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Any, Dict, List, Mapping, Optional, Sequence
+
+from unicorn import optimizer, parser, sexpr
+from unicorn.model import QueryNode
+from unicorn.qb import CIRRUS_FIELDS, BasicQueryBuilder
+from unicorn.qe import BasicQueryExecutor
+from unicorn.trace import TraceNode
+from unicorn.utils import timer
+
+
+def request_key(index: Optional[str], body: Mapping) -> str:
+    return json.dumps([index, body], sort_keys=True)
+
+
+class RecordingClient:
+    """Wraps an elasticsearch client, recording responses and latency"""
+    def __init__(self, client: Elasticsearch):
+        self.client = client
+        self.recording: Dict[str, Any] = {}
+
+    def search(self, index: str, body: Mapping, **kwargs) -> Mapping:
+        with timer() as took:
+            response = self.client.search(index=index, body=body, **kwargs)
+        self.recording[request_key(index, body)] = {
+            'latency_ms': took.ms,
+            'response': response,
+        }
+        return response
+
+    def msearch(self, body: Sequence[Mapping], index: Optional[str] = None, **kwargs) -> Mapping:
+        with timer() as took:
+            response = self.client.msearch(body=body, index=index, **kwargs)
+        for request, sub_response in zip(body[1::2], response['responses']):
+            self.recording[request_key(index, request)] = {
+                'latency_ms': took.ms,
+                'response': sub_response,
+            }
+        return response
+
+    def save(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.recording, f)
+
+
+class ReplayClient:
+    """Serves recorded responses, sleeping for their recorded latency"""
+    def __init__(self, recording: Mapping[str, Any], speed: float = 1.):
+        self.recording = recording
+        self.speed = speed
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> 'ReplayClient':
+        with open(path, 'r') as f:
+            return cls(json.load(f), **kwargs)
+
+    def replay(self, index: Optional[str], body: Mapping) -> Mapping:
+        try:
+            recorded = self.recording[request_key(index, body)]
+        except KeyError:
+            raise KeyError('No recorded response for request: {}'.format(json.dumps(body)))
+        return recorded
+
+    def search(self, index: str, body: Mapping, **kwargs) -> Mapping:
+        recorded = self.replay(index, body)
+        time.sleep(recorded['latency_ms'] / 1000 / self.speed)
+        return recorded['response']
+
+    def msearch(self, body: Sequence[Mapping], index: Optional[str] = None, **kwargs) -> Mapping:
+        recorded = [self.replay(index, request) for request in body[1::2]]
+        time.sleep(max(r['latency_ms'] for r in recorded) / 1000 / self.speed)
+        return {'responses': [r['response'] for r in recorded]}
+
+
+def load_corpus(paths: Sequence[str]) -> Dict[str, str]:
+    """Map from query name to expression, one expression per file"""
+    corpus = {}
+    for path in paths:
+        with open(path, 'r') as f:
+            corpus[os.path.basename(path)] = f.read()
+    return corpus
+
+
+def trace_totals(trace: TraceNode) -> Dict[str, float]:
+    """Sum of requests, request bytes and client side build time"""
+    # build_ms of a node includes the full execution of its children
+    build_ms = trace.build_ms - sum(
+        child.build_ms + child.es_took_ms + child.net_took_ms
+        for child in trace.children)
+    totals = {
+        'requests': trace.requests,
+        'request_bytes': trace.request_bytes,
+        'build_ms': build_ms,
+    }
+    for child in trace.children:
+        for k, v in trace_totals(child).items():
+            totals[k] += v
+    return totals
+
+
+def stage_request_bytes(trace: TraceNode) -> Dict[str, float]:
+    """Request bytes issued by each stage, keyed by its expression
+
+    Stages are attributed only the requests they issued themselves,
+    not those of their children. Repeated stages are summed.
+    """
+    stages: Dict[str, float] = {}
+    if trace.requests:
+        stages['request_bytes ' + trace.node] = trace.request_bytes
+    for child in trace.children:
+        for k, v in stage_request_bytes(child).items():
+            stages[k] = stages.get(k, 0) + v
+    return stages
+
+
+def measure(expression: str, executor: BasicQueryExecutor, size: int) -> Dict[str, float]:
+    """Run expression once, returning timings in ms and request totals"""
+    executor.clear_counters()
+    with timer() as parse_took:
+        query: QueryNode = parser.parse(sexpr.parse(expression))
+    with timer() as plan_took:
+        query = optimizer.optimize(query)
+    with timer() as execute_took:
+        executor(query, size=size, source=['title'], sort=CIRRUS_FIELDS['sort'])
+    trace = executor.tracer.last()
+    assert trace is not None
+    return {
+        'parse_ms': parse_took.ms,
+        'plan_ms': plan_took.ms,
+        'execute_ms': execute_took.ms,
+        'unicorn_ms': execute_took.ms - executor.took_ms,
+        **trace_totals(trace),
+        **stage_request_bytes(trace),
+    }
+
+
+def run_corpus(
+    corpus: Mapping[str, str],
+    executor: BasicQueryExecutor,
+    size: int,
+    repeat: int,
+) -> Dict[str, Dict[str, float]]:
+    """Median of each measurement per query"""
+    report = {}
+    for name, expression in corpus.items():
+        runs = [measure(expression, executor, size) for _ in range(repeat)]
+        report[name] = {k: statistics.median(run[k] for run in runs) for k in runs[0]}
+    return report
+
+
+def regressions(
+    report: Mapping[str, Mapping[str, float]],
+    baseline: Mapping[str, Mapping[str, float]],
+    tolerance: float,
+    min_delta_ms: float,
+) -> List[str]:
+    """Describe measurements that are worse than the baseline"""
+    found = []
+    for name, measured in report.items():
+        if name not in baseline:
+            continue
+        for k, value in measured.items():
+            expect = baseline[name].get(k)
+            if expect is None:
+                continue
+            slack = min_delta_ms if k.endswith('_ms') else 0
+            if value > expect * (1 + tolerance) + slack:
+                found.append('{}: {} {:.2f} > baseline {:.2f}'.format(name, k, value, expect))
+    return found
+
+
+def arg_parser() -> ArgumentParser:
+    parser = ArgumentParser(description='Benchmark unicorn query execution')
+    parser.add_argument('mode', choices=['record', 'run'])
+    parser.add_argument('corpus', nargs='+', help='Files each containing one expression')
+    parser.add_argument('--recording', required=True)
+    parser.add_argument('--elasticsearch', default=None)
+    parser.add_argument('--index', default='wikidatawiki_content')
+    parser.add_argument('--size', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--speed', type=float, default=1., help='Replay latency speedup')
+    parser.add_argument('--baseline', default=None, help='Compare against, or with --save, write to')
+    parser.add_argument('--save', action='store_true', default=False)
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--min-delta-ms', type=float, default=1.)
+    return parser
+
+
+def main():
+    parser = arg_parser()
+    args = parser.parse_args()
+    if args.save and args.baseline is None:
+        parser.error('--save requires --baseline')
+    corpus = load_corpus(args.corpus)
+    qb = BasicQueryBuilder(**CIRRUS_FIELDS)
+
+    if args.mode == 'record':
+        recorder = RecordingClient(Elasticsearch(args.elasticsearch))
+        run_corpus(corpus, BasicQueryExecutor(recorder, qb, args.index), args.size, 1)
+        recorder.save(args.recording)
+        sys.exit(0)
+
+    client = ReplayClient.load(args.recording, speed=args.speed)
+    report = run_corpus(corpus, BasicQueryExecutor(client, qb, args.index), args.size, args.repeat)
+    print(json.dumps(report, indent=4, sort_keys=True))
+
+    if args.baseline is None:
+        sys.exit(0)
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+        sys.exit(0)
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    found = regressions(report, baseline, args.tolerance, args.min_delta_ms)
+    for line in found:
+        print(line, file=sys.stderr)
+    sys.exit(1 if found else 0)
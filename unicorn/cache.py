@@ -0,0 +1,225 @@
+"""Caching of query stage results between requests"""
+from collections import OrderedDict
+from elasticsearch import Elasticsearch
+import hashlib
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Hashable, Optional, Protocol, Sequence
+
+
+class Cache(Protocol):
+    def get(self, key: Hashable) -> Optional[Any]: ...
+
+    def put(self, key: Hashable, value: Any) -> None: ...
+
+
+class LRUCache:
+    """Bounded, thread safe, LRU cache with a time to live
+
+    Hit and miss counters are cumulative over the life of the cache.
+    """
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        ttl_s: float = 300.,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            try:
+                expires_at, value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires_at < self.clock():
+                del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl_s, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+class SqliteCache:
+    """Cache persisted to an sqlite database, shared between processes
+
+    Survives restarts, so new processes start warm. Values are pickled,
+    the database must only be writable by unicorn. When generation is
+    provided entries are stored under the generation current when they
+    were put, typically changing when the index is rebuilt. Entries of
+    any other generation are misses, and are dropped once a newer
+    generation is seen.
+
+    The generation is refreshed from a background thread at most every
+    generation_check_s, requests never wait on it. Until the first
+    refresh the generation last seen by any process is assumed. While
+    it can't be looked up every get is a miss, and puts are dropped.
+
+    Entries beyond max_entries are evicted oldest first, every 100 puts.
+    """
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = 100000,
+        ttl_s: float = 86400.,
+        generation: Optional[Callable[[], str]] = None,
+        generation_check_s: float = 60.,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.generation = generation
+        self.generation_check_s = generation_check_s
+        self.clock = clock
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # The generation is first refreshed on use, not on creation
+        self.next_generation_check = 0.
+        self.refresher: Optional[threading.Thread] = None
+        self.puts = 0
+        self.hits = 0
+        self.misses = 0
+        self.generation_errors = 0
+        with self.connection() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(entries)')]
+            if columns and 'generation' not in columns:
+                # Created before entries carried their generation
+                conn.execute('DROP TABLE entries')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS entries '
+                '(key TEXT PRIMARY KEY, expires_at REAL NOT NULL, generation TEXT NOT NULL, value BLOB NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            row = conn.execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()
+        self.current_generation: Optional[str] = ''
+        if generation is not None:
+            self.current_generation = None if row is None else row[0]
+
+    def connection(self) -> sqlite3.Connection:
+        """Connection of the calling thread"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.)
+            self.local.conn = conn
+        return conn
+
+    @staticmethod
+    def encode_key(key: Hashable) -> str:
+        # Keys are tuples of plain values, their repr is stable
+        return hashlib.sha1(repr(key).encode('utf8')).hexdigest()
+
+    def __len__(self):
+        return self.connection().execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        self.check_generation()
+        generation = self.current_generation
+        row = None
+        if generation is not None:
+            row = self.connection().execute(
+                'SELECT expires_at, value FROM entries WHERE key = ? AND generation = ?',
+                (self.encode_key(key), generation)).fetchone()
+        with self.lock:
+            if row is None or row[0] < self.clock():
+                self.misses += 1
+                return None
+            self.hits += 1
+        return pickle.loads(row[1])
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self.check_generation()
+        generation = self.current_generation
+        if generation is None:
+            return
+        with self.connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO entries (key, expires_at, generation, value) VALUES (?, ?, ?, ?)',
+                (self.encode_key(key), self.clock() + self.ttl_s, generation,
+                 pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+        with self.lock:
+            self.puts += 1
+            evict = self.puts % 100 == 0
+        if evict:
+            self.evict()
+
+    def evict(self) -> None:
+        """Drop expired entries, and the oldest beyond max_entries"""
+        with self.connection() as conn:
+            conn.execute('DELETE FROM entries WHERE expires_at < ?', (self.clock(),))
+            conn.execute(
+                'DELETE FROM entries WHERE rowid <= '
+                '(SELECT rowid FROM entries ORDER BY rowid DESC LIMIT 1 OFFSET ?)', (self.max_entries,))
+
+    def clear(self) -> None:
+        with self.connection() as conn:
+            conn.execute('DELETE FROM entries')
+
+    def check_generation(self) -> None:
+        """Start a background refresh of the generation when one is due"""
+        if self.generation is None:
+            return
+        now = self.clock()
+        with self.lock:
+            if now < self.next_generation_check:
+                return
+            self.next_generation_check = now + self.generation_check_s
+            if self.refresher is not None and self.refresher.is_alive():
+                return
+            self.refresher = threading.Thread(target=self.refresh_generation, daemon=True)
+            self.refresher.start()
+
+    def refresh_generation(self) -> None:
+        """Look up the generation, dropping entries of any other"""
+        assert self.generation is not None
+        try:
+            generation = self.generation()
+        except Exception:
+            # Entries can't be shown to be current
+            with self.lock:
+                self.generation_errors += 1
+            self.current_generation = None
+            return
+        with self.connection() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()
+            if row is None or row[0] != generation:
+                conn.execute('DELETE FROM entries WHERE generation != ?', (generation,))
+                conn.execute(
+                    "INSERT OR REPLACE INTO meta (name, value) VALUES ('generation', ?)", (generation,))
+        self.current_generation = generation
+
+
+def index_generation(client: Elasticsearch, indices: Sequence[str]) -> str:
+    """Marker changing whenever any of indices is rebuilt
+
+    Indices are typically aliases, the uuid of the concrete index they
+    point at changes when a new index is swapped in.
+    """
+    settings = client.indices.get_settings(index=','.join(indices), name='index.uuid')
+    return ','.join(sorted(
+        '{}:{}'.format(name, index['settings']['index']['uuid'])
+        for name, index in settings.items()))
@@ -0,0 +1,158 @@
+"""Estimate the cost of a query before executing it
+
+Cardinality of each node is bounded from above using size=0 counts of
+its term queries. Stages whose inner query can't match more than a
+handful of documents are given a matching limit, and queries expected
+to fetch more than a budget of documents can be stopped before any of
+their stages run.
+"""
+from __future__ import annotations
+from dataclasses import asdict, dataclass, field, replace
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+from unicorn.cache import Cache
+from unicorn.model import (
+    ApplyNode, BoolNode, ClosureNode, ExtractNode, NoneNode,
+    QueryExecutor, QueryNode, TermNode, TermsNode, canonical)
+from unicorn.trace import format_node
+
+
+class CostExceeded(Exception):
+    def __init__(self, planned: QueryNode, estimate: Estimate, budget: int):
+        super().__init__('estimated cost of {} docs exceeds budget of {} docs'.format(
+            estimate.cost(), budget))
+        self.planned = planned
+        self.estimate = estimate
+        self.budget = budget
+
+
+@dataclass
+class Estimate:
+    """Estimated cardinality of a single query node"""
+    node: str
+    # Upper bound of matching documents
+    hits: int
+    # Documents fetched by the stage, None when not a stage
+    limit: Optional[int] = None
+    children: List[Estimate] = field(default_factory=list)
+
+    def cost(self) -> int:
+        """Documents fetched by all stages below, and including, this node"""
+        return (self.limit or 0) + sum(child.cost() for child in self.children)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    def format(self, indent: int = 0) -> Iterator[str]:
+        limit = '' if self.limit is None else ', limit: {}'.format(self.limit)
+        yield '{}{}'.format('    ' * indent, self.node)
+        yield '{}  hits <= {}{}'.format('    ' * indent, self.hits, limit)
+        for child in self.children:
+            yield from child.format(indent + 1)
+
+
+class CostEstimator:
+    """Plans per-stage limits from estimated cardinalities
+
+    Counts are cached per term, the cache ttl bounds how far a
+    count can lag behind the index. As a stage limit is never larger
+    than inner_limit an outdated count can only truncate a stage that
+    grew since it was counted.
+    """
+    def __init__(
+        self,
+        qe: QueryExecutor,
+        inner_limit: int = 900,
+        cache: Optional[Cache] = None,
+        budget: Optional[int] = None,
+    ):
+        self.qe = qe
+        self.inner_limit = inner_limit
+        self.cache = cache
+        self.budget = budget
+
+    def count(self, node: QueryNode) -> int:
+        if self.cache is None:
+            return self.qe.count(node)
+        # Routed properties are counted in the index holding their edges
+        key = ('count', self.qe.route(node), canonical(node))
+        count = self.cache.get(key)
+        if count is None:
+            count = self.qe.count(node)
+            self.cache.put(key, count)
+        return count
+
+    def __call__(self, node: QueryNode) -> Tuple[QueryNode, Estimate]:
+        """Node with estimated limits applied to each stage
+
+        Raises CostExceeded when the stages are estimated to fetch more
+        documents than the budget allows.
+        """
+        planned, estimate = self.plan(node)
+        if self.budget is not None and estimate.cost() > self.budget:
+            raise CostExceeded(planned, estimate, self.budget)
+        return planned, estimate
+
+    def plan(self, node: QueryNode) -> Tuple[QueryNode, Estimate]:
+        if isinstance(node, (TermNode, TermsNode)):
+            return node, Estimate(format_node(node), self.count(node))
+        elif isinstance(node, NoneNode):
+            return node, Estimate(format_node(node), 0)
+        elif isinstance(node, BoolNode):
+            return self.plan_bool(node)
+        elif isinstance(node, ApplyNode):
+            return self.plan_apply(node)
+        elif isinstance(node, ExtractNode):
+            return self.plan_extract(node)
+        elif isinstance(node, ClosureNode):
+            # Levels fetch up to the limit in total, which also bounds
+            # the entities in the closure.
+            limit = self.inner_limit if node.limit is None else node.limit
+            return node, Estimate(format_node(node), limit, limit)
+        else:
+            raise NotImplementedError('Unreachable')
+
+    def stage_limit(self, node: Union[ApplyNode, ExtractNode], inner: Estimate) -> int:
+        limit = self.inner_limit if node.limit is None else node.limit
+        return min(limit, inner.hits)
+
+    def plan_bool(self, node: BoolNode) -> Tuple[QueryNode, Estimate]:
+        must = [self.plan(x) for x in node.must]
+        must_not = [self.plan(x) for x in node.must_not]
+        should = [self.plan(x) for x in node.should]
+        if must:
+            hits = min(e.hits for _, e in must)
+        elif should:
+            hits = min(self.total(), sum(e.hits for _, e in should))
+        else:
+            # Excluding documents doesn't lower the bound
+            hits = self.total()
+        planned = BoolNode(
+            must=[x for x, _ in must],
+            must_not=[x for x, _ in must_not],
+            should=[x for x, _ in should])
+        children = [e for _, e in must + must_not + should]
+        return planned, Estimate(format_node(node), hits, children=children)
+
+    def plan_apply(self, node: ApplyNode) -> Tuple[QueryNode, Estimate]:
+        query, inner = self.plan(node.query)
+        limit = self.stage_limit(node, inner)
+        # Any document with an edge of this kind could be reached
+        hits = 0 if limit == 0 else self.count(TermNode(node.prefix[:-1]))
+        planned = replace(node, query=query, limit=limit)
+        return planned, Estimate(format_node(node), hits, limit, [inner])
+
+    def plan_extract(self, node: ExtractNode) -> Tuple[QueryNode, Estimate]:
+        # Only documents with an edge of this kind are fetched
+        inner_node, inner = self.plan(BoolNode(must=[TermNode(node.key[:-1]), node.query]))
+        assert isinstance(inner_node, BoolNode)
+        query = inner_node.must[1]
+        limit = self.stage_limit(node, inner)
+        # Edges of a single document can reach any number of documents
+        hits = 0 if limit == 0 else self.total()
+        planned = replace(node, query=query, limit=limit)
+        return planned, Estimate(format_node(node), hits, limit, [inner])
+
+    def total(self) -> int:
+        """Documents in the index"""
+        return self.count(BoolNode(must_not=[NoneNode()]))
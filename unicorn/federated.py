@@ -0,0 +1,219 @@
+"""Execution of one plan against several wikibase indices
+
+Each backend is a complete executor with its own client, index and
+routes. A query runs against all backends in parallel, and the hits
+of each are merged by the sort of the query.
+"""
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, replace
+from functools import cmp_to_key
+import heapq
+from itertools import islice
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Sequence, Union
+
+from unicorn.model import ElasticSort, Query, QueryNode, Result
+from unicorn.qe import BasicQueryExecutor
+from unicorn.trace import Tracer
+
+
+@dataclass
+class Backend:
+    name: str
+    executor: BasicQueryExecutor
+
+
+@dataclass
+class BackendReport:
+    """Execution statistics of a single backend for the last query"""
+    name: str
+    took_ms: float = 0.
+    es_took_ms: float = 0.
+    hits: int = 0
+    total_hits: int = 0
+    truncated: int = 0
+    timed_out: bool = False
+    error: Optional[str] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+class FederatedQueryExecutor:
+    """Runs each query against all backends, merging hits by sort
+
+    Hits of the merged result carry the name of their backend in
+    _backend. Backends that fail are reported and left out of the
+    result, the query only fails when all of them do.
+
+    Without a pool one is created per executor, and shut down by close.
+    """
+    def __init__(self, backends: Sequence[Backend], pool: Optional[Executor] = None):
+        if not backends:
+            raise ValueError('At least one backend is required')
+        self.backends = backends
+        self.owns_pool = pool is None
+        self.pool = pool or ThreadPoolExecutor(max_workers=len(backends))
+        self.clear_counters()
+
+    def close(self) -> None:
+        if self.owns_pool:
+            self.pool.shutdown()
+
+    def __enter__(self) -> 'FederatedQueryExecutor':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def clear_counters(self) -> None:
+        for backend in self.backends:
+            backend.executor.clear_counters()
+        self.reports: List[BackendReport] = []
+        # Hits returned by backends that didn't make the merged result
+        self.merge_truncated = 0
+        self.tracer = Tracer()
+
+    def __call__(
+        self,
+        query_node: Union[Query, QueryNode],
+        sort: ElasticSort,
+        size: int = 10,
+        source: Optional[Sequence[str]] = None,
+    ) -> Result:
+        # Counters of the backend executors are cumulative, reports
+        # only cover this query.
+        before = [
+            (backend.executor.took_ms, backend.executor.es_took_ms, backend.executor.truncated)
+            for backend in self.backends]
+        futures = [
+            self.pool.submit(backend.executor, query_node, sort, size, source)
+            for backend in self.backends]
+        self.reports = []
+        results: List[Optional[Result]] = []
+        errors: List[BaseException] = []
+        with self.tracer.span(query_node) as trace:
+            for backend, future, (took_ms, es_took_ms, truncated) in zip(self.backends, futures, before):
+                report = BackendReport(backend.name)
+                executor = backend.executor
+                result: Optional[Result] = None
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    report.error = str(e)
+                if result is not None:
+                    report.hits = result.num_hits
+                    report.total_hits = result.total_hits
+                report.took_ms = executor.took_ms - took_ms
+                report.es_took_ms = executor.es_took_ms - es_took_ms
+                report.truncated = executor.truncated - truncated
+                report.timed_out = executor.timed_out
+                self.reports.append(report)
+                results.append(result)
+                backend_trace = executor.tracer.last()
+                if backend_trace is not None:
+                    trace.children.append(replace(backend_trace, node='[{}] {}'.format(
+                        backend.name, backend_trace.node)))
+        if len(errors) == len(self.backends):
+            raise errors[0]
+        merged = merge_results(
+            [backend.name for backend in self.backends], results, sort, size)
+        self.merge_truncated += sum(report.hits for report in self.reports) - merged.num_hits
+        trace.hits = merged.num_hits
+        trace.total_hits = merged.total_hits
+        trace.truncated = merged.truncated
+        return merged
+
+    # Counters over all backends. Backends run in parallel, the
+    # slowest determines the time taken.
+
+    @property
+    def took_ms(self) -> float:
+        return max(backend.executor.took_ms for backend in self.backends)
+
+    @property
+    def es_took_ms(self) -> float:
+        return max(backend.executor.es_took_ms for backend in self.backends)
+
+    @property
+    def response_bytes(self) -> int:
+        return sum(backend.executor.response_bytes for backend in self.backends)
+
+    @property
+    def decode_ms(self) -> float:
+        return sum(backend.executor.decode_ms for backend in self.backends)
+
+    @property
+    def truncated(self) -> int:
+        return self.merge_truncated + sum(backend.executor.truncated for backend in self.backends)
+
+    @property
+    def timed_out(self) -> bool:
+        return any(backend.executor.timed_out for backend in self.backends)
+
+
+def sort_descending(sort: Union[ElasticSort, Sequence[ElasticSort]]) -> List[bool]:
+    """Direction of each sort key, True when descending"""
+    descending = []
+    specs: Sequence[Any] = sort if isinstance(sort, list) else [sort]
+    for spec in specs:
+        if isinstance(spec, str):
+            descending.append(spec == '_score')
+            continue
+        (name, order), = spec.items()
+        if isinstance(order, Mapping):
+            order = order.get('order', 'desc' if name == '_score' else 'asc')
+        descending.append(order == 'desc')
+    return descending
+
+
+def compare_sort_values(descending: Sequence[bool], a: Sequence[Any], b: Sequence[Any]) -> int:
+    """Compare the sort values of two hits, missing values last"""
+    for desc, x, y in zip(descending, a, b):
+        if x == y:
+            continue
+        if x is None:
+            return 1
+        if y is None:
+            return -1
+        if x < y:
+            return 1 if desc else -1
+        return -1 if desc else 1
+    return 0
+
+
+def merge_results(
+    names: Sequence[str],
+    results: Sequence[Optional[Result]],
+    sort: ElasticSort,
+    size: int,
+) -> Result:
+    """Top size hits of results, which are each ordered by sort"""
+    descending = sort_descending(sort)
+
+    def compare(a: Mapping[str, Any], b: Mapping[str, Any]) -> int:
+        return compare_sort_values(descending, a['sort'], b['sort'])
+
+    def tagged(name: str, result: Result) -> Iterator[Mapping[str, Any]]:
+        for hit in result.es_hits:
+            yield dict(hit, _backend=name)
+
+    available = [(name, result) for name, result in zip(names, results) if result is not None]
+    hits = list(islice(heapq.merge(
+        *(tagged(name, result) for name, result in available), key=cmp_to_key(compare)), size))
+    return Result({
+        'took': max(result.es_took_ms for _, result in available),
+        'timed_out': any(result.timed_out for _, result in available),
+        'hits': {
+            'total': sum(result.total_hits for _, result in available),
+            'hits': hits,
+        },
+    }, max(result.took_ms for _, result in available), available[0][1].id_field)
+
+
+def format_reports(reports: Sequence[BackendReport], indent: int = 0) -> Iterator[str]:
+    for report in reports:
+        yield '{}{}: {} / {} hits, truncated: {}, es: {:.1f}ms, total: {:.1f}ms{}{}'.format(
+            '    ' * indent, report.name, report.hits, report.total_hits, report.truncated,
+            report.es_took_ms, report.took_ms, ' (timed out)' if report.timed_out else '',
+            ', error: ' + report.error if report.error else '')
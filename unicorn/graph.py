@@ -0,0 +1,299 @@
+"""In-memory graph backend evaluating queries without elasticsearch
+
+Loads a dump of the fields unicorn queries from cirrussearch, one json
+document per line:
+
+    {"title": "Q42", "sitelink_count": 1, "statement_keywords": [...], "labels": {...}}
+
+Titles and edges are interned to integers, adjacency and posting lists
+are stored in arrays.
+"""
+from array import array
+import json
+import threading
+from typing import (
+    Any, Callable, Dict, Iterable, Iterator, List, Mapping,
+    Optional, Sequence, Set, TypeVar, Union)
+
+from unicorn.model import (
+    ApplyNode, BoolNode, ClosureNode, ElasticSort, ExtractNode, NoneNode,
+    Query, QueryNode, Result, TermNode, TermsNode)
+from unicorn.trace import Tracer
+from unicorn.utils import timer
+
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+class GraphIndex:
+    def __init__(self):
+        self.titles: List[str] = []
+        self.title_ids: Dict[str, int] = {}
+        self.sitelink_count = array('l')
+        self.labels: List[Mapping[str, Sequence[str]]] = []
+        # Interned edges (P1=Q1) and edge kinds (P1). As with the
+        # cirrussearch mapping matching is case insensitive.
+        self.edges: List[str] = []
+        self.edge_ids: Dict[str, int] = {}
+        self.kind_ids: Dict[str, int] = {}
+        # Edges of each document, compressed sparse row
+        self.adjacency_offsets = array('l', [0])
+        self.adjacency = array('l')
+        # Documents containing each edge, or edge kind, in load order
+        self.edge_postings: List[array] = []
+        self.kind_postings: List[array] = []
+
+    @classmethod
+    def from_jsonl(cls, path: str) -> 'GraphIndex':
+        with open(path, 'rt') as f:
+            return cls.from_docs(json.loads(line) for line in f if line.strip())
+
+    @classmethod
+    def from_docs(cls, docs: Iterable[Mapping[str, Any]]) -> 'GraphIndex':
+        graph = cls()
+        for doc in docs:
+            graph.add(doc)
+        return graph
+
+    def __len__(self):
+        return len(self.titles)
+
+    def add(self, doc: Mapping[str, Any]) -> None:
+        doc_id = len(self.titles)
+        self.titles.append(doc['title'])
+        self.title_ids[doc['title']] = doc_id
+        self.sitelink_count.append(doc.get('sitelink_count', 0))
+        self.labels.append(doc.get('labels', {}))
+        kinds = set()
+        for edge in doc.get('statement_keywords', []):
+            edge_id = self.intern(edge, self.edge_ids, self.edge_postings)
+            self.adjacency.append(edge_id)
+            self.edge_postings[edge_id].append(doc_id)
+            kinds.add(edge.split('=', 1)[0])
+        for kind in kinds:
+            kind_id = self.intern(kind, self.kind_ids, self.kind_postings)
+            self.kind_postings[kind_id].append(doc_id)
+        self.adjacency_offsets.append(len(self.adjacency))
+
+    def intern(self, value: str, ids: Dict[str, int], postings: List[array]) -> int:
+        key = value.lower()
+        try:
+            return ids[key]
+        except KeyError:
+            ids[key] = len(postings)
+            postings.append(array('l'))
+            if postings is self.edge_postings:
+                self.edges.append(value)
+            return ids[key]
+
+    def with_edge(self, edge: str) -> Sequence[int]:
+        try:
+            return self.edge_postings[self.edge_ids[edge.lower()]]
+        except KeyError:
+            return ()
+
+    def with_kind(self, kind: str) -> Sequence[int]:
+        try:
+            return self.kind_postings[self.kind_ids[kind.lower()]]
+        except KeyError:
+            return ()
+
+    def doc_edges(self, doc_id: int) -> Iterator[str]:
+        start, end = self.adjacency_offsets[doc_id], self.adjacency_offsets[doc_id + 1]
+        for edge_id in self.adjacency[start:end]:
+            yield self.edges[edge_id]
+
+    def es_hit(self, doc_id: int, source: Optional[Sequence[str]]) -> Mapping[str, Any]:
+        """Document formatted as an elasticsearch hit"""
+        doc_source: Dict[str, Any] = {}
+        for field in source or ():
+            if field == 'title':
+                doc_source['title'] = self.titles[doc_id]
+            elif field == 'statement_keywords':
+                doc_source['statement_keywords'] = list(self.doc_edges(doc_id))
+            elif field == 'sitelink_count':
+                doc_source['sitelink_count'] = self.sitelink_count[doc_id]
+            elif field.startswith('labels.'):
+                lang = field[len('labels.'):]
+                if lang in self.labels[doc_id]:
+                    doc_source.setdefault('labels', {})[lang] = self.labels[doc_id][lang]
+        return {'_id': str(doc_id), '_source': doc_source}
+
+
+class GraphQueryExecutor:
+    """Evaluates queries against a GraphIndex
+
+    Mirrors the semantics of BasicQueryBuilder and BasicQueryExecutor,
+    including truncation of inner stages to inner_limit documents.
+    Only sorting by sitelink_count is supported.
+    """
+    def __init__(
+        self,
+        graph: GraphIndex,
+        inner_limit: int = 900,
+        limit: int = 10000,
+        closure_depth: int = 10,
+    ):
+        self.graph = graph
+        self.inner_limit = inner_limit
+        self.closure_depth = closure_depth
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.evaluators: Dict[type, Callable[[Any], Set[int]]] = {
+            ApplyNode: self.eval_apply,
+            BoolNode: self.eval_bool,
+            ClosureNode: self.eval_closure,
+            ExtractNode: self.eval_extract,
+            NoneNode: lambda node: set(),
+            TermNode: self.eval_term,
+            TermsNode: self.eval_terms,
+        }
+        self.clear_counters()
+
+    def clear_counters(self):
+        self.took_ms = 0
+        self.es_took_ms = 0
+        self.response_bytes = 0
+        self.decode_ms = 0.
+        self.truncated = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.timed_out = False
+        self.tracer = Tracer()
+
+    def __call__(
+        self,
+        query_node: Union[Query, QueryNode],
+        sort: ElasticSort,
+        size: int = 10,
+        source: Optional[Sequence[str]] = None,
+    ) -> Result:
+        if isinstance(query_node, Query):
+            raise NotImplementedError('GraphQueryExecutor evaluates QueryNode only')
+        self.check_sort(sort)
+        with timer() as took, self.tracer.span(query_node) as trace:
+            doc_ids = self.eval(query_node)
+            top = self.top(doc_ids, min(size, self.limit))
+            trace.hits = len(top)
+            trace.total_hits = len(doc_ids)
+            trace.truncated = len(doc_ids) - len(top)
+            es_result = {
+                'took': 0,
+                'timed_out': False,
+                'hits': {
+                    'total': len(doc_ids),
+                    'hits': [self.graph.es_hit(doc_id, source) for doc_id in top],
+                },
+            }
+        es_result['took'] = int(took.ms)
+        trace.es_took_ms = took.ms
+        with self.lock:
+            self.took_ms += took.ms
+            self.es_took_ms += took.ms
+            self.truncated += len(doc_ids) - len(top)
+        return Result(es_result, took.ms)
+
+    def pages(
+        self,
+        query_node: Union[Query, QueryNode],
+        sort: ElasticSort,
+        size: int = 10,
+        source: Optional[Sequence[str]] = None,
+    ) -> Iterator[Result]:
+        yield self(query_node, sort, size, source)
+
+    def count(self, query_node: QueryNode) -> int:
+        return len(self.eval(query_node))
+
+    def route(self, query_node: Union[Query, QueryNode]) -> Optional[str]:
+        return None
+
+    def map(self, fn: Callable[[T], R], items: Sequence[T]) -> List[R]:
+        return [fn(item) for item in items]
+
+    @staticmethod
+    def check_sort(sort: ElasticSort) -> None:
+        if sort != {'sitelink_count': {'order': 'desc'}}:
+            raise NotImplementedError('Unsupported sort: {}'.format(sort))
+
+    def top(self, doc_ids: Iterable[int], size: int) -> List[int]:
+        """Document ids sorted by sitelink_count desc, title asc"""
+        sitelinks, titles = self.graph.sitelink_count, self.graph.titles
+        return sorted(doc_ids, key=lambda d: (-sitelinks[d], titles[d]))[:size]
+
+    def inner(self, node: QueryNode, limit: Optional[int]) -> List[int]:
+        """Evaluate an inner stage, truncated as elasticsearch would"""
+        if limit is None:
+            limit = self.inner_limit
+        with timer() as took, self.tracer.span(node) as trace:
+            doc_ids = self.eval(node)
+            top = self.top(doc_ids, min(limit, self.limit))
+            trace.hits = len(top)
+            trace.total_hits = len(doc_ids)
+            trace.truncated = len(doc_ids) - len(top)
+        trace.es_took_ms = took.ms
+        with self.lock:
+            self.truncated += trace.truncated
+        return top
+
+    def eval(self, node: QueryNode) -> Set[int]:
+        return self.evaluators[type(node)](node)
+
+    def eval_term(self, node: TermNode) -> Set[int]:
+        if node.is_edge_query:
+            return set(self.graph.with_edge(node.value))
+        return set(self.graph.with_kind(node.value))
+
+    def eval_terms(self, node: TermsNode) -> Set[int]:
+        doc_ids: Set[int] = set()
+        for value in node.values:
+            doc_ids.update(self.graph.with_edge(value))
+        return doc_ids
+
+    def eval_bool(self, node: BoolNode) -> Set[int]:
+        doc_ids: Set[int]
+        if node.must:
+            doc_ids = set.intersection(*(self.eval(x) for x in node.must))
+        elif node.should:
+            doc_ids = set.union(*(self.eval(x) for x in node.should))
+        elif node.must_not:
+            doc_ids = set(range(len(self.graph)))
+        else:
+            raise Exception('empty bool node')
+        for x in node.must_not:
+            doc_ids -= self.eval(x)
+        return doc_ids
+
+    def eval_apply(self, node: ApplyNode) -> Set[int]:
+        doc_ids: Set[int] = set()
+        for inner_id in self.inner(node.query, node.limit):
+            doc_ids.update(self.graph.with_edge(node.prefix + self.graph.titles[inner_id]))
+        return doc_ids
+
+    def eval_extract(self, node: ExtractNode) -> Set[int]:
+        inner = BoolNode(must=[TermNode(node.key[:-1]), node.query])
+        doc_ids = set()
+        for inner_id in self.inner(inner, node.limit):
+            for edge in self.graph.doc_edges(inner_id):
+                if edge.startswith(node.key):
+                    doc_id = self.graph.title_ids.get(edge[len(node.key):])
+                    if doc_id is not None:
+                        doc_ids.add(doc_id)
+        return doc_ids
+
+    def eval_closure(self, node: ClosureNode) -> Set[int]:
+        budget = self.inner_limit if node.limit is None else node.limit
+        roots = [self.graph.title_ids.get(root) for root in dict.fromkeys(node.roots)]
+        visited = [doc_id for doc_id in roots if doc_id is not None][:budget]
+        seen = set(visited)
+        frontier = visited
+        for _ in range(self.closure_depth):
+            if not frontier or len(visited) >= budget:
+                break
+            level = TermsNode([node.prefix + self.graph.titles[doc_id] for doc_id in frontier])
+            frontier = [doc_id for doc_id in self.inner(level, budget) if doc_id not in seen]
+            seen.update(frontier)
+            frontier = frontier[:budget - len(visited)]
+            visited.extend(frontier)
+        return set(visited)
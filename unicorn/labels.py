@@ -0,0 +1,166 @@
+"""Labels of entities, resolved in bulk and cached per language
+
+Outer searches only fetch ids, their labels are looked up afterwards.
+Labels rarely change, and popular entities are shown over and over,
+most lookups are served from the cache without any request.
+"""
+import asyncio
+from typing import Any, Dict, List, Mapping, Optional, Sequence
+
+from elasticsearch import TransportError
+
+from unicorn.cache import LRUCache
+from unicorn.model import Hit
+
+
+class LabelService:
+    """Resolves labels of entity ids, falling back through languages
+
+    A label in lang is preferred, followed by the languages of
+    fallbacks[lang], then default_fallback. Each language has its own
+    bounded cache, entities known to lack a label in a language are
+    cached as such.
+
+    Labels only decorate results, when the lookup fails or runs out of
+    time the ids without cached labels are returned with ''.
+    """
+    def __init__(
+        self,
+        client: Any,
+        index: str,
+        id_field: str = 'title.keyword',
+        max_entries: int = 100000,
+        ttl_s: float = 3600.,
+        fallbacks: Optional[Mapping[str, Sequence[str]]] = None,
+        default_fallback: Sequence[str] = ('en',),
+    ):
+        """
+        client is an Elasticsearch client for labels, or an AsyncClient
+        for async_labels.
+        """
+        self.client = client
+        self.index = index
+        self.id_field = id_field
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.fallbacks = fallbacks or {}
+        self.default_fallback = default_fallback
+        self.caches: Dict[str, LRUCache] = {}
+
+    def chain(self, lang: str) -> List[str]:
+        """Languages to try, in order, for labels in lang"""
+        return list(dict.fromkeys([lang, *self.fallbacks.get(lang, ()), *self.default_fallback]))
+
+    def cache(self, lang: str) -> LRUCache:
+        # Languages are created on first use, racing threads at worst
+        # replace a fresh cache with another.
+        cache = self.caches.get(lang)
+        if cache is None:
+            cache = self.caches.setdefault(lang, LRUCache(self.max_entries, self.ttl_s))
+        return cache
+
+    def cached(self, ids: Sequence[str], chain: Sequence[str]) -> Dict[str, Dict[str, str]]:
+        """Cached labels of ids in each language of chain, '' when known missing"""
+        found: Dict[str, Dict[str, str]] = {}
+        for lang in chain:
+            cache = self.cache(lang)
+            found[lang] = {}
+            for entity_id in ids:
+                label = cache.get(entity_id)
+                if label is not None:
+                    found[lang][entity_id] = label
+        return found
+
+    def request(self, ids: Sequence[str], chain: Sequence[str]) -> Dict[str, Any]:
+        """Search request for the labels of ids in all languages of chain"""
+        return {
+            'query': {'terms': {self.id_field: list(ids)}},
+            'size': len(ids),
+            '_source': ['title'] + ['labels.' + lang for lang in chain],
+        }
+
+    def store(
+        self,
+        ids: Sequence[str],
+        chain: Sequence[str],
+        es_result: Mapping,
+        found: Dict[str, Dict[str, str]],
+    ) -> None:
+        """Cache labels of the response, and the absence of missing ones"""
+        hits: Dict[str, Hit] = {}
+        for es_hit in es_result['hits'].get('hits', ()):
+            hit = Hit(es_hit)
+            hits[hit.id] = hit
+        for lang in chain:
+            cache = self.cache(lang)
+            for entity_id in ids:
+                label = hits[entity_id].label(lang, '') if entity_id in hits else ''
+                cache.put(entity_id, label)
+                found[lang][entity_id] = label
+
+    @staticmethod
+    def missing(ids: Sequence[str], chain: Sequence[str], found: Mapping[str, Mapping[str, str]]) -> List[str]:
+        """ids that could resolve to a label not yet known"""
+        missing = []
+        for entity_id in dict.fromkeys(ids):
+            for lang in chain:
+                label = found[lang].get(entity_id)
+                if label is None:
+                    missing.append(entity_id)
+                    break
+                if label:
+                    break
+        return missing
+
+    @staticmethod
+    def resolve(ids: Sequence[str], chain: Sequence[str], found: Mapping[str, Mapping[str, str]]) -> Dict[str, str]:
+        labels = {}
+        for entity_id in ids:
+            for lang in chain:
+                label = found[lang].get(entity_id)
+                if label:
+                    labels[entity_id] = label
+                    break
+            else:
+                labels[entity_id] = ''
+        return labels
+
+    def labels(self, ids: Sequence[str], lang: str, timeout_ms: Optional[float] = None) -> Dict[str, str]:
+        """Label of each id, '' when it has none in any fallback
+
+        Cache misses are fetched in a single request, unless no time
+        remains of timeout_ms and only cached labels are returned.
+        """
+        chain = self.chain(lang)
+        found = self.cached(ids, chain)
+        missing = self.missing(ids, chain, found)
+        if missing and (timeout_ms is None or timeout_ms > 0):
+            client_args = {} if timeout_ms is None else {'request_timeout': timeout_ms / 1000}
+            try:
+                es_result = self.client.search(
+                    index=self.index, body=self.request(missing, chain), **client_args)
+            except TransportError:
+                pass
+            else:
+                self.store(missing, chain, es_result, found)
+        return self.resolve(ids, chain, found)
+
+    async def async_labels(self, ids: Sequence[str], lang: str, timeout_ms: Optional[float] = None) -> Dict[str, str]:
+        """Async equivalent of labels"""
+        # aiohttp is only installed with the asgi extra
+        import aiohttp
+        from unicorn.aio import RequestError
+
+        chain = self.chain(lang)
+        found = self.cached(ids, chain)
+        missing = self.missing(ids, chain, found)
+        if missing and (timeout_ms is None or timeout_ms > 0):
+            try:
+                es_result = await self.client.search(
+                    index=self.index, body=self.request(missing, chain),
+                    request_timeout=None if timeout_ms is None else timeout_ms / 1000)
+            except (RequestError, asyncio.TimeoutError, aiohttp.ClientError):
+                pass
+            else:
+                self.store(missing, chain, es_result, found)
+        return self.resolve(ids, chain, found)
@@ -0,0 +1,372 @@
+"""Load testing of the /search endpoint of unicorn.web
+
+A query log is replayed against a running server, either by a fixed
+number of concurrent clients or at a fixed arrival rate:
+
+    unicorn-loadtest --url http://localhost:8000 --concurrency 16 queries.log
+    unicorn-loadtest --url http://localhost:8000 --rate 50 --duration-s 60 queries.log
+
+With --stub the web interface is instead served in-process against a
+stub elasticsearch answering every search after a fixed latency, to
+measure unicorn itself without a cluster. The load generator shares the
+process, compare runs against each other rather than with production:
+
+    unicorn-loadtest --stub --stub-latency-ms 5 --rate 200 queries.log
+
+The log holds expressions as read by unicorn --batch. Lines holding a
+json object are sent as the parameters of /search instead, ex:
+{"q": "P31=Q5", "lang": "de"}.
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import http.client
+from itertools import count, cycle
+import json
+import math
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+from urllib.parse import urlencode, urlsplit
+
+from elasticsearch import ConnectionTimeout
+
+from unicorn.batch import split_expressions
+from unicorn.utils import timer
+
+
+# Server side timings reported in the debug section of /search
+DEBUG_TIMINGS = ['es_took_ms', 'net_took_ms', 'label_ms', 'unicorn_took_ms', 'total_took_ms']
+
+
+def load_log(path: str) -> List[Dict[str, Any]]:
+    """/search parameters of each query in the log at path"""
+    queries = []
+    with open(path, 'rt') as f:
+        for _, expression in split_expressions(f):
+            if expression.startswith('{'):
+                queries.append(json.loads(expression))
+            else:
+                queries.append({'q': expression})
+    if not queries:
+        raise ValueError('No queries in {}'.format(path))
+    return queries
+
+
+class SearchClient:
+    """Issues /search requests over a keep-alive connection per thread"""
+    def __init__(self, url: str, timeout_s: float = 60.):
+        parts = urlsplit(url)
+        self.host = parts.netloc
+        self.path = parts.path.rstrip('/') + '/search'
+        self.https = parts.scheme == 'https'
+        self.timeout_s = timeout_s
+        self.local = threading.local()
+
+    def connection(self) -> http.client.HTTPConnection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            conn = self.local.conn = conn_class(self.host, timeout=self.timeout_s)
+        return conn
+
+    def search(self, params: Mapping[str, Any]) -> Mapping[str, Any]:
+        """Decoded response of /search, raises on errors"""
+        conn = self.connection()
+        try:
+            conn.request('GET', self.path + '?' + urlencode(params), headers={'Accept': 'application/json'})
+            response = conn.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            # Dropped keep-alive connections are reopened by the next request
+            conn.close()
+            raise
+        if response.status != 200:
+            raise RuntimeError('/search responded with status {}'.format(response.status))
+        return json.loads(body)
+
+
+@dataclass
+class Sample:
+    """Outcome of a single request"""
+    latency_ms: float
+    error: Optional[str] = None
+    timed_out: bool = False
+    debug: Dict[str, float] = field(default_factory=dict)
+
+
+def measure(client: SearchClient, params: Mapping[str, Any], started: float) -> Sample:
+    """Send a single request, timing it from started"""
+    try:
+        response = client.search(params)
+    except Exception as e:
+        return Sample((time.monotonic() - started) * 1000, error='{}: {}'.format(type(e).__name__, e))
+    latency_ms = (time.monotonic() - started) * 1000
+    if 'error' in response:
+        return Sample(latency_ms, error=response['error'])
+    debug = response.get('debug') or {}
+    return Sample(
+        latency_ms,
+        timed_out=response.get('timed_out', False),
+        debug={name: debug[name] for name in DEBUG_TIMINGS if name in debug})
+
+
+def run_closed(
+    client: SearchClient,
+    queries: Sequence[Mapping[str, Any]],
+    concurrency: int,
+    requests: int,
+    duration_s: Optional[float] = None,
+) -> List[Sample]:
+    """Replay queries from concurrency clients, each waiting on its previous response"""
+    samples: List[Sample] = []
+    lock = threading.Lock()
+    next_request = count()
+    deadline = None if duration_s is None else time.monotonic() + duration_s
+
+    def worker() -> None:
+        while True:
+            with lock:
+                n = next(next_request)
+            if n >= requests or (deadline is not None and time.monotonic() > deadline):
+                return
+            sample = measure(client, queries[n % len(queries)], time.monotonic())
+            with lock:
+                samples.append(sample)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+
+def run_open(
+    client: SearchClient,
+    queries: Sequence[Mapping[str, Any]],
+    rate: float,
+    requests: int,
+    duration_s: Optional[float] = None,
+    max_in_flight: int = 100,
+) -> List[Sample]:
+    """Replay queries arriving at rate per second, regardless of responses
+
+    Latency is measured from the scheduled arrival of each request, time
+    spent waiting for one of max_in_flight connections is included.
+    """
+    if duration_s is not None:
+        requests = min(requests, int(rate * duration_s))
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        futures = []
+        for n, params in zip(range(requests), cycle(queries)):
+            scheduled = start + n / rate
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(measure, client, params, scheduled))
+        return [future.result() for future in futures]
+
+
+def percentiles(values: Sequence[float]) -> Dict[str, float]:
+    """Nearest rank p50, p95, p99 and max of values"""
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def rank(p: float) -> float:
+        return ordered[max(0, math.ceil(len(ordered) * p / 100) - 1)]
+    return {
+        'p50': rank(50),
+        'p95': rank(95),
+        'p99': rank(99),
+        'max': ordered[-1],
+        'mean': sum(ordered) / len(ordered),
+    }
+
+
+def histogram(values: Sequence[float]) -> List[Tuple[float, int]]:
+    """Count of values up to each power of two ms, from 1ms"""
+    if not values:
+        return []
+    bounds = [1.]
+    largest = max(values)
+    while bounds[-1] < largest:
+        bounds.append(bounds[-1] * 2)
+    counts = [0] * len(bounds)
+    for value in values:
+        counts[next(i for i, bound in enumerate(bounds) if value <= bound)] += 1
+    return list(zip(bounds, counts))
+
+
+def summarize(samples: Sequence[Sample], took_s: float) -> Dict[str, Any]:
+    ok = [sample for sample in samples if sample.error is None]
+    errors: Dict[str, int] = {}
+    for sample in samples:
+        if sample.error is not None:
+            errors[sample.error] = errors.get(sample.error, 0) + 1
+    return {
+        'requests': len(samples),
+        'errors': len(samples) - len(ok),
+        'timed_out': sum(sample.timed_out for sample in ok),
+        'took_s': took_s,
+        'throughput': len(ok) / took_s if took_s else 0.,
+        'latency_ms': percentiles([sample.latency_ms for sample in ok]),
+        'histogram': histogram([sample.latency_ms for sample in ok]),
+        'debug': {
+            name: percentiles([sample.debug[name] for sample in ok if name in sample.debug])
+            for name in DEBUG_TIMINGS
+        },
+        'error_messages': errors,
+    }
+
+
+def format_report(report: Mapping[str, Any]) -> Iterator[str]:
+    yield 'requests: {requests}, errors: {errors}, timed out: {timed_out}, {throughput:.1f} requests/s'.format(
+        **report)
+    columns = ['p50', 'p95', 'p99', 'max', 'mean']
+    yield '{:18s}{}'.format('', ''.join('{:>10s}'.format(column) for column in columns))
+    rows = [('latency_ms', report['latency_ms'])] + list(report['debug'].items())
+    for name, stats in rows:
+        if stats:
+            yield '{:18s}{}'.format(name, ''.join('{:10.1f}'.format(stats[column]) for column in columns))
+    yield 'histogram:'
+    total = max(1, report['requests'] - report['errors'])
+    for bound, n in report['histogram']:
+        yield '    <= {:7.0f}ms {:7d} {}'.format(bound, n, '#' * round(50 * n / total))
+    for message, n in report['error_messages'].items():
+        yield 'error ({}x): {}'.format(n, message)
+
+
+class StubElasticsearch:
+    """Answers every search with generated hits after latency_ms
+
+    Searches match hits documents, lookups by id match the requested
+    ids. Responses have the shape unicorn reads, not realistic content.
+    Requests with a shorter request_timeout time out as the elasticsearch
+    client does.
+    """
+    def __init__(self, latency_ms: float = 5., hits: int = 1000, id_field: str = 'title.keyword'):
+        self.latency_ms = latency_ms
+        self.hits = hits
+        self.id_field = id_field
+
+    def wait(self, request_timeout: Optional[float] = None, **kwargs) -> None:
+        latency_s = self.latency_ms / 1000
+        if request_timeout is not None and request_timeout < latency_s:
+            time.sleep(request_timeout)
+            raise ConnectionTimeout('TIMEOUT', 'Read timed out', None)
+        time.sleep(latency_s)
+
+    def response(self, body: Mapping[str, Any]) -> Dict[str, Any]:
+        terms = body.get('query', {}).get('terms', {})
+        if self.id_field in terms:
+            ids = list(terms[self.id_field])
+            total = len(ids)
+        else:
+            ids = ['Q{}'.format(n) for n in range(1, 1 + min(body.get('size', 10), self.hits))]
+            total = self.hits
+        return {
+            'took': int(self.latency_ms),
+            'timed_out': False,
+            'hits': {
+                'total': total,
+                'hits': [{
+                    '_id': entity_id,
+                    '_source': {
+                        'title': entity_id,
+                        'labels': {'en': ['label ' + entity_id]},
+                        'statement_keywords': ['P31=Q{}'.format(n % 100)],
+                    },
+                    'fields': {self.id_field: [entity_id]},
+                    'sort': [self.hits - n, entity_id],
+                } for n, entity_id in enumerate(ids)],
+            },
+            'aggregations': {name: {'buckets': []} for name in body.get('aggs', {})},
+        }
+
+    def search(self, index: str, body: Mapping[str, Any], **kwargs) -> Mapping[str, Any]:
+        self.wait(**kwargs)
+        return self.response(body)
+
+    def msearch(self, body: Sequence[Mapping[str, Any]], index: Optional[str] = None, **kwargs) -> Mapping[str, Any]:
+        self.wait(**kwargs)
+        return {'took': int(self.latency_ms), 'responses': [self.response(request) for request in body[1::2]]}
+
+
+def serve_stub(latency_ms: float, hits: int) -> str:
+    """Serve unicorn.web against a stub elasticsearch, returning its url"""
+    from socketserver import ThreadingMixIn
+    from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+    # Requires the web extra, only imported when serving
+    import hug
+    from unicorn import web
+
+    stub = StubElasticsearch(latency_ms, hits, web.qb.id_field)
+    web.elastic = stub  # type: ignore
+    web.label_service.client = stub
+
+    class Server(ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+        # Connections refused by a full backlog are retried a second later
+        request_queue_size = 1024
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args) -> None:
+            pass
+
+    app = hug.API(web).http.server()
+    server = make_server('localhost', 0, app, server_class=Server, handler_class=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://localhost:{}'.format(server.server_port)
+
+
+def arg_parser() -> ArgumentParser:
+    parser = ArgumentParser(description='Replay a query log against /search of unicorn.web')
+    parser.add_argument('log', help='Expressions, or json objects of /search parameters')
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Concurrent clients, or with --rate the max requests in flight')
+    parser.add_argument('--rate', type=float, default=None, help='Requests per second, regardless of responses')
+    parser.add_argument('--requests', type=int, default=None, help='Defaults to once through the log')
+    parser.add_argument('--duration-s', type=float, default=None)
+    parser.add_argument('--warmup', type=int, default=10, help='Requests sent before measuring')
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                        help='Added to the parameters of each query, ex: size=20')
+    parser.add_argument('--stub', action='store_true', default=False,
+                        help='Serve unicorn.web in-process against a stub elasticsearch')
+    parser.add_argument('--stub-latency-ms', type=float, default=5.)
+    parser.add_argument('--stub-hits', type=int, default=1000)
+    parser.add_argument('--json', action='store_true', default=False, help='Print the report as json')
+    return parser
+
+
+def main():
+    args = arg_parser().parse_args()
+    extra = dict(param.split('=', 1) for param in args.param)
+    queries = [dict(query, **extra) for query in load_log(args.log)]
+    if args.requests is not None:
+        requests = args.requests
+    elif args.duration_s is not None:
+        requests = sys.maxsize
+    else:
+        requests = len(queries)
+    url = serve_stub(args.stub_latency_ms, args.stub_hits) if args.stub else args.url
+
+    client = SearchClient(url)
+    if args.warmup:
+        run_closed(client, queries, min(args.concurrency, args.warmup), args.warmup)
+    with timer() as took:
+        if args.rate is None:
+            samples = run_closed(client, queries, args.concurrency, requests, args.duration_s)
+        else:
+            samples = run_open(client, queries, args.rate, requests, args.duration_s, args.concurrency)
+    report = summarize(samples, took.ms / 1000)
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        for line in format_report(report):
+            print(line)
+    sys.exit(1 if report['errors'] else 0)
@@ -5,12 +5,14 @@ Must not import any other unicorn files
 from __future__ import annotations
 from dataclasses import dataclass, field
 import enum
-from typing import Any, Mapping, Optional, Protocol, Sequence, Union
+from typing import Any, Callable, Iterable, Iterator, List, Mapping, Optional, Protocol, Sequence, TypeVar, Union
 
 
 # Type helpers
 
 ElasticSort = Union[str, Mapping[str, Any]]
+T = TypeVar('T')
+R = TypeVar('R')
 
 # AST for representing an s-expression
 
@@ -39,6 +41,8 @@ Token = Union[StringToken, ExpressionToken]
 class ApplyNode:
     prefix: str
     query: QueryNode
+    # Max inner results, when None the builder default applies
+    limit: Optional[int] = None
 
 
 @dataclass
@@ -60,10 +64,30 @@ class BoolNode:
     should: Sequence[QueryNode] = field(default_factory=list)
 
 
+@dataclass
+class ClosureNode:
+    """Represents the roots and all entities reachable from them
+
+    Entities are reached by following prefix edges backwards, ex: with
+    P279= all transitive subclasses of the roots.
+    """
+    prefix: str
+    roots: Sequence[str]
+    # Max entities in the closure, when None the builder default applies
+    limit: Optional[int] = None
+
+
 @dataclass
 class ExtractNode:
     key: str
     query: QueryNode
+    # Max inner results, when None the builder default applies
+    limit: Optional[int] = None
+
+
+@dataclass
+class NoneNode:
+    """Represents a query that can never match"""
 
 
 @dataclass
@@ -84,15 +108,94 @@ class TermNode:
         return '=' in self.value
 
 
-QueryNode = Union[ApplyNode, BoolNode, ExtractNode, TermNode]
+@dataclass
+class TermsNode:
+    """Represents a query for any of several exact graph edges
+
+    Equivalent to an or of edge term queries (ex: P31=Q1, P31=Q2),
+    but can be issued to elasticsearch as a single clause.
+    """
+    values: Sequence[str]
+
+
+QueryNode = Union[ApplyNode, BoolNode, ClosureNode, ExtractNode, NoneNode, TermNode, TermsNode]
+
+
+def canonical(node: QueryNode) -> tuple:
+    """Hashable representation of node, insensitive to bool child order"""
+    if isinstance(node, TermNode):
+        return ('term', node.value)
+    elif isinstance(node, TermsNode):
+        return ('terms', tuple(sorted(set(node.values))))
+    elif isinstance(node, NoneNode):
+        return ('none',)
+    elif isinstance(node, ApplyNode):
+        return ('apply', node.prefix, canonical(node.query), node.limit)
+    elif isinstance(node, ExtractNode):
+        return ('extract', node.key, canonical(node.query), node.limit)
+    elif isinstance(node, ClosureNode):
+        return ('closure', node.prefix, tuple(sorted(set(node.roots))), node.limit)
+    elif isinstance(node, BoolNode):
+        def children(nodes: Sequence[QueryNode]) -> tuple:
+            return tuple(sorted((canonical(x) for x in nodes), key=repr))
+        return ('bool', children(node.must), children(node.must_not), children(node.should))
+    else:
+        raise NotImplementedError('Unreachable')
 
 
 # Query execution phase
 
+class IdSet:
+    """Set of entity ids (ex: Q42) held as integers
+
+    Allows combining intermediate results locally using C level
+    set operations instead of sending them back to elasticsearch.
+    """
+    __slots__ = ('ids',)
+
+    def __init__(self, ids: Iterable[int]):
+        self.ids = frozenset(ids)
+
+    @classmethod
+    def from_titles(cls, titles: Iterable[str]) -> Optional[IdSet]:
+        """Parse titles into an IdSet, or None if any are not items"""
+        ids = []
+        for title in titles:
+            if not title.startswith('Q') or not title[1:].isdigit():
+                return None
+            ids.append(int(title[1:]))
+        return cls(ids)
+
+    def titles(self) -> List[str]:
+        return ['Q{}'.format(i) for i in sorted(self.ids)]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __eq__(self, other):
+        return isinstance(other, IdSet) and self.ids == other.ids
+
+    def __and__(self, other: IdSet) -> IdSet:
+        return IdSet(self.ids & other.ids)
+
+    def __or__(self, other: IdSet) -> IdSet:
+        return IdSet(self.ids | other.ids)
+
+    def __sub__(self, other: IdSet) -> IdSet:
+        return IdSet(self.ids - other.ids)
+
+    def __repr__(self):
+        return 'IdSet(<{} ids>)'.format(len(self.ids))
+
+
 @dataclass
 class Query:
     es_query: Mapping
-    hit_ids: Optional[Sequence[str]] = None
+    hit_ids: Optional[IdSet] = None
+    # Aggregations requested along with the query
+    aggs: Optional[Mapping] = None
+    # Index to search instead of the executor default
+    index: Optional[str] = None
 
 
 # sigil default arg value indicating no value passed. allows
@@ -100,14 +203,44 @@ class Query:
 no_arg = object()
 
 
-@dataclass
+def hit_id(es_hit: Mapping[str, Any], id_field: str = 'title.keyword') -> str:
+    try:
+        return es_hit['_source']['title']
+    except KeyError:
+        # Requested from the id_field doc values instead of source
+        return es_hit['fields'][id_field][0]
+
+
 class Hit:
-    # TODO: what is type?
-    es_hit: Any
+    """View of a single elasticsearch hit
+
+    Fields are read from the underlying response on request, the
+    response is never copied.
+    """
+    __slots__ = ('es_hit', 'id_field', '_id')
+
+    def __init__(self, es_hit: Any, id_field: str = 'title.keyword'):
+        # TODO: what is type?
+        self.es_hit = es_hit
+        self.id_field = id_field
+        self._id: Optional[str] = None
+
+    def __repr__(self):
+        return 'Hit({!r})'.format(self.es_hit)
+
+    def __eq__(self, other):
+        return isinstance(other, Hit) and self.es_hit == other.es_hit
 
     @property
-    def id(self):
-        return self.es_hit['_source']['title']
+    def id(self) -> str:
+        if self._id is None:
+            self._id = hit_id(self.es_hit, self.id_field)
+        return self._id
+
+    @property
+    def backend(self) -> Optional[str]:
+        """Name of the federated backend the hit came from, if any"""
+        return self.es_hit.get('_backend')
 
     @property
     def edges(self) -> Sequence[str]:
@@ -131,19 +264,79 @@ class Hit:
             return default
 
 
-@dataclass
 class Result:
-    # TODO: what is type?
-    es_result: Any
-    took_ms: float
+    """View of an elasticsearch search response
+
+    Hits and ids are materialized once, on first access. Stages
+    that only need ids should prefer ids over hits.
+    """
+    __slots__ = ('es_result', 'took_ms', 'id_field', 'inner_truncated', '_hits', '_ids')
+
+    def __init__(self, es_result: Any, took_ms: float, id_field: str = 'title.keyword'):
+        """
+        id_field is the doc value field titles were requested from in
+        place of _source, if any.
+        """
+        # TODO: what is type?
+        self.es_result = es_result
+        self.took_ms = took_ms
+        self.id_field = id_field
+        # Hits truncated by the stages nested in the query of this
+        # result, kept along with it in the stage cache.
+        self.inner_truncated = 0
+        self._hits: Optional[Sequence[Hit]] = None
+        self._ids: Optional[Sequence[str]] = None
+
+    def __repr__(self):
+        return 'Result(<{} of {} hits>, took_ms={!r})'.format(
+            self.num_hits, self.total_hits, self.took_ms)
+
+    @classmethod
+    def concat(cls, results: Sequence[Result]) -> Result:
+        """Combine consecutive pages of a single query"""
+        first = results[0].es_result
+        return cls({
+            'took': sum(r.es_result['took'] for r in results),
+            'timed_out': any(r.es_result.get('timed_out', False) for r in results),
+            'hits': {
+                'total': first['hits']['total'],
+                'hits': [hit for r in results for hit in r.es_hits],
+            },
+        }, sum(r.took_ms for r in results), results[0].id_field)
 
     @property
     def es_took_ms(self):
         return self.es_result['took']
 
+    @property
+    def es_hits(self) -> Sequence[Mapping[str, Any]]:
+        # Omitted from responses filtered with filter_path when empty
+        return self.es_result['hits'].get('hits', ())
+
     @property
     def hits(self) -> Sequence[Hit]:
-        return [Hit(hit) for hit in self.es_result['hits']['hits']]
+        if self._hits is None:
+            self._hits = tuple(Hit(hit, self.id_field) for hit in self.es_hits)
+        return self._hits
+
+    @property
+    def ids(self) -> Sequence[str]:
+        if self._ids is None:
+            self._ids = tuple(hit_id(hit, self.id_field) for hit in self.es_hits)
+        return self._ids
+
+    @property
+    def aggregations(self) -> Mapping[str, Any]:
+        return self.es_result.get('aggregations', {})
+
+    @property
+    def aggregations_truncated(self) -> int:
+        """Documents of the terms left out of bucket aggregations"""
+        return sum(agg.get('sum_other_doc_count', 0) for agg in self.aggregations.values())
+
+    @property
+    def num_hits(self) -> int:
+        return len(self.es_hits)
 
     @property
     def total_hits(self) -> int:
@@ -151,8 +344,12 @@ class Result:
 
     @property
     def truncated(self):
-        return self.es_result['hits']['total'] \
-                - len(self.es_result['hits']['hits'])
+        return self.es_result['hits']['total'] - self.num_hits
+
+    @property
+    def timed_out(self) -> bool:
+        """Elasticsearch returned partial hits on reaching its timeout"""
+        return self.es_result.get('timed_out', False)
 
 
 class QueryBuilder(Protocol):
@@ -171,3 +368,29 @@ class QueryExecutor(Protocol):
         size: int = ...,
         source: Optional[Sequence[str]] = ...,
     ) -> Result: ...
+
+    def pages(
+        self,
+        query_node: Union[Query, QueryNode],
+        sort: ElasticSort,
+        size: int = ...,
+        source: Optional[Sequence[str]] = ...,
+    ) -> Iterator[Result]:
+        """Execute query, yielding results as each page arrives"""
+        ...
+
+    def map(
+        self,
+        fn: Callable[[T], R],
+        items: Sequence[T],
+    ) -> List[R]:
+        """Apply fn to independent items, possibly concurrently"""
+        ...
+
+    def count(self, query_node: QueryNode) -> int:
+        """Number of documents matching query_node"""
+        ...
+
+    def route(self, query_node: Union[Query, QueryNode]) -> Optional[str]:
+        """Index searched for query_node, None when there is only one"""
+        ...
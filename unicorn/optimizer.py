@@ -0,0 +1,195 @@
+"""Rewrite parsed queries into cheaper equivalents
+
+Runs between parsing and query building. Every node removed here
+saves a clause in a request, or a full round trip to elasticsearch
+when it removes an apply or extract.
+"""
+from dataclasses import replace
+from typing import Callable, Dict, List, Optional, Sequence, Type, TypeVar
+
+from unicorn.model import (
+    ApplyNode, BoolNode, ClosureNode, ExtractNode, NoneNode,
+    QueryNode, TermNode, TermsNode, canonical)
+
+
+T = TypeVar('T', bound=Callable)
+optimizers: Dict[Type, Callable] = {}
+
+
+def register(type: Type):
+    def wrapper(fn: T) -> T:
+        optimizers[type] = fn
+        return fn
+    return wrapper
+
+
+def optimize(node: QueryNode) -> QueryNode:
+    """Rewrite node until no further rewrites apply"""
+    while True:
+        optimized = optimizers[type(node)](node)
+        if canonical(optimized) == canonical(node):
+            return optimized
+        node = optimized
+
+
+@register(NoneNode)
+@register(TermNode)
+def optimize_leaf(node: QueryNode) -> QueryNode:
+    return node
+
+
+@register(TermsNode)
+def optimize_terms(node: TermsNode) -> QueryNode:
+    values = dedupe_values(node.values)
+    if len(values) == 1:
+        return TermNode(values[0])
+    return TermsNode(values)
+
+
+@register(ApplyNode)
+def optimize_apply(node: ApplyNode) -> QueryNode:
+    query = optimize(node.query)
+    if isinstance(query, NoneNode):
+        return NoneNode()
+    return replace(node, query=query)
+
+
+@register(ExtractNode)
+def optimize_extract(node: ExtractNode) -> QueryNode:
+    query = optimize(node.query)
+    if isinstance(query, NoneNode):
+        return NoneNode()
+    return replace(node, query=query)
+
+
+@register(ClosureNode)
+def optimize_closure(node: ClosureNode) -> QueryNode:
+    return replace(node, roots=dedupe_values(node.roots))
+
+
+@register(BoolNode)
+def optimize_bool(node: BoolNode) -> QueryNode:
+    must = [optimize(x) for x in node.must]
+    must_not = [optimize(x) for x in node.must_not]
+    should = [optimize(x) for x in node.should]
+
+    # Flatten nested bools of the same kind. Only should-only bools
+    # are flattened into should, elasticsearch treats should as
+    # optional scoring when must is also present.
+    flat_must: List[QueryNode] = []
+    for x in must:
+        if isinstance(x, BoolNode) and not x.should:
+            flat_must.extend(x.must)
+            must_not.extend(x.must_not)
+        else:
+            flat_must.append(x)
+    must = flat_must
+    if not must:
+        should = flatten_should(should)
+    # not a and not b == not (a or b)
+    must_not = flatten_should(must_not)
+
+    must = dedupe(must)
+    must_not = [x for x in dedupe(must_not) if not isinstance(x, NoneNode)]
+    should = dedupe(should)
+
+    if any(isinstance(x, NoneNode) for x in must):
+        return NoneNode()
+    if {canonical(x) for x in must} & {canonical(x) for x in must_not}:
+        # a and not a
+        return NoneNode()
+    if should and not must:
+        should = [x for x in should if not isinstance(x, NoneNode)]
+        if not should and not must_not:
+            return NoneNode()
+        should = merge_terms(should)
+        if len(should) == 1 and not must_not:
+            return should[0]
+        if not must_not:
+            hoisted = hoist_common(should)
+            if hoisted is not None:
+                return hoisted
+    must_not = merge_terms(must_not)
+
+    if len(must) == 1 and not must_not and not should:
+        return must[0]
+    if not (must or must_not or should):
+        # Everything excluded was impossible, nothing is excluded.
+        return BoolNode(must_not=[NoneNode()])
+    return BoolNode(must=must, must_not=must_not, should=should)
+
+
+def flatten_should(nodes: Sequence[QueryNode]) -> List[QueryNode]:
+    flat: List[QueryNode] = []
+    for x in nodes:
+        if isinstance(x, BoolNode) and not x.must and not x.must_not:
+            flat.extend(x.should)
+        else:
+            flat.append(x)
+    return flat
+
+
+def dedupe(nodes: Sequence[QueryNode]) -> List[QueryNode]:
+    seen = set()
+    unique = []
+    for x in nodes:
+        key = canonical(x)
+        if key not in seen:
+            seen.add(key)
+            unique.append(x)
+    return unique
+
+
+def dedupe_values(values: Sequence[str]) -> List[str]:
+    return list(dict.fromkeys(values))
+
+
+def merge_terms(nodes: Sequence[QueryNode]) -> List[QueryNode]:
+    """Merge edge term queries of an or into a single terms lookup"""
+    values: List[str] = []
+    rest = []
+    for x in nodes:
+        if isinstance(x, TermNode) and x.is_edge_query:
+            values.append(x.value)
+        elif isinstance(x, TermsNode):
+            values.extend(x.values)
+        else:
+            rest.append(x)
+    if len(values) < 2:
+        return list(nodes)
+    return [TermsNode(dedupe_values(values))] + rest
+
+
+def hoist_common(should: Sequence[QueryNode]) -> Optional[QueryNode]:
+    """Hoist term filters shared by every branch of an or
+
+    (or (and a b) (and a c)) becomes (and a (or b c)).
+    """
+    def musts(x: QueryNode) -> Sequence[QueryNode]:
+        if isinstance(x, BoolNode):
+            return x.must
+        return [x]
+
+    def is_term(x: QueryNode) -> bool:
+        return isinstance(x, (TermNode, TermsNode))
+
+    common = None
+    for x in should:
+        if isinstance(x, BoolNode) and x.should:
+            return None
+        keys = {canonical(y) for y in musts(x) if is_term(y)}
+        common = keys if common is None else common & keys
+        if not common:
+            return None
+    assert common is not None
+
+    hoisted = [y for y in musts(should[0]) if canonical(y) in common]
+    branches: List[QueryNode] = []
+    for x in should:
+        rest = [y for y in musts(x) if canonical(y) not in common]
+        rest_not = x.must_not if isinstance(x, BoolNode) else []
+        if not rest and not rest_not:
+            # (or a (and a b)) == a
+            return hoisted[0] if len(hoisted) == 1 else BoolNode(must=hoisted)
+        branches.append(BoolNode(must=rest, must_not=rest_not))
+    return BoolNode(must=hoisted + [BoolNode(should=branches)])
@@ -4,7 +4,7 @@ from typing import Dict, Optional, Protocol, Sequence, TypeVar
 
 from unicorn.model import (
     # unicorn query
-    ApplyNode, BoolKind, BoolNode, ExtractNode,
+    ApplyNode, BoolKind, BoolNode, ClosureNode, ExtractNode,
     QueryNode, TermNode,
     # sexpr
     Token, ExpressionToken, StringToken)
@@ -108,6 +108,18 @@ def visit_extract(args: Sequence[Token]) -> ExtractNode:
     return ExtractNode(key.value, parse(query))
 
 
+@expr_visitors.register('closure')
+def visit_closure(args: Sequence[Token]) -> ClosureNode:
+    if len(args) < 2:
+        raise ParseError('closure requires a prefix and at least one root')
+    if not all(isinstance(arg, StringToken) for arg in args):
+        raise ParseError('arguments to closure must be strings')
+    prefix, *roots = [arg.value for arg in args if isinstance(arg, StringToken)]
+    if not prefix.endswith('='):
+        raise ParseError('first argument to closure must be an edge prefix, ex: P279=')
+    return ClosureNode(prefix, roots)
+
+
 @expr_visitors.register('difference')
 def visit_difference(args: Sequence[Token]) -> BoolNode:
     if len(args) < 2:
@@ -0,0 +1,88 @@
+"""Compiled query plans, cached by expression text
+
+Expressions may contain positional placeholders, $1, $2, ..., within
+any string. All bindings of an expression share one compiled plan:
+
+    query = prepare('(extract P127= (or P31=$1 (apply P31= P279=$1)))', ['Q16917'])
+
+Compiled plans are shared between callers and must not be modified.
+"""
+from dataclasses import replace
+import re
+from typing import Sequence
+
+from unicorn import optimizer, parser, sexpr
+from unicorn.cache import LRUCache
+from unicorn.model import (
+    ApplyNode, BoolNode, ClosureNode, ExtractNode, NoneNode,
+    QueryNode, TermNode, TermsNode)
+
+
+placeholder_regex = re.compile(r'\$(\d+)')
+# Plans don't go stale, only the number of distinct expressions is bounded
+plans = LRUCache(max_entries=1000, ttl_s=float('inf'))
+
+
+def normalize(expression: str) -> str:
+    """Expression text with insignificant whitespace removed"""
+    if '"' in expression:
+        # Whitespace within quoted strings is significant
+        return expression.strip()
+    return ' '.join(expression.split())
+
+
+def compile_plan(expression: str, optimize: bool = True) -> QueryNode:
+    """Parsed, and optionally optimized, plan of expression"""
+    key = (normalize(expression), optimize)
+    plan = plans.get(key)
+    if plan is None:
+        plan = parser.parse(sexpr.parse(key[0]))
+        if optimize:
+            plan = optimizer.optimize(plan)
+        plans.put(key, plan)
+    return plan
+
+
+def bind(node: QueryNode, params: Sequence[str]) -> QueryNode:
+    """Copy of node with each placeholder $n replaced by params[n-1]"""
+    def sub(value: str) -> str:
+        if '$' not in value:
+            return value
+        return placeholder_regex.sub(lambda match: param(int(match.group(1))), value)
+
+    def param(n: int) -> str:
+        if not 0 < n <= len(params):
+            raise parser.ParseError('no value provided for placeholder ${}'.format(n))
+        return params[n - 1]
+
+    if isinstance(node, TermNode):
+        return TermNode(sub(node.value))
+    elif isinstance(node, TermsNode):
+        return TermsNode([sub(value) for value in node.values])
+    elif isinstance(node, NoneNode):
+        return node
+    elif isinstance(node, ApplyNode):
+        return replace(node, prefix=sub(node.prefix), query=bind(node.query, params))
+    elif isinstance(node, ExtractNode):
+        return replace(node, key=sub(node.key), query=bind(node.query, params))
+    elif isinstance(node, ClosureNode):
+        return replace(node, prefix=sub(node.prefix), roots=[sub(root) for root in node.roots])
+    elif isinstance(node, BoolNode):
+        return BoolNode(
+            must=[bind(x, params) for x in node.must],
+            must_not=[bind(x, params) for x in node.must_not],
+            should=[bind(x, params) for x in node.should])
+    else:
+        raise NotImplementedError('Unreachable')
+
+
+def prepare(expression: str, params: Sequence[str] = (), optimize: bool = True) -> QueryNode:
+    """Plan of expression bound to params, compiling it on first use
+
+    Raises ParseError when a placeholder has no value. Values without a
+    placeholder are ignored, a batch shares params between expressions.
+    """
+    plan = compile_plan(expression, optimize)
+    if '$' not in expression:
+        return plan
+    return bind(plan, params)
@@ -1,15 +1,28 @@
 """Build elasticsearch queries from query language"""
 from __future__ import annotations
-from typing import Callable, Dict, Mapping, Sequence, Type, TypeVar
+from copy import copy
+from dataclasses import replace
+from functools import reduce
+import operator
+from typing import Any, Callable, Dict, List, Mapping, Optional, Sequence, Type, TypeVar, Union
 from unicorn.model import (
-    Query, QueryBuilder, QueryExecutor, QueryNode,
-    ApplyNode, BoolNode, ExtractNode, TermNode,
+    IdSet, Query, QueryBuilder, QueryExecutor, QueryNode,
+    ApplyNode, BoolNode, ClosureNode, ExtractNode, NoneNode, TermNode, TermsNode,
     ElasticSort,
 )
 
 
 T = TypeVar('T', bound=Callable)
 
+# BasicQueryBuilder arguments for wikibase cirrussearch indices
+CIRRUS_FIELDS: Dict[str, Any] = {
+    'id_source': 'title',
+    'id_field': 'title.keyword',
+    'edge_field': 'statement_keywords',
+    'edge_kind_field': 'statement_keywords.property',
+    'sort': {'sitelink_count': {'order': 'desc'}},
+}
+
 
 class ExactTypeDispatch:
     def __init__(self, fns: Dict[Type, Callable] = None):
@@ -47,7 +60,24 @@ class BasicQueryBuilder:
         edge_kind_field: str,
         sort: ElasticSort,
         inner_limit: int = 900,
+        lowercase_edges: bool = True,
+        max_terms: int = 1024,
+        local_threshold: Optional[int] = None,
+        extract_strategy: str = 'source',
+        closure_depth: int = 10,
     ):
+        """
+        extract_strategy selects how extract collects edge targets.
+        With 'source' the edges of the top inner_limit inner hits are
+        fetched and filtered locally. With 'aggregation' a terms
+        aggregation over all inner hits returns only the targets, up
+        to inner_limit of those shared by the most inner hits.
+
+        closure expands at most closure_depth levels below its roots,
+        and no more than inner_limit entities.
+        """
+        if extract_strategy not in ('source', 'aggregation'):
+            raise ValueError('Unknown extract_strategy: {}'.format(extract_strategy))
         self.id_source = id_source
         self.id_field = id_field
         self.edge_field = edge_field
@@ -55,90 +85,227 @@ class BasicQueryBuilder:
         self.build = self.dispatch.using(self, sort)
         self.sort = sort
         self.inner_limit = inner_limit
+        self.lowercase_edges = lowercase_edges
+        self.max_terms = max_terms
+        self.local_threshold = local_threshold
+        self.extract_strategy = extract_strategy
+        self.closure_depth = closure_depth
 
     def __call__(self, node: QueryNode, qe: QueryExecutor) -> Query:
         return self.build(node, qe)
 
+    def limited(self, inner_limit: int) -> BasicQueryBuilder:
+        """Copy of this builder with a different inner_limit"""
+        qb = copy(self)
+        qb.inner_limit = inner_limit
+        qb.build = qb.dispatch.using(qb, qb.sort)
+        return qb
+
+    def stage_limit(self, node: Union[ApplyNode, ClosureNode, ExtractNode]) -> int:
+        return self.inner_limit if node.limit is None else node.limit
+
+    def terms(self, field: str, values: Sequence[str]) -> Mapping:
+        """Query matching any of the provided values in field
+
+        Values are deduplicated, and split into chunks of max_terms
+        when necessary to stay within the elasticsearch clause limit.
+        """
+        values = list(dict.fromkeys(values))
+        if not values:
+            return {'match_none': {}}
+        chunks = [
+            {'terms': {field: values[i:i + self.max_terms]}}
+            for i in range(0, len(values), self.max_terms)
+        ]
+        if len(chunks) == 1:
+            return chunks[0]
+        return {'bool': {'should': chunks}}
+
+    def edge_terms(self, edges: Sequence[str]) -> Mapping:
+        """Query matching any of the provided edges
+
+        Unlike match, terms skips analysis. The cirrussearch mapping
+        lowercases edges, and lowercase_edges should match it.
+        """
+        if self.lowercase_edges:
+            edges = [edge.lower() for edge in edges]
+        return self.terms(self.edge_field, edges)
+
     @dispatch.register(ApplyNode)
     def build_apply(self, node: ApplyNode, qe: QueryExecutor) -> Query:
-        results = qe(
+        pages = qe.pages(
             node.query,
-            size=self.inner_limit,
+            size=self.stage_limit(node),
             source=[self.id_source],
             sort=self.sort,
         )
-        return Query({
-            'bool': {
-                # TODO: search analyzer that can split on spaces only
-                'should': [{
-                    'match': {
-                        self.edge_field: {
-                            'query': node.prefix + hit.id
-                        }
-                    }
-                } for hit in results.hits]
-            }
-        })
+        edges = [node.prefix + hit_id for page in pages for hit_id in page.ids]
+        return Query(self.edge_terms(edges))
 
     @dispatch.register(BoolNode)
     def build_bool(self, node: BoolNode, qe: QueryExecutor) -> Query:
-        def build(queries: Sequence[QueryNode]) -> Sequence[Mapping]:
-            return [self.build(q, qe).es_query for q in queries]
-
-        queries = {}
-        if node.must:
-            queries['must'] = build(node.must)
-        if node.must_not:
-            queries['must_not'] = build(node.must_not)
-        if node.should:
-            queries['should'] = build(node.should)
-        if not queries:
+        # Sibling subtrees are independent, build them all in a single
+        # fan out so the executor can run their inner stages concurrently.
+        clauses = [
+            (kind, child)
+            for kind, children in (
+                ('must', node.must),
+                ('must_not', node.must_not),
+                ('should', node.should))
+            for child in children
+        ]
+        if not clauses:
             raise Exception('empty bool node')
+        built = qe.map(lambda clause: self.build(clause[1], qe), clauses)
+
+        if self.local_threshold is not None and any(q.hit_ids is not None for q in built):
+            local = self.build_bool_locally(node, built, qe)
+            if local is not None:
+                return local
+
+        queries: Dict[str, List[Mapping]] = {}
+        for (kind, _), query in zip(clauses, built):
+            queries.setdefault(kind, []).append(query.es_query)
         return Query({'bool': queries})
 
+    def build_bool_locally(
+        self,
+        node: BoolNode,
+        built: Sequence[Query],
+        qe: QueryExecutor,
+    ) -> Optional[Query]:
+        """Evaluate bool node with set operations on local id sets
+
+        Children without local ids are fetched when they match no more
+        than local_threshold documents. Returns None when the node must
+        be evaluated by elasticsearch.
+        """
+        if not node.must and not node.should:
+            # Set of all documents is not available locally
+            return None
+        assert self.local_threshold is not None
+        id_sets = []
+        for query in built:
+            if query.hit_ids is None:
+                # Count before fetching, hits left out of a truncated
+                # fetch would be reported as truncated by the executor.
+                if qe(query, size=0, sort=self.sort).total_hits > self.local_threshold:
+                    return None
+                result = qe(
+                    query,
+                    size=self.local_threshold,
+                    source=[self.id_source],
+                    sort=self.sort,
+                )
+                if result.truncated:
+                    # Grew since it was counted
+                    return None
+                id_set = IdSet.from_titles(result.ids)
+                if id_set is None:
+                    return None
+                id_sets.append(id_set)
+            else:
+                id_sets.append(query.hit_ids)
+
+        must = id_sets[:len(node.must)]
+        must_not = id_sets[len(node.must):len(node.must) + len(node.must_not)]
+        should = id_sets[len(node.must) + len(node.must_not):]
+        if must:
+            hit_ids = reduce(operator.and_, must)
+        else:
+            hit_ids = reduce(operator.or_, should)
+        for id_set in must_not:
+            hit_ids -= id_set
+        return Query(self.terms(self.id_field, hit_ids.titles()), hit_ids)
+
     @dispatch.register(ExtractNode)
     def build_extract(self, node: ExtractNode, qe: QueryExecutor) -> Query:
         # TODO: Should parsing provide this structure?
-        es_query = {
-            'bool': {
-                'must': [
-                    {
-                        'match': {
-                            self.edge_kind_field: node.key[:-1]
-                        }
-                    },
-                    self.build(node.query, qe).es_query,
-                ]
-            }
-        }
+        inner = BoolNode(must=[TermNode(node.key[:-1]), node.query])
 
+        if self.extract_strategy == 'aggregation':
+            hit_ids = self.aggregate_targets(node, inner, qe)
+        else:
+            hit_ids = self.source_targets(node, inner, qe)
+        return Query(self.terms(self.id_field, hit_ids), IdSet.from_titles(hit_ids))
+
+    def source_targets(self, node: ExtractNode, inner: QueryNode, qe: QueryExecutor) -> List[str]:
         # TODO: Executor needs to specialize on ExtractNode and
         # ApplyNode, or the queries will be silly inefficient.
-        # Maybe an early transformation pass should do something.
-        results = qe(
-            Query(es_query),
-            size=self.inner_limit,
+        pages = qe.pages(
+            inner,
+            size=self.stage_limit(node),
             source=[self.edge_field],
             sort=self.sort,
         )
-        hit_ids = []
-        for hit in results.hits:
-            for edge in hit.edges:
-                if edge.startswith(node.key):
-                    hit_ids.append(edge[len(node.key):])
-        if not hit_ids:
-            return Query({'match_none': {}})
-
-        es_query = {
-            'bool': {
-                # TODO: search analyzer that can split on spaces only
-                'should': [{
-                    'match': {self.id_field: hit_id}
-                } for hit_id in hit_ids]
-            }
-        }
-
-        return Query(es_query, hit_ids)
+        # Many hits can share an edge, dedupe keeping the
+        # order of first appearance.
+        return list(dict.fromkeys(
+            edge[len(node.key):]
+            for page in pages
+            for hit in page.hits
+            for edge in hit.edges
+            if edge.startswith(node.key)))
+
+    def aggregate_targets(self, node: ExtractNode, inner: QueryNode, qe: QueryExecutor) -> List[str]:
+        key = node.key.lower() if self.lowercase_edges else node.key
+        query = replace(self(inner, qe), index=qe.route(inner), aggs={
+            'targets': {
+                'terms': {
+                    'field': self.edge_field,
+                    'include': regex_escape(key) + '.*',
+                    'size': self.stage_limit(node),
+                },
+            },
+        })
+        result = qe(query, size=0, sort=self.sort)
+        # Buckets are ordered by the number of inner hits sharing the
+        # edge, most shared first. The executor reports the inner hits
+        # of targets beyond the size, sum_other_doc_count, as truncated.
+        # Unresolved results of multi-search rounds have no aggregations.
+        buckets = result.aggregations.get('targets', {}).get('buckets', [])
+        targets = [bucket['key'][len(key):] for bucket in buckets]
+        if self.lowercase_edges:
+            # Entity ids are upper case, the edge field normalizer
+            # lowercases the aggregated values.
+            targets = [target.upper() for target in targets]
+        return targets
+
+    @dispatch.register(ClosureNode)
+    def build_closure(self, node: ClosureNode, qe: QueryExecutor) -> Query:
+        hit_ids = self.closure(node, qe)
+        return Query(self.terms(self.id_field, hit_ids), IdSet.from_titles(hit_ids))
+
+    def closure(self, node: ClosureNode, qe: QueryExecutor) -> List[str]:
+        """Roots and the entities reachable from them, breadth first
+
+        Each level is a single request for everything with an edge to
+        the previous level. Levels are plain terms stages, repeated
+        expansions of a hierarchy are served by the stage cache.
+        """
+        budget = self.stage_limit(node)
+        visited = list(dict.fromkeys(node.roots))[:budget]
+        seen = set(visited)
+        frontier = visited
+        for _ in range(self.closure_depth):
+            if not frontier or len(visited) >= budget:
+                break
+            pages = qe.pages(
+                TermsNode([node.prefix + hit_id for hit_id in frontier]),
+                size=budget,
+                source=[self.id_source],
+                sort=self.sort,
+            )
+            frontier = []
+            for page in pages:
+                for hit_id in page.ids:
+                    if hit_id not in seen:
+                        seen.add(hit_id)
+                        frontier.append(hit_id)
+            # Most linked first, as with any other stage
+            frontier = frontier[:budget - len(visited)]
+            visited.extend(frontier)
+        return visited
 
     @dispatch.register(TermNode)
     def build_term(self, node: TermNode, qe: QueryExecutor) -> Query:
@@ -149,3 +316,16 @@ class BasicQueryBuilder:
         return Query({
             'match': {field: node.value}
         })
+
+    @dispatch.register(TermsNode)
+    def build_terms(self, node: TermsNode, qe: QueryExecutor) -> Query:
+        return Query(self.edge_terms(node.values))
+
+    @dispatch.register(NoneNode)
+    def build_none(self, node: NoneNode, qe: QueryExecutor) -> Query:
+        return Query({'match_none': {}})
+
+
+def regex_escape(value: str) -> str:
+    """Escape value for use in a lucene regular expression"""
+    return ''.join('\\' + c if c in '.?+*|{}[]()"\\#@&<>~' else c for c in value)
@@ -1,10 +1,37 @@
-from elasticsearch import Elasticsearch
+import asyncio
+from concurrent.futures import Executor, Future, TimeoutError
+from contextlib import contextmanager
+import copy
+from elasticsearch import ConnectionTimeout, Elasticsearch
+import json
 from pprint import pprint
-from typing import Optional, Sequence, Union
+import threading
+import time
+from typing import (
+    Any, Awaitable, Callable, Dict, Generator, Hashable, Iterator, List, Mapping,
+    Optional, Sequence, Set, Tuple, TYPE_CHECKING, TypeVar, Union)
 
-from unicorn.model import ElasticSort, Query, QueryBuilder, QueryNode, Result
+from unicorn.cache import Cache
+from unicorn.model import (
+    ApplyNode, BoolNode, ElasticSort, Query, QueryBuilder, QueryNode,
+    Result, TermNode, TermsNode, canonical)
+from unicorn.trace import TraceNode, Tracer
+from unicorn.transport import TransportProfile
 from unicorn.utils import timer
 
+if TYPE_CHECKING:
+    # Optional dependency, only required by AsyncQueryExecutor
+    from unicorn.aio import AsyncClient
+
+
+T = TypeVar('T')
+R = TypeVar('R')
+E = TypeVar('E', bound='BasicQueryExecutor')
+
+
+class DeadlineExceeded(Exception):
+    pass
+
 
 class BasicQueryExecutor:
     debug = False
@@ -14,18 +41,195 @@ class BasicQueryExecutor:
         client: Elasticsearch,
         qb: QueryBuilder,
         index: str,
-        limit: int = 10000
+        limit: int = 10000,
+        cache: Optional[Cache] = None,
+        page_size: Optional[int] = None,
+        time_budget_ms: Optional[float] = None,
+        tiebreak: Optional[ElasticSort] = None,
+        timeout_ms: Optional[float] = None,
+        transport: Optional[TransportProfile] = None,
+        routes: Optional[Mapping[str, str]] = None,
     ):
+        """
+        limit and time_budget_ms bound the hits fetched by a single
+        execution. When page_size is provided executions larger than
+        page_size are fetched with search_after, which requires a
+        tiebreak sort to uniquely order documents. Without one hits
+        tied at page boundaries would be skipped.
+
+        timeout_ms bounds all executions from one clear_counters to the
+        next, typically a single top level query. Requests are sent
+        with the remaining time as their timeout, and no requests are
+        sent once it has passed.
+
+        transport must be the profile client was created with, if any.
+
+        routes maps properties to the index holding their edges, on the
+        same cluster as index. Stages matching only properties routed
+        to one index are searched there, all others against index.
+        """
+        if page_size is not None and tiebreak is None:
+            raise ValueError('page_size requires a tiebreak sort')
         self.client = client
         self.qb = qb
         self.index = index
         self.limit = limit
+        self.cache = cache
+        self.page_size = page_size
+        self.time_budget_ms = time_budget_ms
+        self.tiebreak = tiebreak
+        self.timeout_ms = timeout_ms
+        self.transport = transport
+        self.routes = routes or {}
+        self.id_field = 'title.keyword' if transport is None else transport.id_field()
+        self.lock = threading.Lock()
         self.clear_counters()
 
     def clear_counters(self):
+        self.zero_counters()
+        self.tracer = Tracer()
+        self.deadline = None if self.timeout_ms is None else time.monotonic() + self.timeout_ms / 1000
+
+    def zero_counters(self):
         self.took_ms = 0
         self.es_took_ms = 0
+        self.response_bytes = 0
+        self.decode_ms = 0.
         self.truncated = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.timed_out = False
+
+    def with_builder(self: E, qb: QueryBuilder) -> E:
+        """Copy of this executor building stages with qb
+
+        The copy shares the deadline, cache and tracer of this executor.
+        Its counters start from zero, merge_counters adds them back.
+        """
+        executor = copy.copy(self)
+        executor.qb = qb
+        executor.zero_counters()
+        return executor
+
+    def merge_counters(self: E, other: E) -> None:
+        """Add the counters of other, typically a copy from with_builder"""
+        with self.lock:
+            self.took_ms += other.took_ms
+            self.es_took_ms += other.es_took_ms
+            self.response_bytes += other.response_bytes
+            self.decode_ms += other.decode_ms
+            self.truncated += other.truncated
+            self.cache_hits += other.cache_hits
+            self.cache_misses += other.cache_misses
+            self.timed_out |= other.timed_out
+
+    def remaining_ms(self) -> Optional[float]:
+        """Time until the deadline, or None without one"""
+        if self.deadline is None:
+            return None
+        return max(0., (self.deadline - time.monotonic()) * 1000)
+
+    def bound(self, request: Mapping) -> Tuple[Mapping, Mapping[str, Any]]:
+        """Request body and client arguments bounded to the deadline
+
+        Raises DeadlineExceeded once the deadline has passed.
+        """
+        remaining_ms = self.remaining_ms()
+        if remaining_ms is None:
+            return request, {}
+        if remaining_ms == 0:
+            raise self.deadline_exceeded()
+        # Shards that don't finish in time return partial results,
+        # flagged with timed_out, the client gives up on the rest.
+        request = dict(request, timeout='{}ms'.format(max(1, int(remaining_ms))))
+        return request, {'request_timeout': remaining_ms / 1000}
+
+    def deadline_exceeded(self) -> DeadlineExceeded:
+        self.timed_out = True
+        return DeadlineExceeded('deadline of {}ms exceeded'.format(self.timeout_ms))
+
+    @contextmanager
+    def within_timeout(self, client_args: Mapping[str, Any]) -> Iterator[None]:
+        """Raise DeadlineExceeded when the client times out a bounded request"""
+        try:
+            yield
+        except ConnectionTimeout:
+            if 'request_timeout' not in client_args:
+                raise
+            raise self.deadline_exceeded()
+
+    def route(self, query_node: Union[Query, QueryNode]) -> str:
+        """Index to search for query_node"""
+        if isinstance(query_node, Query):
+            return query_node.index or self.index
+        if not self.routes:
+            return self.index
+        indices = {self.routes.get(prop) for prop in stage_properties(query_node)}
+        if len(indices) == 1:
+            return indices.pop() or self.index
+        return self.index
+
+    def cache_key(
+        self,
+        query_node: QueryNode,
+        sort: ElasticSort,
+        size: int,
+        source: Optional[Sequence[str]],
+    ) -> Hashable:
+        return (
+            self.route(query_node),
+            canonical(query_node),
+            # Nested stages fetch inner_limit hits, which differs
+            # between the rounds of a top-k evaluation.
+            getattr(self.qb, 'inner_limit', None),
+            min(size, self.limit),
+            tuple(source or ()),
+            json.dumps(sort, sort_keys=True),
+        )
+
+    def cache_get(
+        self,
+        query_node: QueryNode,
+        sort: ElasticSort,
+        size: int,
+        source: Optional[Sequence[str]],
+    ) -> Tuple[Optional[Hashable], Optional[Result]]:
+        """Lookup query_node in the stage cache
+
+        Returns the key to store the result under on a miss, along
+        with the cached result if available.
+        """
+        if self.cache is None:
+            return None, None
+        cache_key = self.cache_key(query_node, sort, size, source)
+        cached = self.cache.get(cache_key)
+        with self.lock:
+            if cached is None:
+                self.cache_misses += 1
+            else:
+                self.cache_hits += 1
+                self.truncated += cached.truncated + cached.inner_truncated
+        return cache_key, cached
+
+    def request(
+        self,
+        query: Query,
+        sort: ElasticSort,
+        size: int,
+        source: Optional[Sequence[str]],
+    ) -> Dict[str, Any]:
+        """Elasticsearch request body for a single page of query"""
+        request = {
+            'query': query.es_query,
+            'size': min(size, self.limit),
+            '_source': source or False,
+            'sort': sort,
+        }
+        if query.aggs is not None:
+            request['aggs'] = query.aggs
+        if self.transport is not None:
+            request = self.transport.request(request)
+        return request
 
     # TODO: Distinguish inner and outer execution?
     def __call__(
@@ -35,37 +239,684 @@ class BasicQueryExecutor:
         size: int = 10,
         source: Optional[Sequence[str]] = None,
     ) -> Result:
-        if isinstance(query_node, Query):
-            query = query_node
-        else:
-            # can't isinstance against a Union type, just
-            # assume mypy caught all wrong callers...
+        pages = list(self.pages(query_node, sort, size, source))
+        if len(pages) == 1:
+            return pages[0]
+        return Result.concat(pages)
+
+    def pages(
+        self,
+        query_node: Union[Query, QueryNode],
+        sort: ElasticSort,
+        size: int = 10,
+        source: Optional[Sequence[str]] = None,
+    ) -> Iterator[Result]:
+        """Execute query, yielding results a page at a time
+
+        Fetches up to size hits, bounded by the limit and time budget
+        of the executor, in pages of page_size.
+        """
+        cache_key = None
+        cached = None
+        with self.tracer.span(query_node) as trace:
+            if isinstance(query_node, Query):
+                query = query_node
+            else:
+                cache_key, cached = self.cache_get(query_node, sort, size, source)
+                if cached is None:
+                    # can't isinstance against a Union type, just
+                    # assume mypy caught all wrong callers...
+                    with timer() as build:
+                        query = self.qb(query_node, self)
+                    trace.build_ms = build.ms
+        if cached is not None:
+            trace.cached = True
+            trace.hits = cached.num_hits
+            trace.total_hits = cached.total_hits
+            trace.truncated = cached.truncated
+            trace.inner_truncated = cached.inner_truncated
+            yield cached
+            return
+        trace.inner_truncated = trace.nested_truncated()
+
+        pages = []
+        index = self.route(query_node)
+        for result in self.fetch(self.request(query, sort, size, source), trace, index):
+            if cache_key is not None:
+                pages.append(result)
+            yield result
+        with self.lock:
+            self.truncated += trace.truncated
+        # Partial results are only valid for this execution
+        if any(page.timed_out for page in pages) or self.remaining_ms() == 0:
+            return
+        if cache_key is not None and self.cache is not None:
+            result = pages[0] if len(pages) == 1 else Result.concat(pages)
+            result.inner_truncated = trace.inner_truncated
+            self.cache.put(cache_key, result)
+
+    def build(self, query_node: QueryNode) -> Query:
+        """Build query_node, executing all of its inner stages"""
+        with self.tracer.span(query_node) as trace, timer() as build:
             query = self.qb(query_node, self)
+        trace.build_ms = build.ms
+        return query
 
-        request = {
-            'query': query.es_query,
-            'size': min(size, self.limit),
-            '_source': source or False,
-            'sort': sort,
-        }
+    def stream(
+        self,
+        query: Query,
+        sort: ElasticSort,
+        size: int = 10,
+        source: Optional[Sequence[str]] = None,
+        search_after: Optional[Sequence[Any]] = None,
+    ) -> Iterator[Result]:
+        """Execute a prebuilt query a page at a time, resuming after search_after
+
+        Hits are sorted including the tiebreak, the sort values of any
+        hit can resume the query from that hit. Nothing is cached.
+        """
+        request = self.request(query, sort, size, source)
+        request['sort'] = self.unique_sort(sort)
+        if search_after is not None:
+            request['search_after'] = search_after
+        with self.tracer.span(query) as trace:
+            yield from self.fetch(request, trace, self.route(query))
+
+    def unique_sort(self, sort: ElasticSort) -> List[ElasticSort]:
+        """sort extended with the tiebreak, as required by search_after"""
+        sorts = list(sort if isinstance(sort, list) else [sort])
+        if self.tiebreak is not None and self.tiebreak not in sorts:
+            sorts.append(self.tiebreak)
+        return sorts
+
+    def fetch(self, request: Dict[str, Any], trace: TraceNode, index: Optional[str] = None) -> Iterator[Result]:
+        """Issue request, following search_after in pages of page_size
+
+        Raises DeadlineExceeded when the deadline passes before the
+        first page, pages fetched before it passes are kept.
+        """
+        budget = request['size']
+        if self.page_size is not None and budget > self.page_size:
+            request['size'] = self.page_size
+            request['sort'] = self.unique_sort(request['sort'])
+
+        fetched = 0
+        pages = 0
+        with timer() as took:
+            while True:
+                try:
+                    result = self.search(request, trace, index)
+                except DeadlineExceeded:
+                    if not pages:
+                        raise
+                    # Hits of the pages already fetched are kept,
+                    # flagged with timed_out as any partial result.
+                    break
+                pages += 1
+                fetched += result.num_hits
+                yield result
+                es_hits = result.es_hits
+                if fetched >= budget or len(es_hits) < request['size']:
+                    break
+                if self.time_budget_ms is not None and took.elapsed_ms() > self.time_budget_ms:
+                    break
+                if self.remaining_ms() == 0:
+                    self.timed_out = True
+                    break
+                request['size'] = min(request['size'], budget - fetched)
+                request['search_after'] = es_hits[-1]['sort']
+
+        trace.total_hits = result.total_hits
+        trace.truncated = (result.total_hits - fetched if budget else 0) + result.aggregations_truncated
+
+    def count(self, query_node: QueryNode) -> int:
+        """Number of documents matching query_node, without fetching any"""
+        query = self.qb(query_node, self)
+        request, client_args = self.bound({'query': query.es_query, 'size': 0})
+        with timer() as took, self.within_timeout(client_args):
+            es_result = self.client.search(
+                index=self.route(query_node),
+                body=request,
+                **self.search_args(client_args))
+        result = Result(es_result, took.ms, self.id_field)
+        self.record(result, took.ms, result.es_took_ms, *self.last_response())
+        return result.total_hits
+
+    def search(self, request: Mapping, trace: TraceNode, index: Optional[str] = None) -> Result:
+        """Issue a single search request to elasticsearch"""
         if self.debug:
             pprint(request)
-        with timer() as took:
+        bounded, client_args = self.bound(request)
+        with timer() as took, self.within_timeout(client_args):
             es_result = self.client.search(
-                index=self.index,
-                body=request)
-        result = Result(es_result, took.ms)
+                index=index or self.index,
+                body=bounded,
+                **self.search_args(client_args))
+        result = Result(es_result, took.ms, self.id_field)
+        response_bytes, decode_ms = self.last_response()
+        self.record(result, took.ms, result.es_took_ms, response_bytes, decode_ms)
+        trace_request(trace, request, result, took.ms, result.es_took_ms, response_bytes, decode_ms)
+        return result
+
+    def search_args(self, client_args: Mapping[str, Any]) -> Mapping[str, Any]:
+        """Client arguments of a search, including the transport profile"""
+        if self.transport is None:
+            return client_args
+        return dict(client_args, **self.transport.search_args())
+
+    def last_response(self) -> Tuple[int, float]:
+        """Size and decode time of the response last received by this thread"""
+        if self.transport is None:
+            return 0, 0.
+        return self.transport.last_response()
+
+    def record(
+        self,
+        result: Result,
+        took_ms: float,
+        es_took_ms: float,
+        response_bytes: int = 0,
+        decode_ms: float = 0.,
+    ) -> None:
+        """Account for a completed request in the executor counters"""
+        with self.lock:
+            self.took_ms += took_ms
+            self.es_took_ms += es_took_ms
+            self.response_bytes += response_bytes
+            self.decode_ms += decode_ms
+            self.timed_out |= result.timed_out
+
+    def map(self, fn: Callable[[T], R], items: Sequence[T]) -> List[R]:
+        return [fn(item) for item in items]
+
+
+def trace_request(
+    trace: TraceNode,
+    request: Mapping,
+    result: Result,
+    took_ms: float,
+    es_took_ms: float,
+    response_bytes: int = 0,
+    decode_ms: float = 0.,
+) -> None:
+    trace.requests += 1
+    trace.request_bytes += len(json.dumps(request))
+    trace.response_bytes += response_bytes
+    trace.decode_ms += decode_ms
+    trace.es_took_ms += es_took_ms
+    trace.net_took_ms += took_ms - es_took_ms
+    trace.hits += result.num_hits
+    trace.total_hits = result.total_hits
+
+
+def stage_properties(node: QueryNode) -> Set[str]:
+    """Properties of the edges matched by a stage, excluding nested stages"""
+    if isinstance(node, TermNode):
+        return {node.value.split('=', 1)[0]}
+    elif isinstance(node, TermsNode):
+        return {value.split('=', 1)[0] for value in node.values}
+    elif isinstance(node, ApplyNode):
+        return {node.prefix.split('=', 1)[0]}
+    elif isinstance(node, BoolNode):
+        return {prop for child in (*node.must, *node.must_not, *node.should) for prop in stage_properties(child)}
+    # Extract and closure match ids, none matches nothing
+    return set()
+
+
+def truncated(request: Mapping, result: Result) -> int:
+    """Hits matching request that were not returned"""
+    # Requests for no hits, counts and aggregations, truncate no hits
+    # but aggregations can leave out terms.
+    return (result.truncated if request['size'] else 0) + result.aggregations_truncated
+
+
+class ConcurrentQueryExecutor(BasicQueryExecutor):
+    """Executes independent sibling subtrees concurrently
+
+    The pool is typically shared between executors, its max_workers
+    caps the parallelism of all queries using it.
+    """
+    def __init__(
+        self,
+        client: Elasticsearch,
+        qb: QueryBuilder,
+        index: str,
+        pool: Executor,
+        **kwargs
+    ):
+        super().__init__(client, qb, index, **kwargs)
+        self.pool = pool
+
+    def map(self, fn: Callable[[T], R], items: Sequence[T]) -> List[R]:
+        if len(items) < 2:
+            return [fn(item) for item in items]
+        # The calling thread runs the first item itself, and any
+        # items the pool hasn't started by the time we get to them.
+        # Nested fan outs from pool threads would otherwise deadlock
+        # a saturated pool waiting on work queued behind themselves.
+        traced = self.tracer.wrap(fn)
+        futures = [self.pool.submit(traced, item) for item in items[1:]]
         try:
-            print('es took: {}ms took: {}ms hits: {} total_hits: {}'.format(
-                result.es_took_ms,
-                took.ms,
-                len(result.hits),
-                result.total_hits))
-            self.took_ms += took.ms
-            self.es_took_ms += result.es_took_ms
-            self.truncated += result.total_hits - len(result.hits)
-        except KeyError:
-            # TODO: Error result
-            print(es_result)
+            results = [fn(items[0])]
+            for item, future in zip(items[1:], futures):
+                if future.cancel():
+                    results.append(fn(item))
+                else:
+                    results.append(self.wait(future))
+        except BaseException:
+            for future in futures:
+                future.cancel()
             raise
+        return results
+
+    def wait(self, future: Future) -> Any:
+        """Result of future, waiting no longer than the deadline"""
+        remaining_ms = self.remaining_ms()
+        try:
+            return future.result(None if remaining_ms is None else remaining_ms / 1000)
+        except TimeoutError:
+            raise self.deadline_exceeded()
+
+
+class MultiSearchQueryExecutor(BasicQueryExecutor):
+    """Executes sibling inner stages together with _msearch
+
+    The query is built in rounds. Each round builds the full tree,
+    using results from previous rounds where available. Requests that
+    could be built entirely from available results are collected and
+    sent as a single multi-search, stages depending on them are left
+    for a later round. Round n resolves the stages with n-1 levels of
+    stages below them.
+
+    Pages are not supported, each stage is a single request.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.depth = 0
+
+    def zero_counters(self):
+        super().zero_counters()
+        self.msearch_count = 0
+        self.clear_round_state()
+
+    def merge_counters(self, other: 'MultiSearchQueryExecutor') -> None:
+        super().merge_counters(other)
+        self.msearch_count += other.msearch_count
+
+    def clear_round_state(self):
+        # Responses keyed by request body
+        self.results: Dict[str, Result] = {}
+        # Request bodies waiting for the next round
+        self.pending: Dict[str, Mapping] = {}
+        # Cache keys of pending requests
+        self.pending_cache_keys: Dict[str, Hashable] = {}
+        # Hits truncated by the stages nested in pending requests
+        self.pending_inner_truncated: Dict[str, int] = {}
+        # Routed indices of pending requests
+        self.pending_indices: Dict[str, str] = {}
+        # Cache lookups memoized between rounds
+        self.cached: Dict[Hashable, Optional[Result]] = {}
+        # Request statistics keyed by request body
+        self.request_traces: Dict[str, TraceNode] = {}
+        # Count of stages unavailable this round
+        self.unresolved = 0
+
+    def pages(
+        self,
+        query_node: Union[Query, QueryNode],
+        sort: ElasticSort,
+        size: int = 10,
+        source: Optional[Sequence[str]] = None,
+    ) -> Iterator[Result]:
+        if self.depth > 0:
+            yield self.lookup(query_node, sort, size, source)
+            return
+
+        yield self.rounds(lambda: self.lookup(query_node, sort, size, source))
+
+    def build(self, query_node: QueryNode) -> Query:
+        return self.rounds(lambda: BasicQueryExecutor.build(self, query_node))
+
+    def rounds(self, fn: Callable[[], R]) -> R:
+        """Call fn until it completes without any pending requests"""
+        steps = self.round_steps(fn)
+        try:
+            while True:
+                next(steps)
+                self.execute_pending()
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            steps.close()
+
+    def round_steps(self, fn: Callable[[], R]) -> Generator[None, None, R]:
+        """Call fn in rounds, yielding when pending requests must be sent"""
+        self.clear_round_state()
+        # Only the trace of the final, fully resolved, round is kept
+        parent = self.tracer.current()
+        num_children = len(parent.children)
+        try:
+            while True:
+                del parent.children[num_children:]
+                self.depth += 1
+                try:
+                    self.unresolved = 0
+                    result = fn()
+                finally:
+                    self.depth -= 1
+                if not self.pending:
+                    break
+                yield
+        finally:
+            self.clear_round_state()
+        return result
+
+    def lookup(
+        self,
+        query_node: Union[Query, QueryNode],
+        sort: ElasticSort,
+        size: int,
+        source: Optional[Sequence[str]],
+    ) -> Result:
+        """Result of query_node if available, otherwise a placeholder"""
+        with self.tracer.span(query_node) as trace:
+            return self.traced_lookup(query_node, sort, size, source, trace)
+
+    def traced_lookup(
+        self,
+        query_node: Union[Query, QueryNode],
+        sort: ElasticSort,
+        size: int,
+        source: Optional[Sequence[str]],
+        trace: TraceNode,
+    ) -> Result:
+        cache_key = None
+        if isinstance(query_node, Query):
+            if self.unresolved:
+                # Prebuilt queries can't report if they were built from
+                # placeholders, assume so when anything is unresolved.
+                self.unresolved += 1
+                return self.placeholder()
+            query = query_node
+        else:
+            if self.cache is not None:
+                cache_key = self.cache_key(query_node, sort, size, source)
+                if cache_key not in self.cached:
+                    self.cached[cache_key] = self.cache_get(query_node, sort, size, source)[1]
+                cached = self.cached[cache_key]
+                if cached is not None:
+                    trace.cached = True
+                    trace.hits = cached.num_hits
+                    trace.total_hits = cached.total_hits
+                    trace.truncated = cached.truncated
+                    trace.inner_truncated = cached.inner_truncated
+                    return cached
+            unresolved = self.unresolved
+            with timer() as build:
+                query = self.qb(query_node, self)
+            trace.build_ms = build.ms
+            if self.unresolved > unresolved:
+                # Built from placeholders, wait for a later round
+                self.unresolved += 1
+                return self.placeholder()
+
+        trace.inner_truncated = trace.nested_truncated()
+        request = self.request(query, sort, size, source)
+        index = self.route(query_node)
+        key = json.dumps(request, sort_keys=True)
+        if index != self.index:
+            key = index + ' ' + key
+        try:
+            result = self.results[key]
+        except KeyError:
+            self.pending[key] = request
+            if index != self.index:
+                self.pending_indices[key] = index
+            if cache_key is not None:
+                self.pending_cache_keys[key] = cache_key
+                self.pending_inner_truncated[key] = trace.inner_truncated
+            self.unresolved += 1
+            return self.placeholder()
+        stats = self.request_traces[key]
+        trace.requests = stats.requests
+        trace.request_bytes = stats.request_bytes
+        trace.response_bytes = stats.response_bytes
+        trace.decode_ms = stats.decode_ms
+        trace.es_took_ms = stats.es_took_ms
+        trace.net_took_ms = stats.net_took_ms
+        trace.hits = stats.hits
+        trace.total_hits = stats.total_hits
+        trace.truncated = truncated(request, result)
+        return result
+
+    @staticmethod
+    def placeholder() -> Result:
+        return Result({'took': 0, 'hits': {'total': 0, 'hits': []}}, 0.)
+
+    def execute_pending(self) -> None:
+        """Send all pending requests in a single round trip"""
+        keys = list(self.pending.keys())
+        traces = [TraceNode(key) for key in keys]
+        indices = [self.pending_indices.get(key) for key in keys]
+        if len(keys) == 1:
+            results = [self.search(self.pending[keys[0]], traces[0], indices[0])]
+        else:
+            results = self.msearch([self.pending[key] for key in keys], indices)
+        self.resolve_pending(keys, traces, results)
+
+    def resolve_pending(self, keys: Sequence[str], traces: Sequence[TraceNode], results: Sequence[Result]) -> None:
+        """Make results of pending requests available to the next round"""
+        if len(keys) > 1:
+            for key, trace, result in zip(keys, traces, results):
+                trace_request(trace, self.pending[key], result, result.took_ms, result.es_took_ms)
+        for key, trace, result in zip(keys, traces, results):
+            self.results[key] = result
+            self.request_traces[key] = trace
+            with self.lock:
+                self.truncated += truncated(self.pending[key], result)
+            if key in self.pending_cache_keys and self.cache is not None and not result.timed_out:
+                result.inner_truncated = self.pending_inner_truncated[key]
+                self.cache.put(self.pending_cache_keys[key], result)
+        self.pending.clear()
+        self.pending_cache_keys.clear()
+        self.pending_inner_truncated.clear()
+        self.pending_indices.clear()
+
+    def msearch(self, requests: Sequence[Mapping], indices: Sequence[Optional[str]] = ()) -> List[Result]:
+        body, client_args = self.msearch_body(requests, indices)
+        with timer() as took, self.within_timeout(client_args):
+            es_result = self.client.msearch(body=body, index=self.index, **client_args)
+        return self.msearch_results(es_result, took.ms, *self.last_response())
+
+    def msearch_body(
+        self,
+        requests: Sequence[Mapping],
+        indices: Sequence[Optional[str]] = (),
+    ) -> Tuple[List[Mapping], Mapping[str, Any]]:
+        """Multi-search body of requests, searching indices other than the default"""
+        body: List[Mapping] = []
+        client_args: Mapping[str, Any] = {}
+        if not indices:
+            indices = [None] * len(requests)
+        for request, index in zip(requests, indices):
+            request, client_args = self.bound(request)
+            body.append({} if index is None else {'index': index})
+            body.append(request)
+        if self.debug:
+            pprint(body)
+        if self.transport is not None:
+            client_args = dict(client_args, **self.transport.msearch_args())
+        return body, client_args
+
+    def msearch_results(
+        self,
+        es_result: Mapping,
+        took_ms: float,
+        response_bytes: int = 0,
+        decode_ms: float = 0.,
+    ) -> List[Result]:
+        results = []
+        for response in es_result['responses']:
+            if 'error' in response:
+                raise Exception(response['error'])
+            results.append(Result(response, took_ms, self.id_field))
+        self.msearch_count += 1
+        # Searches of a multi-search run concurrently, the slowest
+        # determines elasticsearch time of the round trip. The
+        # response is decoded as a whole, attributed to the first.
+        for i, result in enumerate(results):
+            if i == 0:
+                self.record(
+                    result, took_ms, max(r.es_took_ms for r in results),
+                    response_bytes, decode_ms)
+            else:
+                self.record(result, 0, 0)
+        return results
+
+
+class AsyncQueryExecutor:
+    """Executes queries from an asyncio event loop
+
+    Stages are resolved in rounds as with MultiSearchQueryExecutor.
+    Building a round never waits on elasticsearch, only the round trip
+    sending its pending requests is awaited, so a single event loop
+    can serve many multi-stage queries concurrently. client must be
+    an AsyncClient.
+    """
+    def __init__(self, client: 'AsyncClient', qb: QueryBuilder, index: str, **kwargs):
+        self.client = client
+        # Builds the rounds and holds their state and counters. Stages
+        # are only looked up through it, its synchronous client
+        # methods are never called.
+        self.rounds = MultiSearchQueryExecutor(client, qb, index, **kwargs)  # type: ignore
+
+    def clear_counters(self) -> None:
+        self.rounds.clear_counters()
+
+    def remaining_ms(self) -> Optional[float]:
+        return self.rounds.remaining_ms()
+
+    def with_builder(self, qb: QueryBuilder) -> 'AsyncQueryExecutor':
+        """Copy of this executor building stages with qb, as BasicQueryExecutor.with_builder"""
+        executor = copy.copy(self)
+        executor.rounds = self.rounds.with_builder(qb)
+        return executor
+
+    def merge_counters(self, other: 'AsyncQueryExecutor') -> None:
+        self.rounds.merge_counters(other.rounds)
+
+    async def execute(
+        self,
+        query_node: Union[Query, QueryNode],
+        sort: ElasticSort,
+        size: int = 10,
+        source: Optional[Sequence[str]] = None,
+    ) -> Result:
+        """Top size hits of query_node"""
+        rounds = self.rounds
+        return await self.async_rounds(lambda: rounds.lookup(query_node, sort, size, source))
+
+    async def async_build(self, query_node: QueryNode) -> Query:
+        """Build query_node, executing all of its inner stages"""
+        rounds = self.rounds
+        return await self.async_rounds(lambda: BasicQueryExecutor.build(rounds, query_node))
+
+    async def async_rounds(self, fn: Callable[[], R]) -> R:
+        steps = self.rounds.round_steps(fn)
+        try:
+            while True:
+                next(steps)
+                await self.async_execute_pending()
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            steps.close()
+
+    async def async_execute_pending(self) -> None:
+        rounds = self.rounds
+        keys = list(rounds.pending.keys())
+        traces = [TraceNode(key) for key in keys]
+        indices = [rounds.pending_indices.get(key) for key in keys]
+        if len(keys) == 1:
+            results = [await self.async_search(rounds.pending[keys[0]], traces[0], indices[0])]
+        else:
+            results = await self.async_msearch([rounds.pending[key] for key in keys], indices)
+        rounds.resolve_pending(keys, traces, results)
+
+    async def async_search(self, request: Mapping, trace: TraceNode, index: Optional[str] = None) -> Result:
+        rounds = self.rounds
+        if rounds.debug:
+            pprint(request)
+        bounded, client_args = rounds.bound(request)
+        with timer() as took:
+            es_result = await self.within_deadline(self.client.search(
+                index=index or rounds.index,
+                body=bounded,
+                **rounds.search_args(client_args)))
+        result = Result(es_result, took.ms, rounds.id_field)
+        rounds.record(result, took.ms, result.es_took_ms)
+        trace_request(trace, request, result, took.ms, result.es_took_ms)
         return result
+
+    async def async_msearch(self, requests: Sequence[Mapping], indices: Sequence[Optional[str]] = ()) -> List[Result]:
+        body, client_args = self.rounds.msearch_body(requests, indices)
+        with timer() as took:
+            es_result = await self.within_deadline(self.client.msearch(
+                body=body, index=self.rounds.index, **client_args))
+        return self.rounds.msearch_results(es_result, took.ms)
+
+    async def within_deadline(self, request: Awaitable[T]) -> T:
+        """Await request, cancelling it when the deadline passes"""
+        remaining_ms = self.remaining_ms()
+        try:
+            return await asyncio.wait_for(request, None if remaining_ms is None else remaining_ms / 1000)
+        except (asyncio.TimeoutError, ConnectionTimeout):
+            if remaining_ms is None:
+                raise
+            raise self.rounds.deadline_exceeded()
+
+    # Counters of the rounds executor
+
+    @property
+    def qb(self) -> QueryBuilder:
+        return self.rounds.qb
+
+    @property
+    def tracer(self) -> Tracer:
+        return self.rounds.tracer
+
+    @property
+    def took_ms(self) -> float:
+        return self.rounds.took_ms
+
+    @property
+    def es_took_ms(self) -> float:
+        return self.rounds.es_took_ms
+
+    @property
+    def response_bytes(self) -> int:
+        return self.rounds.response_bytes
+
+    @property
+    def decode_ms(self) -> float:
+        return self.rounds.decode_ms
+
+    @property
+    def truncated(self) -> int:
+        return self.rounds.truncated
+
+    @property
+    def cache_hits(self) -> int:
+        return self.rounds.cache_hits
+
+    @property
+    def cache_misses(self) -> int:
+        return self.rounds.cache_misses
+
+    @property
+    def timed_out(self) -> bool:
+        return self.rounds.timed_out
+
+    @property
+    def msearch_count(self) -> int:
+        return self.rounds.msearch_count
@@ -0,0 +1,170 @@
+"""Top-k evaluation, deepening inner stages only as far as needed
+
+Searches typically show a single page of results, yet every inner stage
+fetches inner_limit hits. A top-k evaluation first runs inner stages
+with a small limit, and raises it only while the top hits of the outer
+result could still change.
+"""
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Generator, List, Optional, Sequence, Tuple, TypeVar, Union
+
+from unicorn.model import ElasticSort, Query, QueryNode, Result
+from unicorn.qb import BasicQueryBuilder
+from unicorn.qe import AsyncQueryExecutor, BasicQueryExecutor, DeadlineExceeded
+
+
+E = TypeVar('E', BasicQueryExecutor, AsyncQueryExecutor)
+
+
+@dataclass
+class Deepening:
+    """Rounds of a single top-k evaluation"""
+    # Inner limit of each round
+    limits: List[int] = field(default_factory=list)
+    # No inner stage was truncated in the final round, the result
+    # equals a full evaluation.
+    exact: bool = False
+    # The final round matched as many hits, with the same top hits, as
+    # the round before
+    stable: bool = False
+    # Hits truncated by inner stages in the final round
+    inner_truncated: int = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+class TopK:
+    """Evaluates queries for their top hits, deepening inner stages on demand
+
+    Each round evaluates the query with inner stages limited to the next
+    of initial_limit, initial_limit * growth, ..., up to the inner_limit
+    of the query builder. Evaluation stops once no inner stage was
+    truncated, or the outer result matches as many hits as in the
+    previous round, with the same top size. Stages with an explicit
+    limit keep it.
+
+    Stability is a heuristic, inner hits beyond the deepest round may
+    still contribute to the top size of a full evaluation. Aggregated
+    extracts are truncated by the inner hits of the targets left out
+    of their top inner_limit.
+    """
+    def __init__(self, initial_limit: int = 100, growth: int = 4):
+        if initial_limit < 1 or growth < 2:
+            raise ValueError('initial_limit must be positive and growth at least 2')
+        self.initial_limit = initial_limit
+        self.growth = growth
+
+    def limits(self, inner_limit: int) -> List[int]:
+        """Inner limit of each round, ending with inner_limit"""
+        limits = []
+        limit = self.initial_limit
+        while limit < inner_limit:
+            limits.append(limit)
+            limit *= self.growth
+        limits.append(inner_limit)
+        return limits
+
+    def rounds(self, executor: Union[BasicQueryExecutor, AsyncQueryExecutor]) -> List[BasicQueryBuilder]:
+        """Query builder of each round"""
+        qb = executor.qb
+        if not isinstance(qb, BasicQueryBuilder):
+            raise ValueError('Top-k evaluation requires a BasicQueryBuilder')
+        return [qb.limited(limit) for limit in self.limits(qb.inner_limit)]
+
+    def done(
+        self,
+        deepening: Deepening,
+        qb: BasicQueryBuilder,
+        size: int,
+        result: Result,
+        inner_truncated: int,
+        previous: Optional[Result],
+    ) -> bool:
+        """Record the outcome of a round, True when no deeper round is needed"""
+        deepening.limits.append(qb.inner_limit)
+        deepening.inner_truncated = inner_truncated
+        deepening.exact = inner_truncated == 0
+        deepening.stable = (
+            previous is not None
+            and result.num_hits >= size
+            and result.total_hits == previous.total_hits
+            and result.ids[:size] == previous.ids[:size])
+        return deepening.exact or deepening.stable or result.timed_out
+
+    def deepen(self, executor: E, size: int) -> Generator[E, Result, Tuple[Result, Deepening]]:
+        """Rounds of a top-k evaluation with executor
+
+        Yields the executor of each round, building inner stages with
+        the limit of the round, and is sent the result of executing the
+        query with it. DeadlineExceeded thrown into a round ends the
+        evaluation with the result of the last completed round, and is
+        only raised again when no round completed.
+        """
+        deepening = Deepening()
+        result: Optional[Result] = None
+        for qb in self.rounds(executor):
+            round_executor = executor.with_builder(qb)
+            try:
+                round_result = yield round_executor
+            except DeadlineExceeded:
+                if result is None:
+                    raise
+                break
+            finally:
+                executor.merge_counters(round_executor)
+            inner_truncated = round_executor.truncated - round_result.truncated
+            previous, result = result, round_result
+            if self.done(deepening, qb, size, result, inner_truncated, previous):
+                break
+        assert result is not None
+        return result, deepening
+
+    def __call__(
+        self,
+        executor: BasicQueryExecutor,
+        query_node: Union[Query, QueryNode],
+        sort: ElasticSort,
+        size: int = 10,
+        source: Optional[Sequence[str]] = None,
+    ) -> Tuple[Result, Deepening]:
+        """Top size hits of query_node, along with the rounds taken
+
+        Once the deadline of the executor passes the result of the last
+        completed round is returned, DeadlineExceeded is only raised
+        when the first round doesn't complete.
+        """
+        steps = self.deepen(executor, size)
+        try:
+            round_executor = next(steps)
+            while True:
+                try:
+                    round_result = round_executor(query_node, sort, size, source)
+                except DeadlineExceeded as e:
+                    round_executor = steps.throw(e)
+                else:
+                    round_executor = steps.send(round_result)
+        except StopIteration as stop:
+            return stop.value
+
+    async def execute(
+        self,
+        executor: AsyncQueryExecutor,
+        query_node: Union[Query, QueryNode],
+        sort: ElasticSort,
+        size: int = 10,
+        source: Optional[Sequence[str]] = None,
+    ) -> Tuple[Result, Deepening]:
+        """Async equivalent of __call__"""
+        steps = self.deepen(executor, size)
+        try:
+            round_executor = next(steps)
+            while True:
+                try:
+                    round_result = await round_executor.execute(query_node, sort, size, source)
+                except DeadlineExceeded as e:
+                    round_executor = steps.throw(e)
+                else:
+                    round_executor = steps.send(round_result)
+        except StopIteration as stop:
+            return stop.value
@@ -0,0 +1,126 @@
+"""Per-node execution traces of a query"""
+from __future__ import annotations
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional, TypeVar, Union
+
+from unicorn.model import (
+    ApplyNode, BoolNode, ClosureNode, ExtractNode, NoneNode,
+    Query, QueryNode, TermNode, TermsNode)
+
+
+T = TypeVar('T', bound=Callable)
+
+
+def format_node(node: Union[Query, QueryNode]) -> str:
+    """Render node as an s-expression"""
+    if isinstance(node, TermNode):
+        return node.value
+    elif isinstance(node, TermsNode):
+        return '(or {})'.format(' '.join(node.values))
+    elif isinstance(node, NoneNode):
+        return '(none)'
+    elif isinstance(node, ApplyNode):
+        return '(apply {} {})'.format(node.prefix, format_node(node.query))
+    elif isinstance(node, ExtractNode):
+        return '(extract {} {})'.format(node.key, format_node(node.query))
+    elif isinstance(node, ClosureNode):
+        return '(closure {} {})'.format(node.prefix, ' '.join(node.roots))
+    elif isinstance(node, BoolNode):
+        def join(nodes):
+            return ' '.join(format_node(x) for x in nodes)
+        if node.must and node.must_not and not node.should:
+            must = format_node(node.must[0]) if len(node.must) == 1 else '(and {})'.format(join(node.must))
+            return '(difference {} {})'.format(must, join(node.must_not))
+        parts = []
+        if node.must:
+            parts.append('(and {})'.format(join(node.must)))
+        if node.must_not:
+            parts.append('(not {})'.format(join(node.must_not)))
+        if node.should:
+            parts.append('(or {})'.format(join(node.should)))
+        return parts[0] if len(parts) == 1 else '(and {})'.format(' '.join(parts))
+    elif isinstance(node, Query):
+        return '<prebuilt query>'
+    else:
+        raise NotImplementedError('Unreachable')
+
+
+@dataclass
+class TraceNode:
+    """Execution statistics of a single query node"""
+    node: str
+    requests: int = 0
+    request_bytes: int = 0
+    response_bytes: int = 0
+    es_took_ms: float = 0.
+    net_took_ms: float = 0.
+    build_ms: float = 0.
+    decode_ms: float = 0.
+    hits: int = 0
+    total_hits: int = 0
+    truncated: int = 0
+    # Hits truncated by stages nested below this node
+    inner_truncated: int = 0
+    cached: bool = False
+    children: List[TraceNode] = field(default_factory=list)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    def nested_truncated(self) -> int:
+        """Hits truncated by the stages of children and below"""
+        return sum(child.truncated + child.inner_truncated for child in self.children)
+
+    def format(self, indent: int = 0) -> Iterator[str]:
+        yield '{}{}'.format('    ' * indent, self.node)
+        yield '{}  hits: {} / {}, truncated: {}, requests: {}, bytes: {} / {}{}'.format(
+            '    ' * indent, self.hits, self.total_hits, self.truncated,
+            self.requests, self.request_bytes, self.response_bytes, ' (cached)' if self.cached else '')
+        yield '{}  es: {:.1f}ms, net: {:.1f}ms, decode: {:.1f}ms, build: {:.1f}ms'.format(
+            '    ' * indent, self.es_took_ms, self.net_took_ms, self.decode_ms, self.build_ms)
+        for child in self.children:
+            yield from child.format(indent + 1)
+
+
+class Tracer:
+    """Collects a tree of TraceNode as queries execute
+
+    The current node is tracked per thread, work handed to other
+    threads must be wrapped to continue the same tree.
+    """
+    def __init__(self):
+        self.local = threading.local()
+        self.root = TraceNode('root')
+
+    def current(self) -> TraceNode:
+        return getattr(self.local, 'node', self.root)
+
+    def last(self) -> Optional[TraceNode]:
+        """Most recent top level trace"""
+        return self.root.children[-1] if self.root.children else None
+
+    @contextmanager
+    def span(self, node: Union[Query, QueryNode]) -> Iterator[TraceNode]:
+        parent = self.current()
+        trace = TraceNode(format_node(node))
+        parent.children.append(trace)
+        self.local.node = trace
+        try:
+            yield trace
+        finally:
+            self.local.node = parent
+
+    def wrap(self, fn: T) -> T:
+        """Run fn as a child of the current node, from any thread"""
+        parent = self.current()
+
+        def wrapped(*args, **kwargs):
+            prev = self.current()
+            self.local.node = parent
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.local.node = prev
+        return wrapped  # type: ignore
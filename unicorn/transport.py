@@ -0,0 +1,133 @@
+"""Wire format of requests to elasticsearch
+
+A TransportProfile trims responses to the keys unicorn reads, fetches
+ids from doc values rather than _source, compresses requests and
+decodes responses with a configurable json library. Response sizes
+and decode times are measured for the executor counters.
+"""
+from dataclasses import dataclass, field
+from elasticsearch import Elasticsearch
+import json
+import threading
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+from unicorn.utils import timer
+
+try:
+    import orjson
+except ImportError:
+    # Optional, only required for json_library orjson
+    orjson = None  # type: ignore
+
+
+# Response keys read by unicorn, everything else is dropped by elasticsearch
+SEARCH_FILTER_PATH = [
+    'took',
+    'timed_out',
+    'hits.total',
+    'hits.hits._source',
+    'hits.hits.fields',
+    'hits.hits.sort',
+    'aggregations',
+]
+MSEARCH_FILTER_PATH = ['responses.error'] + ['responses.' + path for path in SEARCH_FILTER_PATH]
+
+
+class MeasuringSerializer:
+    """json serializer recording the size and decode time of responses
+
+    Measurements are kept per thread, last() reports the most recent
+    response decoded by the calling thread.
+    """
+    mimetype = 'application/json'
+
+    def __init__(self, json_library: str = 'json'):
+        self.json_loads: Callable[[str], Any]
+        self.json_dumps: Callable[[Any], str]
+        if json_library == 'orjson':
+            if orjson is None:
+                raise ValueError('json_library orjson is not installed')
+            self.json_loads = orjson.loads
+            self.json_dumps = lambda data: orjson.dumps(data).decode('utf8')
+        elif json_library == 'json':
+            self.json_loads = json.loads
+            self.json_dumps = json.dumps
+        else:
+            raise ValueError('Unknown json_library: {}'.format(json_library))
+        self.local = threading.local()
+
+    def loads(self, s: str) -> Any:
+        with timer() as took:
+            data = self.json_loads(s)
+        # Characters of the decoded body, equal to bytes for the
+        # mostly ascii responses of wikidata ids.
+        self.local.last = (len(s), took.ms)
+        return data
+
+    def dumps(self, data: Any) -> str:
+        if isinstance(data, str):
+            return data
+        return self.json_dumps(data)
+
+    def last(self) -> Tuple[int, float]:
+        """Size and decode time of the last response, zero if none"""
+        last = getattr(self.local, 'last', (0, 0.))
+        self.local.last = (0, 0.)
+        return last
+
+
+@dataclass
+class TransportProfile:
+    """How requests are sent and responses received
+
+    docvalue_fields maps _source fields to the doc value fields
+    returned in their place, title is requested as title.keyword.
+    """
+    filter_path: bool = False
+    docvalue_fields: Dict[str, str] = field(default_factory=dict)
+    http_compress: bool = False
+    json_library: str = 'json'
+
+    def __post_init__(self):
+        self.serializer = MeasuringSerializer(self.json_library)
+
+    def client(self, hosts: Optional[Any] = None, **kwargs) -> Elasticsearch:
+        """Elasticsearch client using this profile"""
+        return Elasticsearch(
+            hosts, http_compress=self.http_compress,
+            serializer=self.serializer, **kwargs)
+
+    def request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """request with mapped _source fields read from doc values"""
+        source = request.get('_source')
+        if not self.docvalue_fields or not source or source is True:
+            return request
+        docvalue_fields: List[str] = [
+            self.docvalue_fields[name] for name in source if name in self.docvalue_fields]
+        if docvalue_fields:
+            remaining = [name for name in source if name not in self.docvalue_fields]
+            request['_source'] = remaining or False
+            request['docvalue_fields'] = docvalue_fields
+        return request
+
+    def id_field(self, default: str = 'title.keyword') -> str:
+        """Doc value field titles are read from, default when read from _source"""
+        return self.docvalue_fields.get('title', default)
+
+    def search_args(self) -> Mapping[str, Any]:
+        return {'filter_path': SEARCH_FILTER_PATH} if self.filter_path else {}
+
+    def msearch_args(self) -> Mapping[str, Any]:
+        return {'filter_path': MSEARCH_FILTER_PATH} if self.filter_path else {}
+
+    def last_response(self) -> Tuple[int, float]:
+        return self.serializer.last()
+
+
+def lean(json_library: str = 'json', id_field: str = 'title.keyword') -> TransportProfile:
+    """Profile with all wire savings enabled, reading titles from id_field"""
+    return TransportProfile(
+        filter_path=True,
+        docvalue_fields={'title': id_field},
+        http_compress=True,
+        json_library=json_library)
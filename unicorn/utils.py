@@ -5,6 +5,8 @@ import time
 @contextmanager
 def timer():
     start = time.monotonic()
-    obj = type('', (), dict(ms=None))
+    obj = type('', (), dict(
+        ms=None,
+        elapsed_ms=staticmethod(lambda: 1000 * (time.monotonic() - start))))
     yield obj
     obj.ms = 1000 * (time.monotonic() - start)
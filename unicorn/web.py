@@ -1,14 +1,24 @@
-from elasticsearch import Elasticsearch
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import hashlib
 import hug
 from jinja2 import FileSystemLoader, Environment
 import json
 import os
-from typing import Any, Dict
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple, Union
 
+from unicorn.cache import Cache, LRUCache, SqliteCache, index_generation
+from unicorn.estimate import CostEstimator, CostExceeded, Estimate
+from unicorn.labels import LabelService
 from unicorn.qb import BasicQueryBuilder
-from unicorn.qe import BasicQueryExecutor
+from unicorn.parser import ParseError
+from unicorn.model import Query, QueryNode, Result, canonical
+from unicorn.qe import (
+    AsyncQueryExecutor, BasicQueryExecutor, ConcurrentQueryExecutor, DeadlineExceeded, MultiSearchQueryExecutor)
+from unicorn.topk import Deepening, TopK
+from unicorn.transport import TransportProfile
 from unicorn.utils import timer
-from unicorn import parser, sexpr
+from unicorn import prepared
 
 # There isn't a particularly convenient way to keep application
 # specific state, it has to be module level. For a demo app
@@ -25,8 +35,98 @@ config: Dict[str, Any] = {
         'edge_field': 'statement_keywords',
         'edge_kind_field': 'statement_keywords.property',
         'sort': {'sitelink_count': {'order': 'desc'}},
+        # Combine intermediate id sets locally when all sides of a
+        # boolean match no more than this many documents.
+        'local_threshold': None,
+        # 'source' filters edges of fetched inner hits, 'aggregation'
+        # only transfers the extracted ids.
+        'extract_strategy': 'source',
+        # Levels expanded below the roots of a closure
+        'closure_depth': 10,
     },
     'templates_path': os.environ.get('UNICORN_TEMPLATES', 'templates'),
+    'optimize': True,
+    'executor': {
+        # Max hits fetched by a single stage, across all pages
+        'limit': 10000,
+        'page_size': None,
+        'time_budget_ms': None,
+        'tiebreak': {'title.keyword': 'asc'},
+        # Default deadline of a single search, overridden by the
+        # timeout_ms request parameter.
+        'timeout_ms': 30000,
+        # Properties whose edges are held by another index of the
+        # cluster, ex: {'P180': 'commonswiki_file'}
+        'routes': {},
+    },
+    # Batch sibling stages into multi-search requests instead
+    # of running them concurrently.
+    'multi_search': False,
+    # Max concurrent inner stages across all requests
+    'parallelism': int(os.environ.get('UNICORN_PARALLELISM', 8)),
+    # Limit each stage to the estimated size of its inner query. Counts
+    # are kept in the stage cache. Queries estimated to fetch more than
+    # budget docs from inner stages are rejected, or only reported in
+    # debug when reject is false.
+    'estimate': {
+        'enabled': False,
+        'budget': None,
+        'reject': True,
+    },
+    # Start inner stages at initial_limit hits, multiplying it by growth
+    # up to the inner_limit of the query builder only while the top size
+    # hits of the search still change, see unicorn.topk.
+    'top_k': {
+        'enabled': False,
+        'initial_limit': 100,
+        'growth': 4,
+    },
+    # Wire format of elasticsearch requests, see unicorn.transport.
+    # filter_path drops unused response keys, docvalue_fields reads
+    # the mapped _source fields from doc values, json_library may be
+    # 'orjson' when installed. Decode time is not measured by unicorn.asgi.
+    'transport': {
+        'filter_path': False,
+        'docvalue_fields': {},
+        'http_compress': False,
+        'json_library': 'json',
+    },
+    # Elasticsearch connections of unicorn.asgi, shared by all
+    # concurrent requests of a process.
+    'async': {
+        'pool_size': 100,
+        'keepalive_s': 30,
+    },
+    # Outer pages of /search/stream are fetched page_size hits at a time
+    'stream': {
+        'page_size': 100,
+    },
+    # Results of query stages, and built plans of streamed queries,
+    # shared between requests
+    'stage_cache': {
+        'max_entries': 1000,
+        'ttl_s': 300,
+    },
+    # Labels of result ids are looked up after the search, preferring
+    # lang, then fallbacks[lang], then default_fallback. Each language
+    # caches max_entries labels for ttl_s.
+    'labels': {
+        'max_entries': 100000,
+        'ttl_s': 3600,
+        'fallbacks': {},
+        'default_fallback': ['en'],
+    },
+    # When path is set the stage cache is instead kept in an sqlite
+    # database shared by all workers of the host, and kept across
+    # restarts. Entries are dropped when the index, or any routed
+    # index, is rebuilt, checked in the background every
+    # generation_check_s.
+    'persistent_stage_cache': {
+        'path': os.environ.get('UNICORN_STAGE_CACHE', None),
+        'max_entries': 100000,
+        'ttl_s': 86400,
+        'generation_check_s': 60,
+    },
 }
 
 config_path = os.environ.get('UNICORN_CONFIG', None)
@@ -37,12 +137,45 @@ if config_path:
 
 qb = BasicQueryBuilder(**config['query_builder'])
 template_engine = Environment(loader=FileSystemLoader(config['templates_path']))
-elastic = Elasticsearch(**config['elasticsearch'])
+transport = TransportProfile(**config['transport'])
+elastic = transport.client(**config['elasticsearch'])
+pool = ThreadPoolExecutor(max_workers=config['parallelism'])
+
+
+def make_stage_cache() -> Cache:
+    # Sections of UNICORN_CONFIG replace the defaults, path may be missing
+    persistent = dict(config['persistent_stage_cache'])
+    path = persistent.pop('path', None)
+    if path is None:
+        return LRUCache(**config['stage_cache'])
+    indices = [config['index_name'], *config['executor'].get('routes', {}).values()]
+    return SqliteCache(path, generation=lambda: index_generation(elastic, indices), **persistent)
+
 
+def make_top_k() -> Optional[TopK]:
+    # Sections of UNICORN_CONFIG replace the defaults, enabled may be missing
+    top_k_config = dict(config['top_k'])
+    if not top_k_config.pop('enabled', False):
+        return None
+    return TopK(**top_k_config)
 
-def make_executor():
+
+stage_cache = make_stage_cache()
+top_k = make_top_k()
+label_service = LabelService(
+    elastic, config['index_name'], id_field=config['query_builder']['id_field'], **config['labels'])
+
+
+def make_executor(**kwargs) -> BasicQueryExecutor:
     """Per-request query executor"""
-    return BasicQueryExecutor(elastic, qb, config['index_name'])
+    executor_args = dict(config['executor'], **kwargs)
+    if config['multi_search']:
+        return MultiSearchQueryExecutor(
+            elastic, qb, config['index_name'],
+            cache=stage_cache, transport=transport, **executor_args)
+    return ConcurrentQueryExecutor(
+        elastic, qb, config['index_name'], pool,
+        cache=stage_cache, transport=transport, **executor_args)
 
 
 def get_template(name):
@@ -60,39 +193,282 @@ def output_format_html_template(name):
     return output_type
 
 
+class ChunkedStream:
+    """File-like view of an iterator of byte chunks, for streamed responses"""
+    def __init__(self, chunks: Iterator[bytes]):
+        self.chunks = chunks
+
+    def read(self, size: int = -1) -> bytes:
+        # Servers read until an empty chunk, chunks may be of any size
+        for chunk in self.chunks:
+            if chunk:
+                return chunk
+        return b''
+
+
+def output_format_ndjson(content, **kwargs):
+    """Newline delimited json"""
+    return ChunkedStream(json.dumps(line).encode('utf8') + b'\n' for line in content['lines'])
+
+
+output_format_ndjson.content_type = 'application/x-ndjson'  # type: ignore
+
+
+def output_format_html_stream(name):
+    def output_type(content, **kwargs):
+        return ChunkedStream(chunk.encode('utf8') for chunk in get_template(name).generate(content))
+
+    output_type.content_type = hug.output_format.html.content_type
+    output_type.__doc__ = "@TODO"
+    return output_type
+
+
 @hug.get('/', output=output_format_html_template('index.html'))
 def root():
     return {}
 
 
+def split_params(params: str) -> List[str]:
+    """Placeholder values of a prepared query, comma separated"""
+    return [param.strip() for param in params.split(',')] if params else []
+
+
 @hug.get('/search', output=hug.output_format.accept({
     'application/json': hug.output_format.json,
     'text/html': output_format_html_template('search.html'),
 }))
-def search(q: str, size: int = 1000, lang: str = 'en'):
-    executor = make_executor()
+def search(q: str, size: int = 1000, lang: str = 'en', timeout_ms: float = 0., params: str = '', response=None):
+    if timeout_ms > 0:
+        executor = make_executor(timeout_ms=timeout_ms)
+    else:
+        executor = make_executor()
     with timer() as took:
-        result = executor(
-            parser.parse(sexpr.parse(q)),
-            size=size,
-            source=['title', 'labels.' + lang],
-            sort=qb.sort,
-        )
-
-    result_truncated = result.total_hits - len(result.hits)
+        try:
+            query, estimate, cost_warning = plan_search(q, params, executor)
+        except ParseError as e:
+            # Invalid expressions, or placeholders without a value
+            response.status = hug.HTTP_400
+            return {'q': q, 'error': str(e)}
+        except CostExceeded as e:
+            return {
+                'q': q,
+                'error': str(e),
+                'estimate': e.estimate.to_dict(),
+            }
+        deepening = None
+        try:
+            if top_k is not None:
+                result, deepening = top_k(executor, query, qb.sort, size, ['title'])
+            else:
+                result = executor(
+                    query,
+                    size=size,
+                    source=['title'],
+                    sort=qb.sort,
+                )
+        except DeadlineExceeded:
+            result = timed_out_result()
+        with timer() as label_took:
+            labels = label_service.labels(result.ids, lang, executor.remaining_ms())
+    return search_response(
+        q, labels, executor, result, took.ms, estimate, cost_warning, label_took.ms, deepening)
+
+
+def plan_search(
+    q: str,
+    params: str,
+    executor: BasicQueryExecutor,
+) -> Tuple[QueryNode, Optional[Estimate], Optional[str]]:
+    """Query to execute for a search, with its estimate and any cost warning
+
+    Raises CostExceeded when the query is estimated to be over budget
+    and configured to reject such queries.
+    """
+    query = prepared.prepare(q, split_params(params), optimize=config['optimize'])
+    if not config['estimate']['enabled']:
+        return query, None, None
+    estimator = CostEstimator(
+        executor, qb.inner_limit, stage_cache, budget=config['estimate']['budget'])
+    try:
+        query, estimate = estimator(query)
+    except CostExceeded as e:
+        if config['estimate']['reject']:
+            raise
+        return e.planned, e.estimate, str(e)
+    return query, estimate, None
+
+
+def timed_out_result() -> Result:
+    # Nothing to show when no page of the final stage came back in time,
+    # the executor returns the pages fetched before the deadline otherwise
+    return Result({'took': 0, 'timed_out': True, 'hits': {'total': 0, 'hits': []}}, 0.)
+
+
+def search_response(
+    q: str,
+    labels: Mapping[str, str],
+    executor: Union[BasicQueryExecutor, AsyncQueryExecutor],
+    result: Result,
+    took_ms: float,
+    estimate: Optional[Estimate] = None,
+    cost_warning: Optional[str] = None,
+    label_ms: float = 0.,
+    deepening: Optional[Deepening] = None,
+) -> Dict[str, Any]:
+    result_truncated = result.truncated
+    if deepening is not None:
+        # Counters of the executor accumulate over all rounds
+        inner_truncated = deepening.inner_truncated
+    else:
+        inner_truncated = executor.truncated - result_truncated
+    trace = executor.tracer.last()
     return {
         'q': q,
         'hits': [{
-            'id': hit.id,
-            'label': hit.label(lang, ''),
-        } for hit in result.hits],
+            'id': hit_id,
+            'label': labels.get(hit_id, ''),
+        } for hit_id in result.ids],
         'total_hits': result.total_hits,
+        'timed_out': executor.timed_out,
         'debug': {
-            'inner_truncated': executor.truncated - result_truncated,
+            'inner_truncated': inner_truncated,
             'result_truncated': result_truncated,
             'es_took_ms': executor.es_took_ms,
             'net_took_ms': executor.took_ms - executor.es_took_ms,
-            'unicorn_took_ms': took.ms - executor.took_ms,
-            'total_took_ms': took.ms,
+            'response_bytes': executor.response_bytes,
+            'decode_ms': executor.decode_ms,
+            'label_ms': label_ms,
+            'unicorn_took_ms': took_ms - executor.took_ms - label_ms,
+            'total_took_ms': took_ms,
+            'cache_hits': executor.cache_hits,
+            'cache_misses': executor.cache_misses,
+            'trace': trace.to_dict() if trace is not None else None,
+            'estimate': estimate.to_dict() if estimate is not None else None,
+            'cost_warning': cost_warning,
+            'deepening': deepening.to_dict() if deepening is not None else None,
         }
     }
+
+
+def plan_key(query_node: QueryNode) -> str:
+    return hashlib.sha1(repr((config['index_name'], canonical(query_node))).encode('utf8')).hexdigest()
+
+
+def encode_cursor(plan: str, search_after: List[Any], offset: int) -> str:
+    cursor = json.dumps({'plan': plan, 'after': search_after, 'offset': offset})
+    return base64.urlsafe_b64encode(cursor.encode('utf8')).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> Tuple[str, List[Any], int]:
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return decoded['plan'], decoded['after'], decoded['offset']
+    except (ValueError, KeyError, TypeError):
+        raise ValueError('invalid cursor')
+
+
+@hug.get('/search/stream', output=hug.output_format.accept({
+    'application/x-ndjson': output_format_ndjson,
+    'text/html': output_format_html_stream('search_stream.html'),
+}))
+def search_stream(
+    q: str,
+    size: int = 1000,
+    lang: str = 'en',
+    cursor: str = '',
+    timeout_ms: float = 0.,
+    params: str = '',
+):
+    """Stream hits as the outer pages arrive, one json object per line
+
+    The final line holds a cursor, when more hits are available, that
+    continues from the last hit. Continuing requests must provide the
+    same q, the inner stages are not executed again while their built
+    plan is in the stage cache.
+    """
+    # Continuing requests repeat all arguments but the cursor
+    content: Dict[str, Any] = {
+        'q': q,
+        'args': {'q': q, 'size': size, 'lang': lang, 'timeout_ms': timeout_ms, 'params': params},
+    }
+    executor_args: Dict[str, Any] = {'page_size': config['stream']['page_size']}
+    if timeout_ms > 0:
+        executor_args['timeout_ms'] = timeout_ms
+    executor = make_executor(**executor_args)
+    query_node = prepared.prepare(q, split_params(params), optimize=config['optimize'])
+    plan = plan_key(query_node)
+
+    search_after = None
+    offset = 0
+    if cursor:
+        try:
+            cursor_plan, search_after, offset = decode_cursor(cursor)
+        except ValueError as e:
+            return dict(content, lines=[{'error': str(e)}])
+        if cursor_plan != plan:
+            return dict(content, lines=[{'error': 'cursor was not issued for q'}])
+
+    cache_key = ('plan', plan)
+    query = stage_cache.get(cache_key)
+    if query is None:
+        try:
+            query = executor.build(query_node)
+        except DeadlineExceeded:
+            return dict(content, lines=[summary(executor, None, 0, None)])
+        if not executor.timed_out:
+            stage_cache.put(cache_key, query)
+    return dict(content, lines=stream_hits(executor, plan, query, size, lang, search_after, offset))
+
+
+def stream_hits(
+    executor: BasicQueryExecutor,
+    plan: str,
+    query: Query,
+    size: int,
+    lang: str,
+    search_after: Optional[List[Any]],
+    offset: int,
+) -> Iterator[Dict[str, Any]]:
+    total_hits = None
+    with timer() as took:
+        try:
+            pages = executor.stream(
+                query, qb.sort, size, source=['title'], search_after=search_after)
+            for result in pages:
+                labels = label_service.labels(result.ids, lang, executor.remaining_ms())
+                for hit_id in result.ids:
+                    yield {'id': hit_id, 'label': labels.get(hit_id, '')}
+                total_hits = result.total_hits
+                offset += result.num_hits
+                es_hits = result.es_hits
+                if es_hits:
+                    search_after = es_hits[-1]['sort']
+        except DeadlineExceeded:
+            pass
+    next_cursor = None
+    if total_hits is not None and search_after is not None and offset < total_hits:
+        next_cursor = encode_cursor(plan, search_after, offset)
+    yield summary(executor, total_hits, took.ms, next_cursor)
+
+
+def summary(
+    executor: BasicQueryExecutor,
+    total_hits: Optional[int],
+    took_ms: float,
+    cursor: Optional[str],
+) -> Dict[str, Any]:
+    """Final line of a streamed search"""
+    return {
+        'cursor': cursor,
+        'total_hits': total_hits,
+        'timed_out': executor.timed_out,
+        'debug': {
+            'es_took_ms': executor.es_took_ms,
+            'net_took_ms': executor.took_ms - executor.es_took_ms,
+            'response_bytes': executor.response_bytes,
+            'decode_ms': executor.decode_ms,
+            'stream_took_ms': took_ms,
+            'cache_hits': executor.cache_hits,
+            'cache_misses': executor.cache_misses,
+        },
+    }